@@ -9,12 +9,14 @@ import logging
 from pathlib import Path
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CallbackQueryHandler, MessageHandler, CommandHandler, filters, ContextTypes
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
+from utils import gcal_client, api_usage
+from utils.lesson_sync import apply_events, mark_lessons_fresh, lessons_fresh_as_of
 from utils.name_matcher import get_match_with_confidence
 
 # Setup logging
@@ -46,6 +48,35 @@ HIGH_CONFIDENCE_THRESHOLD = 95
 # Storage temporaneo per le conversazioni (in produzione usare Redis)
 pending_associations = {}
 
+# I/O bloccante (Google Calendar, SQLite) fuori dall'event loop del bot:
+# thread limitati, un solo sync calendario alla volta
+IO_WORKERS = 4
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='resolver-io')
+calendar_sync_lock = asyncio.Lock()
+
+# /process risincronizza le lezioni di oggi solo se l'ultimo sync (del bot, dello
+# script incrementale o delle notifiche push) è più vecchio di così
+LESSONS_MAX_AGE = timedelta(minutes=15)
+
+# Sync iniziale in background (riferimento al task, vedi warm_start)
+warm_start_task = None
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Esegue una funzione bloccante in io_executor senza bloccare l'event loop.
+
+    Returns:
+        Il valore restituito da func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+
+def get_calendar_service():
+    """Service Google Calendar condiviso (client e token riusati tra le chiamate)."""
+    return gcal_client.get_calendar_service(GCAL_SERVICE_ACCOUNT_FILE, SCOPES)
+
 
 def get_students_from_calendar():
     """
@@ -54,26 +85,23 @@ def get_students_from_calendar():
     Returns:
         Set di nomi studenti
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(GCAL_SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
+    service = get_calendar_service()
 
-    # Prendi eventi degli ultimi 60 giorni
+    # Prendi eventi degli ultimi 60 giorni (e dei prossimi 60: senza limite la
+    # paginazione scaricherebbe tutte le ricorrenze future)
     now = datetime.utcnow()
     time_min = (now - timedelta(days=60)).isoformat() + 'Z'
+    time_max = (now + timedelta(days=60)).isoformat() + 'Z'
 
     try:
-        events_result = service.events().list(
-            calendarId=GCAL_CALENDAR_ID,
+        events = list(gcal_client.iter_events(
+            service, GCAL_CALENDAR_ID,
+            fields='summary',
             timeMin=time_min,
-            maxResults=200,
+            timeMax=time_max,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
+        ))
 
         # Estrai nomi unici (pulendo da varianti)
         studenti = set()
@@ -102,11 +130,7 @@ def get_lessons_by_date_range(payment_date):
     Returns:
         Lista di dict con: nome_studente, data_lezione
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(GCAL_SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
+    service = get_calendar_service()
 
     # Parse payment date
     payment_dt = datetime.strptime(payment_date, '%Y-%m-%d')
@@ -116,15 +140,14 @@ def get_lessons_by_date_range(payment_date):
     time_max = (payment_dt + timedelta(days=3)).isoformat() + 'Z'
 
     try:
-        events_result = service.events().list(
-            calendarId=GCAL_CALENDAR_ID,
+        events = list(gcal_client.iter_events(
+            service, GCAL_CALENDAR_ID,
+            fields='summary,start',
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
+        ))
 
         lessons = []
         for event in events:
@@ -163,11 +186,7 @@ def sync_today_lessons_from_calendar():
     Returns:
         Numero di lezioni sincronizzate
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(GCAL_SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
+    service = get_calendar_service()
 
     # Range: SOLO OGGI (00:00 - 23:59)
     today = datetime.now().date()
@@ -175,80 +194,29 @@ def sync_today_lessons_from_calendar():
     time_max = datetime.combine(today, datetime.max.time()).isoformat() + 'Z'
 
     try:
-        events_result = service.events().list(
-            calendarId=GCAL_CALENDAR_ID,
+        fetch_started = datetime.now()
+        events = list(gcal_client.iter_events(
+            service, GCAL_CALENDAR_ID,
+            fields=gcal_client.LESSON_EVENT_FIELDS,
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
+        ))
 
         conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Recupera event_id dal calendario per confronto
-        calendar_event_ids = set()
-
-        synced = 0
-        for event in events:
-            event_id = event['id']
-            calendar_event_ids.add(event_id)
-
-            summary = event.get('summary', '').strip()
-            start = event['start'].get('dateTime', event['start'].get('date'))
-
-            # Salta eventi "prova"
-            if not summary or summary.lower().startswith('prova'):
-                continue
-
-            # Parse date e time
-            if 'T' in start:
-                dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                giorno = dt.strftime('%Y-%m-%d')
-                ora = dt.strftime('%H:%M:%S')
-            else:
-                giorno = start
-                ora = '00:00:00'
 
-            # Normalizza nome studente
-            nome_studente = summary.replace('dmitry1', 'dmitry').strip()
-
-            # Insert or update
-            try:
-                cursor.execute('''
-                    INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
-                    VALUES (?, ?, ?, ?, 'prevista')
-                    ON CONFLICT(nextcloud_event_id) DO UPDATE SET
-                        nome_studente = excluded.nome_studente,
-                        giorno = excluded.giorno,
-                        ora = excluded.ora
-                ''', (event_id, nome_studente, giorno, ora))
-                synced += 1
-            except sqlite3.IntegrityError as e:
-                logger.warning(f"Errore inserimento lezione {event_id}: {e}")
-
-        # CANCELLA lezioni di oggi che non esistono più nel calendario
+        # Upsert + CANCELLA lezioni di oggi che non esistono più nel calendario
         # (es. lezione cancellata sul calendario)
-        if calendar_event_ids:
-            placeholders = ','.join(['?' for _ in calendar_event_ids])
-            cursor.execute(f'''
-                DELETE FROM lezioni
-                WHERE giorno = ?
-                AND nextcloud_event_id NOT IN ({placeholders})
-            ''', [str(today)] + list(calendar_event_ids))
-            deleted = cursor.rowcount
-            if deleted > 0:
-                logger.info(f"🗑️  Rimosse {deleted} lezioni di oggi cancellate dal calendario")
-        else:
-            # Nessun evento oggi, cancella tutte le lezioni di oggi dal DB
-            cursor.execute('DELETE FROM lezioni WHERE giorno = ?', (str(today),))
-            deleted = cursor.rowcount
-            if deleted > 0:
-                logger.info(f"🗑️  Rimosse {deleted} lezioni di oggi (nessun evento sul calendario)")
+        stats = apply_events(conn, events, reconcile_days=(str(today), str(today)))
+        synced = stats['synced']
+        if stats['deleted'] > 0:
+            logger.info(f"🗑️  Rimosse {stats['deleted']} lezioni di oggi cancellate dal calendario")
+        if stats['flagged'] > 0:
+            logger.warning(f"⚠️  {stats['flagged']} lezioni pagate senza evento: in lezioni_da_verificare")
 
         conn.commit()
+        mark_lessons_fresh(conn, fetch_started)
         conn.close()
 
         logger.info(f"✅ Sincronizzate {synced} lezioni di OGGI da Google Calendar")
@@ -271,11 +239,7 @@ def sync_lessons_from_calendar(days_back=60):
     Returns:
         Numero di lezioni sincronizzate
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(GCAL_SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
+    service = get_calendar_service()
 
     # Range di date: da days_back fa fino a OGGI (fine giornata)
     now = datetime.now()
@@ -283,60 +247,31 @@ def sync_lessons_from_calendar(days_back=60):
     time_max = now.replace(hour=23, minute=59, second=59).isoformat() + 'Z'
 
     try:
-        events_result = service.events().list(
-            calendarId=GCAL_CALENDAR_ID,
+        events = list(gcal_client.iter_events(
+            service, GCAL_CALENDAR_ID,
+            fields=gcal_client.LESSON_EVENT_FIELDS,
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
+        ))
 
+        # Nota: costo viene impostato a DEFAULT 2000 RUB dalla tabella
+        # Può essere modificato manualmente tramite interfaccia web
+        # Il primo giorno è letto solo in parte (timeMin a metà giornata):
+        # le lezioni senza evento si riconciliano dal giorno dopo a oggi
+        first_day = (now - timedelta(days=days_back - 1)).date()
         conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        synced = 0
-        for event in events:
-            event_id = event['id']
-            summary = event.get('summary', '').strip()
-            start = event['start'].get('dateTime', event['start'].get('date'))
-
-            # Salta eventi "prova"
-            if not summary or summary.lower().startswith('prova'):
-                continue
-
-            # Parse date e time
-            if 'T' in start:
-                dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                giorno = dt.strftime('%Y-%m-%d')
-                ora = dt.strftime('%H:%M:%S')
-            else:
-                giorno = start
-                ora = '00:00:00'  # Default per eventi all-day
-
-            # Normalizza nome studente
-            nome_studente = summary.replace('dmitry1', 'dmitry').strip()
-
-            # Insert or update
-            # Nota: costo viene impostato a DEFAULT 2000 RUB dalla tabella
-            # Può essere modificato manualmente tramite interfaccia web
-            try:
-                cursor.execute('''
-                    INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
-                    VALUES (?, ?, ?, ?, 'prevista')
-                    ON CONFLICT(nextcloud_event_id) DO UPDATE SET
-                        nome_studente = excluded.nome_studente,
-                        giorno = excluded.giorno,
-                        ora = excluded.ora
-                ''', (event_id, nome_studente, giorno, ora))
-                synced += 1
-            except sqlite3.IntegrityError as e:
-                logger.warning(f"Errore inserimento lezione {event_id}: {e}")
-
+        stats = apply_events(conn, events, reconcile_days=(str(first_day), str(now.date())))
         conn.commit()
+        mark_lessons_fresh(conn, now)
         conn.close()
 
+        synced = stats['synced']
+        if stats['deleted'] > 0:
+            logger.info(f"🗑️  Rimosse {stats['deleted']} lezioni cancellate dal calendario")
+        if stats['flagged'] > 0:
+            logger.warning(f"⚠️  {stats['flagged']} lezioni pagate senza evento: in lezioni_da_verificare")
         logger.info(f"✅ Sincronizzate {synced} lezioni da Google Calendar")
         return synced
 
@@ -551,6 +486,204 @@ def mark_payment_as_skipped(payment_id):
     logger.info(f"Pagamento {payment_id} marcato come skipped")
 
 
+def clear_skipped_flag(payment_id):
+    """Rimuove il flag skipped per permettere il riprocessamento."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('UPDATE pagamenti SET skipped = 0 WHERE id_pagamento = ?', (payment_id,))
+    conn.commit()
+    conn.close()
+
+
+def get_payment_context(nome_pagante, payment_date):
+    """
+    Recupera l'associazione esistente del pagante e le lezioni del giorno del pagamento.
+
+    Args:
+        nome_pagante: Nome del pagante
+        payment_date: Data pagamento (YYYY-MM-DD)
+
+    Returns:
+        Tupla (nome_studente associato o None, lista di dict lezione)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('SELECT nome_studente FROM associazioni WHERE nome_pagante = ?', (nome_pagante,))
+    existing = cursor.fetchone()
+
+    # Recupera lezioni SOLO dello stesso giorno
+    cursor.execute('''
+        SELECT id_lezione, nome_studente, giorno, ora
+        FROM lezioni
+        WHERE giorno = ?
+        ORDER BY ora ASC
+    ''', (payment_date,))
+
+    lessons = []
+    for row in cursor.fetchall():
+        lessons.append({
+            'id': row[0],
+            'nome_studente': row[1],
+            'giorno': row[2],
+            'ora': row[3]
+        })
+
+    conn.close()
+    return (existing[0] if existing else None), lessons
+
+
+def save_lesson_quotas(payment_id, quotas):
+    """
+    Abbina un pagamento a una o più lezioni (pagamenti_lezioni).
+    Se l'abbinamento esiste già, la quota viene sommata a quella esistente.
+
+    Args:
+        payment_id: ID del pagamento
+        quotas: Lista di tuple (lezione_id, quota_usata)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    for lezione_id, quota_usata in quotas:
+        # Controlla se abbinamento esiste già
+        cursor.execute('''
+            SELECT id FROM pagamenti_lezioni
+            WHERE pagamento_id = ? AND lezione_id = ?
+        ''', (payment_id, lezione_id))
+
+        existing = cursor.fetchone()
+
+        if existing:
+            # Aggiorna quota esistente invece di inserire duplicato
+            cursor.execute('''
+                UPDATE pagamenti_lezioni
+                SET quota_usata = quota_usata + ?
+                WHERE id = ?
+            ''', (quota_usata, existing[0]))
+            logger.info(f"⚠️  Abbinamento già esistente, aggiornata quota: +{quota_usata}")
+        else:
+            # Inserisci nuovo abbinamento
+            cursor.execute('''
+                INSERT INTO pagamenti_lezioni (pagamento_id, lezione_id, quota_usata)
+                VALUES (?, ?, ?)
+            ''', (payment_id, lezione_id, quota_usata))
+
+    conn.commit()
+    conn.close()
+
+
+def associate_new_payment(payment_id, lezione_id):
+    """
+    Associa un nuovo pagamento (notificato dal monitor) a una lezione, per l'intero importo.
+
+    Returns:
+        Tupla (riga pagamento, riga lezione) o None se non trovati
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT nome_pagante, giorno, ora, somma, valuta FROM pagamenti WHERE id_pagamento = ?', (payment_id,))
+    pay_row = cursor.fetchone()
+
+    cursor.execute('SELECT nome_studente, giorno, ora FROM lezioni WHERE id_lezione = ?', (lezione_id,))
+    les_row = cursor.fetchone()
+
+    if not pay_row or not les_row:
+        conn.close()
+        return None
+
+    nome_pagante = pay_row[0]
+    nome_studente = les_row[0]
+    quota_usata = pay_row[3]  # Usa l'intero importo
+
+    # Salva associazione pagante→studente
+    save_association(nome_pagante, nome_studente, auto_matched=False, confidence_score=0)
+
+    # Salva in pagamenti_lezioni
+    cursor.execute('''
+        INSERT INTO pagamenti_lezioni (pagamento_id, lezione_id, quota_usata)
+        VALUES (?, ?, ?)
+    ''', (payment_id, lezione_id, quota_usata))
+
+    # Marca come associato
+    cursor.execute('UPDATE pagamenti SET stato = ? WHERE id_pagamento = ?', ('associato', payment_id))
+
+    conn.commit()
+    conn.close()
+    return pay_row, les_row
+
+
+def archive_payment(payment_id):
+    """
+    Archivia un pagamento per gestione via web.
+
+    Returns:
+        Riga (nome_pagante, somma, valuta)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE pagamenti SET stato = ? WHERE id_pagamento = ?', ('archivio', payment_id))
+    cursor.execute('SELECT nome_pagante, somma, valuta FROM pagamenti WHERE id_pagamento = ?', (payment_id,))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return row
+
+
+def lessons_are_fresh():
+    """
+    True se le lezioni fino a oggi sono state sincronizzate oggi, da meno di LESSONS_MAX_AGE.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    fresh_as_of = lessons_fresh_as_of(conn)
+    conn.close()
+
+    now = datetime.now()
+    return (
+        fresh_as_of is not None
+        and fresh_as_of.date() == now.date()
+        and now - fresh_as_of < LESSONS_MAX_AGE
+    )
+
+
+async def sync_today_if_stale():
+    """
+    Sincronizza le lezioni di oggi se non sono aggiornate.
+    Il controllo avviene col lock preso: se un sync (es. quello iniziale) è in
+    corso, lo aspetta e non ne ripete un altro.
+
+    Returns:
+        Numero di lezioni sincronizzate, None se erano già aggiornate
+    """
+    async with calendar_sync_lock:
+        if await run_blocking(lessons_are_fresh):
+            return None
+        return await run_blocking(tracked_sync, sync_today_lessons_from_calendar)
+
+
+def tracked_sync(sync_func, *args, **kwargs):
+    """
+    Esegue un sync contando a parte le sue richieste API: a fine sync una riga
+    per metodo in api_usage (il bot è residente, l'atexit arriverebbe solo alla chiusura).
+
+    Returns:
+        Il valore restituito da sync_func
+    """
+    with api_usage.usage_run(f"association_resolver.py {sync_func.__name__}", log=logger.info):
+        return sync_func(*args, **kwargs)
+
+
+async def run_calendar_sync(sync_func, *args, **kwargs):
+    """
+    Esegue un sync del calendario in io_executor, uno alla volta:
+    un secondo /sync o /process aspetta che finisca il primo.
+
+    Returns:
+        Numero di lezioni sincronizzate
+    """
+    async with calendar_sync_lock:
+        return await run_blocking(tracked_sync, sync_func, *args, **kwargs)
+
+
 async def process_payment(payment, bot):
     """
     Processa un singolo pagamento: mostra lezioni vicine e chiede associazione.
@@ -579,36 +712,12 @@ async def process_payment(payment, bot):
         abbonamento_type = "10 lezioni"
         num_lezioni = 10
 
-    # Controlla se esiste già associazione pagante→studente
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT nome_studente FROM associazioni WHERE nome_pagante = ?', (nome_pagante,))
-    existing = cursor.fetchone()
+    # Controlla se esiste già associazione pagante→studente + lezioni del giorno
+    nome_studente, lessons_in_range = await run_blocking(get_payment_context, nome_pagante, payment_date)
 
-    nome_studente = None
-    if existing:
-        nome_studente = existing[0]
+    if nome_studente:
         logger.info(f"✅ Associazione esistente trovata: {nome_pagante} → {nome_studente}")
 
-    # Recupera lezioni SOLO dello stesso giorno
-    cursor.execute('''
-        SELECT id_lezione, nome_studente, giorno, ora
-        FROM lezioni
-        WHERE giorno = ?
-        ORDER BY ora ASC
-    ''', (payment_date,))
-
-    lessons_in_range = []
-    for row in cursor.fetchall():
-        lessons_in_range.append({
-            'id': row[0],
-            'nome_studente': row[1],
-            'giorno': row[2],
-            'ora': row[3]
-        })
-
-    conn.close()
-
     if not lessons_in_range:
         logger.warning(f"Nessuna lezione trovata per il giorno {payment_date}")
 
@@ -732,7 +841,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Supporta selezione multipla per abbonamenti e quota_usata per lezioni condivise.
     """
     query = update.callback_query
-    await query.answer()
 
     data = query.data
     parts = data.split('_')
@@ -741,11 +849,19 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     payment_key = f"payment_{payment_id}"
 
-    if payment_key not in pending_associations:
+    # La sessione si prende (pop) prima di qualsiasi await: con concurrent_updates
+    # un doppio tap esegue due handler insieme e solo il primo deve trovarla.
+    # Viene rimessa in pending_associations se il pagamento non è ancora chiuso.
+    payment_data = pending_associations.pop(payment_key, None)
+    if payment_data is not None and action not in ("lesson", "skip"):
+        pending_associations[payment_key] = payment_data
+
+    await query.answer()
+
+    if payment_data is None:
         await query.edit_message_text("❌ Sessione scaduta. Riavvia lo script.")
         return
 
-    payment_data = pending_associations[payment_key]
     payment = payment_data['payment']
     abbonamento_type = payment_data.get('abbonamento_type')
     num_lezioni = payment_data.get('num_lezioni', 1)
@@ -758,26 +874,37 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Trova la lezione selezionata
         lesson = next((l for l in payment_data['lessons'] if l['id'] == lezione_id), None)
         if not lesson:
+            pending_associations[payment_key] = payment_data
             await query.answer("❌ Lezione non trovata", show_alert=True)
             return
 
+        # Abbonamento: aggiungi la lezione alla selezione (copia: dopo il primo
+        # await la sessione può essere ripresa da un altro tap)
+        if abbonamento_type and num_lezioni > 1:
+            if lezione_id not in selected_lessons:
+                selected_lessons = selected_lessons + [lezione_id]
+                payment_data['selected_lessons'] = selected_lessons
+            # Selezione incompleta: la sessione resta aperta per le prossime lezioni
+            if len(selected_lessons) < num_lezioni:
+                pending_associations[payment_key] = payment_data
+
         nome_studente = lesson['nome_studente']
 
         # Salva o aggiorna associazione pagante→studente
-        save_association(
-            payment['nome_pagante'],
-            nome_studente,
-            auto_matched=False,
-            confidence_score=0
-        )
+        try:
+            await run_blocking(
+                save_association,
+                payment['nome_pagante'],
+                nome_studente,
+                auto_matched=False,
+                confidence_score=0
+            )
+        except Exception:
+            pending_associations.setdefault(payment_key, payment_data)
+            raise
 
         # Gestione abbonamenti (selezione multipla)
         if abbonamento_type and num_lezioni > 1:
-            # Aggiungi lezione alla lista
-            if lezione_id not in selected_lessons:
-                selected_lessons.append(lezione_id)
-                payment_data['selected_lessons'] = selected_lessons
-
             # Controlla se abbiamo selezionato abbastanza lezioni
             if len(selected_lessons) < num_lezioni:
                 await query.answer(f"✅ Lezione aggiunta ({len(selected_lessons)}/{num_lezioni})")
@@ -787,35 +914,15 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Abbonamento completo, salva tutte le associazioni
                 quota_per_lezione = payment['residuo'] / num_lezioni
 
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-
-                for lid in selected_lessons:
-                    # Controlla se abbinamento esiste già
-                    cursor.execute('''
-                        SELECT id FROM pagamenti_lezioni
-                        WHERE pagamento_id = ? AND lezione_id = ?
-                    ''', (payment_id, lid))
-
-                    existing = cursor.fetchone()
-
-                    if existing:
-                        # Aggiorna quota esistente
-                        cursor.execute('''
-                            UPDATE pagamenti_lezioni
-                            SET quota_usata = quota_usata + ?
-                            WHERE id = ?
-                        ''', (quota_per_lezione, existing[0]))
-                        logger.info(f"⚠️  Abbinamento abbonamento già esistente, aggiornata quota: +{quota_per_lezione}")
-                    else:
-                        # Inserisci nuovo abbinamento
-                        cursor.execute('''
-                            INSERT INTO pagamenti_lezioni (pagamento_id, lezione_id, quota_usata)
-                            VALUES (?, ?, ?)
-                        ''', (payment_id, lid, quota_per_lezione))
-
-                conn.commit()
-                conn.close()
+                try:
+                    await run_blocking(
+                        save_lesson_quotas, payment_id,
+                        [(lid, quota_per_lezione) for lid in selected_lessons]
+                    )
+                except Exception:
+                    # Salvataggio fallito: la sessione resta aperta per riprovare
+                    pending_associations[payment_key] = payment_data
+                    raise
 
                 logger.info(f"✅ Abbonamento {abbonamento_type} associato: {num_lezioni} lezioni per {payment['nome_pagante']}")
 
@@ -833,34 +940,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             quota_usata = payment['residuo']  # Default: usa tutto il residuo
 
             # Salva in pagamenti_lezioni
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-
-            # Controlla se abbinamento esiste già
-            cursor.execute('''
-                SELECT id FROM pagamenti_lezioni
-                WHERE pagamento_id = ? AND lezione_id = ?
-            ''', (payment_id, lezione_id))
-
-            existing = cursor.fetchone()
-
-            if existing:
-                # Aggiorna quota esistente invece di inserire duplicato
-                cursor.execute('''
-                    UPDATE pagamenti_lezioni
-                    SET quota_usata = quota_usata + ?
-                    WHERE id = ?
-                ''', (quota_usata, existing[0]))
-                logger.info(f"⚠️  Abbinamento già esistente, aggiornata quota: +{quota_usata}")
-            else:
-                # Inserisci nuovo abbinamento
-                cursor.execute('''
-                    INSERT INTO pagamenti_lezioni (pagamento_id, lezione_id, quota_usata)
-                    VALUES (?, ?, ?)
-                ''', (payment_id, lezione_id, quota_usata))
-
-            conn.commit()
-            conn.close()
+            try:
+                await run_blocking(save_lesson_quotas, payment_id, [(lezione_id, quota_usata)])
+            except Exception:
+                # Salvataggio fallito: la sessione resta aperta per riprovare
+                pending_associations[payment_key] = payment_data
+                raise
 
             logger.info(f"✅ Pagamento-lezione associato: {payment['nome_pagante']} → {nome_studente}, quota: {quota_usata}")
 
@@ -873,11 +958,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='HTML'
             )
 
-        del pending_associations[payment_key]
-
         # Processa automaticamente il prossimo pagamento
         try:
-            payments = get_unassociated_payments()
+            payments = await run_blocking(get_unassociated_payments)
 
             if payments:
                 next_payment = payments[0]
@@ -901,7 +984,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif action == "skip":
         # Salta questo pagamento e marcalo come skipped
-        mark_payment_as_skipped(payment_id)
+        try:
+            await run_blocking(mark_payment_as_skipped, payment_id)
+        except Exception:
+            pending_associations[payment_key] = payment_data
+            raise
         logger.info(f"⏭️ Pagamento saltato e marcato: {payment['nome_pagante']} - {payment['somma']}")
 
         await query.edit_message_text(
@@ -912,11 +999,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML'
         )
 
-        del pending_associations[payment_key]
-
         # Processa automaticamente il prossimo pagamento (escludendo gli skipped)
         try:
-            payments = get_unassociated_payments(include_skipped=False)
+            payments = await run_blocking(get_unassociated_payments, include_skipped=False)
 
             if payments:
                 next_payment = payments[0]
@@ -931,7 +1016,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await process_payment(next_payment, context.bot)
             else:
                 # Controlla se ci sono skipped
-                skipped = get_skipped_payments()
+                skipped = await run_blocking(get_skipped_payments)
                 if skipped:
                     await context.bot.send_message(
                         chat_id=ADMIN_CHAT_ID,
@@ -954,39 +1039,17 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Gestione nuovi pagamenti notificati dal monitor
         lezione_id = int(parts[2])
 
-        # Recupera dati pagamento e lezione dal DB
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT nome_pagante, giorno, ora, somma, valuta FROM pagamenti WHERE id_pagamento = ?', (payment_id,))
-        pay_row = cursor.fetchone()
+        # Recupera dati pagamento e lezione dal DB e salva l'abbinamento
+        result = await run_blocking(associate_new_payment, payment_id, lezione_id)
 
-        cursor.execute('SELECT nome_studente, giorno, ora FROM lezioni WHERE id_lezione = ?', (lezione_id,))
-        les_row = cursor.fetchone()
-
-        if not pay_row or not les_row:
+        if result is None:
             await query.edit_message_text("❌ Dati non trovati")
-            conn.close()
             return
 
+        pay_row, les_row = result
         nome_pagante = pay_row[0]
         nome_studente = les_row[0]
-        quota_usata = pay_row[3]  # Usa l'intero importo
-
-        # Salva associazione pagante→studente
-        save_association(nome_pagante, nome_studente, auto_matched=False, confidence_score=0)
-
-        # Salva in pagamenti_lezioni
-        cursor.execute('''
-            INSERT INTO pagamenti_lezioni (pagamento_id, lezione_id, quota_usata)
-            VALUES (?, ?, ?)
-        ''', (payment_id, lezione_id, quota_usata))
-
-        # Marca come associato
-        cursor.execute('UPDATE pagamenti SET stato = ? WHERE id_pagamento = ?', ('associato', payment_id))
-
-        conn.commit()
-        conn.close()
+        quota_usata = pay_row[3]
 
         logger.info(f"✅ Nuovo pagamento associato: {nome_pagante} → {nome_studente}, {quota_usata} RUB")
 
@@ -1000,13 +1063,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif action == "archive":
         # Archivia pagamento per gestione via web
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE pagamenti SET stato = ? WHERE id_pagamento = ?', ('archivio', payment_id))
-        cursor.execute('SELECT nome_pagante, somma, valuta FROM pagamenti WHERE id_pagamento = ?', (payment_id,))
-        row = cursor.fetchone()
-        conn.commit()
-        conn.close()
+        row = await run_blocking(archive_payment, payment_id)
 
         logger.info(f"📦 Pagamento archiviato: {row[0]} - {row[1]}")
 
@@ -1040,25 +1097,31 @@ async def process_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
 
-    # PRIMA DI TUTTO: Sincronizza lezioni di OGGI dal calendario
-    await update.message.reply_text("🔄 Sincronizzazione lezioni di oggi...")
+    # PRIMA DI TUTTO: Sincronizza lezioni di OGGI dal calendario (se non aggiornate)
     try:
-        synced = sync_today_lessons_from_calendar()
-        logger.info(f"✅ Sincronizzate {synced} lezioni di oggi prima del /process")
+        if await run_blocking(lessons_are_fresh):
+            logger.info("✅ Lezioni già aggiornate: nessun sync prima del /process")
+        else:
+            await update.message.reply_text("🔄 Sincronizzazione lezioni di oggi...")
+            synced = await sync_today_if_stale()
+            if synced is None:
+                logger.info("✅ Lezioni aggiornate da un sync in corso: nessun sync prima del /process")
+            else:
+                logger.info(f"✅ Sincronizzate {synced} lezioni di oggi prima del /process")
     except Exception as e:
         logger.error(f"❌ Errore sincronizzazione lezioni oggi: {e}")
         await update.message.reply_text(f"⚠️ Errore sync lezioni: {e}\nContinuo comunque...")
 
     # Carica pagamenti non associati (ESCLUSI gli skipped)
     try:
-        payments = get_unassociated_payments(include_skipped=False)
+        payments = await run_blocking(get_unassociated_payments, include_skipped=False)
     except Exception as e:
         await update.message.reply_text(f"❌ Errore caricamento pagamenti: {e}")
         return
 
     if not payments:
         # Controlla se ci sono skipped
-        skipped = get_skipped_payments()
+        skipped = await run_blocking(get_skipped_payments)
         if skipped:
             await update.message.reply_text(
                 f"✅ Nessun pagamento da processare!\n\n"
@@ -1097,7 +1160,7 @@ async def suspended_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Carica SOLO i pagamenti skipped
     try:
-        payments = get_skipped_payments()
+        payments = await run_blocking(get_skipped_payments)
     except Exception as e:
         await update.message.reply_text(f"❌ Errore caricamento pagamenti skipped: {e}")
         return
@@ -1110,11 +1173,7 @@ async def suspended_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     payment = payments[0]
 
     # Rimuovi flag skipped per permettere riprocessamento
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE pagamenti SET skipped = 0 WHERE id_pagamento = ?', (payment['id'],))
-    conn.commit()
-    conn.close()
+    await run_blocking(clear_skipped_flag, payment['id'])
 
     logger.info(f"📋 Totale pagamenti sospesi: {len(payments)}")
     logger.info(f"▶️ Riprocessamento pagamento sospeso: ID {payment['id']}")
@@ -1141,7 +1200,7 @@ async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Sincronizzazione lezioni da Google Calendar in corso...")
 
     try:
-        synced = sync_lessons_from_calendar(days_back=60)
+        synced = await run_calendar_sync(sync_lessons_from_calendar, days_back=60)
         await update.message.reply_text(
             f"✅ <b>Sincronizzazione completata!</b>\n\n"
             f"📚 {synced} lezioni sincronizzate dal calendario.\n"
@@ -1153,6 +1212,25 @@ async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Errore durante la sincronizzazione: {e}")
 
 
+async def initial_sync():
+    """Sync iniziale delle lezioni (ultimi 60 giorni), eseguito mentre il bot risponde già."""
+    logger.info("🔄 Sincronizzazione iniziale lezioni in background...")
+    try:
+        synced = await run_calendar_sync(sync_lessons_from_calendar, days_back=60)
+        logger.info(f"✅ Sync iniziale: {synced} lezioni (ultimi 60 giorni fino a oggi)")
+    except Exception as e:
+        logger.error(f"❌ Errore sync iniziale lezioni: {e}")
+
+
+async def warm_start(application):
+    """
+    post_init: avvia il sync iniziale in background, il polling parte subito.
+    Un /process ricevuto nel frattempo aspetta la fine del sync (calendar_sync_lock).
+    """
+    global warm_start_task
+    warm_start_task = asyncio.get_running_loop().create_task(initial_sync())
+
+
 def main():
     """Funzione principale."""
     if not BOT_TOKEN:
@@ -1171,13 +1249,17 @@ def main():
     print(f"Admin Chat ID: {ADMIN_CHAT_ID}")
     print("="*60 + "\n")
 
-    # Sincronizza lezioni all'avvio
-    print("🔄 Sincronizzazione lezioni da Google Calendar...")
-    synced = sync_lessons_from_calendar(days_back=60)
-    print(f"✅ {synced} lezioni sincronizzate (ultimi 60 giorni fino a oggi)\n")
-
     # Crea l'applicazione
-    application = Application.builder().token(BOT_TOKEN).build()
+    # concurrent_updates: gli altri update (altri admin, bottoni) vengono gestiti
+    # mentre un handler aspetta un sync o il database.
+    # Il sync delle lezioni all'avvio gira in background (warm_start)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(warm_start)
+        .build()
+    )
 
     # Aggiungi handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -1187,7 +1269,8 @@ def main():
     application.add_handler(CallbackQueryHandler(handle_callback))
 
     # Avvia il bot
-    print("🤖 Bot avviato! Premi Ctrl+C per terminare.\n")
+    print("🤖 Bot avviato! Premi Ctrl+C per terminare.")
+    print("🔄 Sincronizzazione lezioni (ultimi 60 giorni) in background...\n")
     print(f"📱 Invia /process al bot per elaborare i pagamenti.")
     print(f"📱 Usa /suspended per riprocessare i pagamenti sospesi.")
 
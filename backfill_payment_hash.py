@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Backfill della colonna hash_contenuto per i pagamenti già nel database.
+
+In un solo passaggio sulla tabella pagamenti:
+- aggiunge la colonna hash_contenuto (se manca) e il suo indice
+- calcola l'hash (pagante normalizzato, giorno, ora, somma) delle righe senza hash
+- riporta i gruppi di pagamenti con lo stesso hash, cioè i duplicati già presenti
+
+I duplicati NON vengono cancellati: possono essere già abbinati a lezioni
+(pagamenti_lezioni) e vanno verificati a mano.
+
+Uso:
+    python backfill_payment_hash.py
+"""
+import sqlite3
+from pathlib import Path
+
+from utils.payments_db import content_hash, ensure_content_hash_column
+
+DB_PATH = Path(__file__).parent / "pagamenti.db"
+
+
+def backfill_payment_hash(db_path):
+    """
+    Calcola hash_contenuto per le righe che non lo hanno e trova i duplicati.
+
+    Args:
+        db_path: Path del database SQLite
+
+    Returns:
+        dict con total, updated e duplicates (lista di gruppi, ognuno lista di righe)
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    ensure_content_hash_column(conn)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT id_pagamento, nome_pagante, giorno, ora, somma, stato, fonte_msg_id, hash_contenuto
+        FROM pagamenti
+        ORDER BY id_pagamento
+    ''')
+
+    groups = {}
+    updates = []
+    total = 0
+
+    for row in cursor:
+        total += 1
+        hash_contenuto = row['hash_contenuto']
+        if hash_contenuto is None:
+            hash_contenuto = content_hash(row['nome_pagante'], row['giorno'], row['ora'], row['somma'])
+            updates.append((hash_contenuto, row['id_pagamento']))
+        groups.setdefault(hash_contenuto, []).append(dict(row))
+
+    cursor.executemany('UPDATE pagamenti SET hash_contenuto = ? WHERE id_pagamento = ?', updates)
+    conn.commit()
+    conn.close()
+
+    return {
+        'total': total,
+        'updated': len(updates),
+        'duplicates': [rows for rows in groups.values() if len(rows) > 1]
+    }
+
+
+def main():
+    """Funzione principale."""
+    print("="*60)
+    print("BACKFILL HASH CONTENUTO PAGAMENTI")
+    print("="*60)
+    print(f"Database: {DB_PATH}")
+    print("="*60 + "\n")
+
+    stats = backfill_payment_hash(DB_PATH)
+
+    print(f"✅ Pagamenti analizzati: {stats['total']}")
+    print(f"✅ Hash calcolati: {stats['updated']}")
+
+    if not stats['duplicates']:
+        print("\n✅ Nessun pagamento duplicato")
+        return
+
+    extra = sum(len(rows) - 1 for rows in stats['duplicates'])
+    print(f"\n⚠️  {len(stats['duplicates'])} gruppi di duplicati ({extra} pagamenti in più):\n")
+
+    for rows in stats['duplicates']:
+        first = rows[0]
+        print(f"📋 {first['nome_pagante']} - {first['somma']}₽ - {first['giorno']} {first['ora']}")
+        for row in rows:
+            print(f"   ID {row['id_pagamento']} | stato: {row['stato']} | fonte: {row['fonte_msg_id']}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
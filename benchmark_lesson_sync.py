@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+Benchmark del motore di sync eventi → lezioni (utils/lesson_sync.py).
+
+Misura le righe/secondo di apply_events() su un calendario sintetico e le confronta
+con il vecchio ciclo (un INSERT ... ON CONFLICT per evento), in tre scenari:
+- primo caricamento (tutte lezioni nuove)
+- re-sync senza modifiche
+- re-sync con il 10% degli eventi spostati e l'1% cancellati
+
+Ogni scenario gira su un database temporaneo con lo schema di db_create_schema.py,
+con un solo commit finale come nei sync reali.
+
+Uso:
+    python benchmark_lesson_sync.py                  # 50k eventi
+    python benchmark_lesson_sync.py --size 200000
+"""
+import io
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+
+from db_create_schema import create_schema
+from utils.lesson_sync import apply_events
+
+STUDENTI = ['Ivan', 'Maria', 'Sergey', 'Daria', 'Ekaterina', 'Naili', 'dmitry1', 'Anna K', 'Oleg']
+
+
+def build_events(size, seed=42):
+    """
+    Genera un calendario sintetico (lezioni tra agosto 2025 e oggi, qualche prova).
+
+    Returns:
+        Lista di eventi nel formato di events().list
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 8, 1, 8, 0)
+    span_minutes = int((datetime.now() - start).total_seconds() // 60) - 24 * 60
+
+    events = []
+    for i in range(size):
+        dt = start + timedelta(minutes=rng.randrange(span_minutes))
+        summary = rng.choice(STUDENTI)
+        if rng.random() < 0.03:
+            summary = f"prova {summary}"
+        events.append({
+            'id': f"evt{i:07d}",
+            'status': 'confirmed',
+            'summary': summary,
+            'start': {'dateTime': dt.strftime('%Y-%m-%dT%H:%M:00+03:00')}
+        })
+    return events
+
+
+def modify_events(events, seed=7):
+    """Sposta di un'ora il 10% degli eventi e ne cancella l'1%."""
+    rng = random.Random(seed)
+    modified = []
+    for event in events:
+        r = rng.random()
+        if r < 0.01:
+            modified.append({'id': event['id'], 'status': 'cancelled'})
+        elif r < 0.11:
+            dt = datetime.fromisoformat(event['start']['dateTime']) + timedelta(hours=1)
+            modified.append({**event, 'start': {'dateTime': dt.isoformat()}})
+        else:
+            modified.append(event)
+    return modified
+
+
+def legacy_sync(conn, events):
+    """Vecchio ciclo: parsing e un upsert (o delete) per evento."""
+    cursor = conn.cursor()
+    oggi = datetime.now().date().isoformat()
+
+    for event in events:
+        event_id = event['id']
+        if event.get('status') == 'cancelled':
+            cursor.execute('DELETE FROM lezioni WHERE nextcloud_event_id = ?', (event_id,))
+            continue
+
+        summary = event.get('summary', '').strip()
+        if not summary or summary.lower().startswith('prova'):
+            continue
+
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        if 'T' in start:
+            dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
+            giorno = dt.strftime('%Y-%m-%d')
+            ora = dt.strftime('%H:%M:%S')
+        else:
+            giorno = start
+            ora = '00:00:00'
+
+        if giorno > oggi or giorno < '2025-08-01':
+            continue
+
+        nome_studente = summary.replace('dmitry1', 'dmitry').strip()
+        cursor.execute('''
+            INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
+            VALUES (?, ?, ?, ?, 'prevista')
+            ON CONFLICT(nextcloud_event_id) DO UPDATE SET
+                nome_studente = excluded.nome_studente,
+                giorno = excluded.giorno,
+                ora = excluded.ora
+        ''', (event_id, nome_studente, giorno, ora))
+
+    conn.commit()
+
+
+def engine_sync(conn, events):
+    """Nuovo motore: righe in memoria, executemany e delete set-based."""
+    apply_events(conn, events, min_day='2025-08-01', max_day=datetime.now().date().isoformat())
+    conn.commit()
+
+
+def run_scenarios(sync_func, events, modified, workdir, name):
+    """
+    Esegue i tre scenari su un database nuovo.
+
+    Returns:
+        Lista di (scenario, secondi, lezioni finali)
+    """
+    db_path = Path(workdir) / f"{name}.db"
+    conn = sqlite3.connect(db_path)
+    with redirect_stdout(io.StringIO()):
+        create_schema(conn)
+
+    results = []
+    for scenario, batch in (('primo caricamento', events), ('re-sync invariato', events),
+                            ('re-sync 10% modificati', modified)):
+        start = time.perf_counter()
+        sync_func(conn, batch)
+        elapsed = time.perf_counter() - start
+        count = conn.execute('SELECT COUNT(*) FROM lezioni').fetchone()[0]
+        results.append((scenario, elapsed, count))
+
+    conn.close()
+    return results
+
+
+def main():
+    """Benchmark principale."""
+    parser = argparse.ArgumentParser(description="Benchmark sync eventi → lezioni")
+    parser.add_argument('--size', type=int, default=50_000, help="Eventi del calendario sintetico")
+    args = parser.parse_args()
+
+    events = build_events(args.size)
+    modified = modify_events(events)
+
+    print("="*60)
+    print("BENCHMARK SYNC LEZIONI")
+    print("="*60)
+    print(f"Calendario sintetico: {len(events):,} eventi")
+    print("="*60 + "\n")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        legacy = run_scenarios(legacy_sync, events, modified, workdir, 'legacy')
+        engine = run_scenarios(engine_sync, events, modified, workdir, 'engine')
+
+    for (scenario, legacy_time, legacy_count), (_, new_time, new_count) in zip(legacy, engine):
+        print(f"{scenario}:")
+        print(f"   Vecchio ciclo  : {len(events) / legacy_time:>12,.0f} eventi/s ({legacy_time:.3f}s)")
+        print(f"   apply_events() : {len(events) / new_time:>12,.0f} eventi/s ({new_time:.3f}s)")
+        print(f"   Speedup        : {legacy_time / new_time:>12.2f}x")
+        if legacy_count != new_count:
+            print(f"   ⚠️  Lezioni diverse: {legacy_count} (vecchio) vs {new_count} (nuovo)")
+        print()
+
+
+if __name__ == "__main__":
+    main()
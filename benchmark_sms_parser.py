@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Benchmark del parser SMS condiviso (utils/sms_parser.py).
+
+Misura i messaggi/secondo di parse_many() su un corpus di messaggi e li confronta
+con il vecchio parsing (regex completa su ogni messaggio, senza prefiltro).
+
+Uso:
+    python benchmark_sms_parser.py                      # corpus sintetico (100k messaggi)
+    python benchmark_sms_parser.py --size 500000        # corpus sintetico più grande
+    python benchmark_sms_parser.py --corpus sms.txt     # un messaggio per riga
+"""
+import re
+import time
+import random
+import argparse
+from datetime import datetime
+
+from utils.sms_parser import parse_many
+
+# Vecchio pattern (copiato in telegram_ingestor.py e telegram_bulk_ingestor.py)
+LEGACY_SMS_PATTERN = re.compile(
+    r'СЧЁТ\d+\s+'
+    r'(\d{1,2}):(\d{2})\s+'
+    r'Перевод.*?'
+    r'([\d\s]+)р\s+'
+    r'от\s+'
+    r'([А-ЯЁA-Za-zА-яё]+(?:\s+[А-ЯЁA-Za-zА-яё]\.?)?)'
+)
+
+NOMI = ['ИВАН И.', 'МАРИЯ П.', 'СЕРГЕЙ К.', 'ДАРЬЯ М.', 'ЕКАТЕРИНА А.', 'НАИЛИ Г.']
+
+# Messaggi tipici del canale che NON sono pagamenti in entrata
+NON_PAYMENT_TEMPLATES = [
+    "СЧЁТ3185 {hh}:{mm} Покупка {somma}р PYATEROCHKA Баланс: 12 345р",
+    "СЧЁТ3185 {hh}:{mm} Оплата {somma}р Мобильная связь Баланс: 8 210р",
+    "СЧЁТ3185 {hh}:{mm} Списание {somma}р Баланс: 3 400р",
+    "Код для входа в СберБанк Онлайн: 48213. Никому не сообщайте его.",
+    "Ваш баланс на {hh}:{mm}: {somma}р",
+    "Ricordati la lezione di domani alle {hh}:{mm}",
+]
+
+PAYMENT_TEMPLATE = "СЧЁТ3185 {hh}:{mm} Перевод из Т-Банк +{somma}р от {nome} Баланс: 25 300р"
+
+
+def build_synthetic_corpus(size, payment_ratio=0.3, seed=42):
+    """
+    Genera un corpus di messaggi con una quota di pagamenti.
+
+    Returns:
+        Lista di testi
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        values = {
+            'hh': f"{rng.randint(0, 23):02d}",
+            'mm': f"{rng.randint(0, 59):02d}",
+            'somma': rng.choice(['2000', '2 200', '6 600', '10 500', '20 000', '350', '1 249']),
+            'nome': rng.choice(NOMI)
+        }
+        template = PAYMENT_TEMPLATE if rng.random() < payment_ratio else rng.choice(NON_PAYMENT_TEMPLATES)
+        corpus.append(template.format(**values))
+    return corpus
+
+
+def load_corpus(path):
+    """Carica un corpus da file di testo (un messaggio per riga)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def legacy_parse_all(items):
+    """Vecchio approccio: regex completa su ogni messaggio."""
+    results = []
+    for text, date in items:
+        match = LEGACY_SMS_PATTERN.search(text)
+        if not match:
+            results.append(None)
+            continue
+        results.append({
+            'nome_pagante': match.group(4).strip().title(),
+            'giorno': date.strftime('%Y-%m-%d'),
+            'ora': f"{match.group(1).zfill(2)}:{match.group(2)}:00",
+            'somma': float(match.group(3).strip().replace(' ', '').replace('\xa0', '')),
+            'valuta': 'RUB',
+            'stato': 'sospeso'
+        })
+    return results
+
+
+def measure(func, items, repeat=3):
+    """Restituisce (miglior tempo in secondi, risultato) su `repeat` esecuzioni."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(items)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    """Benchmark principale."""
+    parser = argparse.ArgumentParser(description="Benchmark parser SMS")
+    parser.add_argument('--size', type=int, default=100_000, help="Messaggi del corpus sintetico")
+    parser.add_argument('--corpus', help="File di testo con un messaggio per riga")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else build_synthetic_corpus(args.size)
+    message_date = datetime(2025, 9, 1, 12, 0)
+    items = [(text, message_date) for text in corpus]
+
+    print("="*60)
+    print("BENCHMARK PARSER SMS")
+    print("="*60)
+    print(f"Corpus: {args.corpus or 'sintetico'} ({len(items):,} messaggi)")
+    print("="*60 + "\n")
+
+    legacy_time, legacy_results = measure(legacy_parse_all, items)
+    new_time, new_results = measure(parse_many, items)
+
+    parsed = sum(1 for r in new_results if r)
+    legacy_parsed = sum(1 for r in legacy_results if r)
+
+    print(f"Pagamenti riconosciuti: {parsed:,} (vecchio parser: {legacy_parsed:,})")
+    print(f"Vecchio parser : {len(items) / legacy_time:>12,.0f} msg/s ({legacy_time:.3f}s)")
+    print(f"parse_many()   : {len(items) / new_time:>12,.0f} msg/s ({new_time:.3f}s)")
+    print(f"Speedup        : {legacy_time / new_time:>12.2f}x")
+
+    if parsed != legacy_parsed:
+        print("\n⚠️  Il numero di pagamenti riconosciuti è diverso dal vecchio parser!")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,8 @@ import os
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+
+from utils import gcal_client
 
 # Configurazione
 env_path = Path(__file__).parent / '.env'
@@ -20,10 +20,7 @@ SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 
 def get_calendar_service():
     """Crea servizio Google Calendar."""
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE), scopes=SCOPES
-    )
-    return build('calendar', 'v3', credentials=credentials)
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def check_today_events(service, calendar_id):
@@ -35,15 +32,14 @@ def check_today_events(service, calendar_id):
     print(f"\n📅 Verifica eventi del {oggi.strftime('%d/%m/%Y')}\n")
 
     try:
-        events_result = service.events().list(
-            calendarId=calendar_id,
+        events = list(gcal_client.iter_events(
+            service, calendar_id,
+            fields='summary,start,colorId',
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
+        ))
 
         if not events:
             print("Nessun evento oggi")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Simula le notifiche push di Google Calendar verso l'interfaccia web in locale.
+
+Usa il canale salvato nel database (o ne registra uno finto con --register) e
+invia una raffica di notifiche come quella che Google manda dopo una modifica:
+l'interfaccia web deve rispondere 204 a tutte e lanciare un solo sync.
+
+Il canale finto è salvato a parte (TEST_WATCH_SOURCE) e scade dopo un'ora: il
+canale reale resta valido e le notifiche di Google continuano ad arrivare.
+
+Uso:
+    python fake_calendar_notifier.py --register      # canale finto, senza Google
+    python fake_calendar_notifier.py --burst 5
+    python fake_calendar_notifier.py --url http://localhost:5000/api/calendar_notification
+"""
+import time
+import uuid
+import sqlite3
+import argparse
+import urllib.error
+import urllib.request
+from pathlib import Path
+from datetime import datetime, timezone
+
+from utils.calendar_watch import load_channel, save_channel, TEST_WATCH_SOURCE, TEST_CHANNEL_TTL
+
+DB_PATH = Path(__file__).parent / "pagamenti.db"
+DEFAULT_URL = 'http://localhost:5000/api/calendar_notification'
+
+
+def send_notification(url, channel, state, number):
+    """
+    Invia una notifica con gli header di Google.
+
+    Returns:
+        Codice HTTP della risposta
+    """
+    request = urllib.request.Request(url, data=b'', method='POST', headers={
+        'X-Goog-Channel-ID': channel['id'],
+        'X-Goog-Channel-Token': channel['token'],
+        'X-Goog-Resource-ID': channel['resource_id'],
+        'X-Goog-Resource-State': state,
+        'X-Goog-Message-Number': str(number),
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    """Funzione principale."""
+    parser = argparse.ArgumentParser(description="Notifiche Google Calendar finte per test locali")
+    parser.add_argument('--url', default=DEFAULT_URL, help="Endpoint dell'interfaccia web")
+    parser.add_argument('--burst', type=int, default=3, help="Notifiche nella raffica")
+    parser.add_argument('--interval', type=float, default=0.2, help="Secondi tra due notifiche")
+    parser.add_argument('--register', action='store_true', help="Salva un canale finto nel database")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DB_PATH)
+    if args.register:
+        expiration = datetime.now(timezone.utc) + TEST_CHANNEL_TTL
+        save_channel(conn, {
+            'id': f"fake-{uuid.uuid4()}",
+            'resource_id': 'fake-resource',
+            'token': uuid.uuid4().hex,
+            'expiration': expiration,
+        }, source=TEST_WATCH_SOURCE)
+        print(f"✅ Canale finto registrato fino a {expiration:%H:%M} UTC (il canale reale non viene toccato)")
+
+    # Canale finto se ancora valido, altrimenti quello reale
+    channel = load_channel(conn, TEST_WATCH_SOURCE)
+    if channel is None or channel['expiration'] <= datetime.now(timezone.utc):
+        channel = load_channel(conn)
+    conn.close()
+
+    if channel is None:
+        print("❌ Nessun canale nel database: usa --register o gcal_watch_channel.py")
+        return
+
+    # Come Google: prima 'sync' alla creazione, poi 'exists' per ogni modifica
+    statuses = [send_notification(args.url, channel, 'sync', 1)]
+    for number in range(2, args.burst + 2):
+        time.sleep(args.interval)
+        statuses.append(send_notification(args.url, channel, 'exists', number))
+
+    print(f"📨 Inviate {len(statuses)} notifiche a {args.url}: risposte {statuses}")
+
+
+if __name__ == "__main__":
+    main()
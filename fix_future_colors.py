@@ -14,10 +14,11 @@ import sqlite3
 from pathlib import Path
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client
+from utils.gcal_batch import execute_batch
+
 # Configurazione
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -32,10 +33,7 @@ COLOR_DEFAULT = '1'  # Lavanda
 
 def get_calendar_service():
     """Crea servizio Google Calendar."""
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE), scopes=SCOPES
-    )
-    return build('calendar', 'v3', credentials=credentials)
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def fix_future_events(service, calendar_id):
@@ -56,16 +54,14 @@ def fix_future_events(service, calendar_id):
 
     try:
         # Recupera tutti gli eventi futuri
-        events_result = service.events().list(
-            calendarId=calendar_id,
+        events = list(gcal_client.iter_events(
+            service, calendar_id,
+            fields='id,summary,start,colorId',
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
-            orderBy='startTime',
-            maxResults=2500
-        ).execute()
-
-        events = events_result.get('items', [])
+            orderBy='startTime'
+        ))
         print(f"✅ Trovati {len(events)} eventi futuri\n")
 
         if not events:
@@ -80,40 +76,45 @@ def fix_future_events(service, calendar_id):
 
         print("🔧 Rimozione colori blu da eventi futuri...\n")
 
+        # Imposta colore default (lavanda): patch del solo colore (l'evento è stato
+        # letto con una field mask parziale), in batch da 50 per richiesta HTTP
+        blue_events = {}
         for event in events:
-            event_id = event['id']
-            summary = event.get('summary', 'Senza titolo')
-            current_color = event.get('colorId', None)
-
-            # Se ha colore blu, rimuovilo
-            if current_color == COLOR_BLUE:
-                try:
-                    # Imposta colore default (lavanda)
-                    event['colorId'] = COLOR_DEFAULT
-
-                    service.events().update(
-                        calendarId=calendar_id,
-                        eventId=event_id,
-                        body=event
-                    ).execute()
-
-                    stats['fixed'] += 1
-
-                    # Estrai data evento
-                    start = event['start'].get('dateTime', event['start'].get('date'))
-                    if 'T' in start:
-                        event_date = datetime.fromisoformat(start.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M')
-                    else:
-                        event_date = start
-
-                    print(f"  ✅ Rimosso colore BLU: {summary} ({event_date})")
-
-                except HttpError as e:
-                    stats['errors'] += 1
-                    print(f"  ❌ Errore su {summary}: {e}")
+            if event.get('colorId', None) == COLOR_BLUE:
+                blue_events[event['id']] = event
             else:
                 stats['unchanged'] += 1
 
+        responses = execute_batch(service, [
+            (event_id, service.events().patch(
+                calendarId=calendar_id,
+                eventId=event_id,
+                body={'colorId': COLOR_DEFAULT},
+                fields='id'
+            ))
+            for event_id in blue_events
+        ])
+
+        for event_id, (_, error) in responses.items():
+            event = blue_events[event_id]
+            summary = event.get('summary', 'Senza titolo')
+
+            if error is not None:
+                stats['errors'] += 1
+                print(f"  ❌ Errore su {summary}: {error}")
+                continue
+
+            stats['fixed'] += 1
+
+            # Estrai data evento
+            start = event['start'].get('dateTime', event['start'].get('date'))
+            if 'T' in start:
+                event_date = datetime.fromisoformat(start.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M')
+            else:
+                event_date = start
+
+            print(f"  ✅ Rimosso colore BLU: {summary} ({event_date})")
+
         return stats
 
     except HttpError as error:
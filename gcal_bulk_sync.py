@@ -9,16 +9,35 @@ Differenze rispetto alla funzione sync_lessons_from_calendar():
 - Statistiche dettagliate per studente
 - Report completo del sincronizzamento
 - Supporto lezioni gratis (eventi "prova")
+
+Il range viene diviso in mesi, scaricati in parallelo (al massimo SHARD_WORKERS
+alla volta) entro un budget globale di CALENDAR_QPS richieste/secondo; gli eventi
+di tutti i mesi vengono poi applicati al database in un'unica transazione.
+
+Con --ricorrenze-locali scarica solo gli eventi master delle lezioni ricorrenti
+(più le eccezioni) ed espande le occorrenze in locale (utils/recurrence.py),
+invece di ricevere da Google ogni occorrenza come evento separato.
+
+Uso:
+    python gcal_bulk_sync.py
+    python gcal_bulk_sync.py --ricorrenze-locali
 """
 import os
 import sqlite3
+import time
+import argparse
 from pathlib import Path
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client
+from utils.lesson_sync import apply_events, mark_lessons_fresh
+from utils.calendar_mirror import MIRROR_EVENT_FIELDS, ensure_calendar_events_table, mirror_events
+from utils.recurrence import RECURRENCE_EVENT_FIELDS, expand_events
+from utils.rate_limiter import QpsLimiter
+
 # Carica variabili d'ambiente
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -33,6 +52,11 @@ SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 START_DATE = datetime(2025, 8, 1)  # 1 agosto 2025
 END_DATE = datetime.now()  # Oggi (fine giornata)
 
+# Download parallelo per mese: thread contemporanei e budget richieste/secondo
+# condiviso (quota Calendar API per utente: ~600 richieste/minuto)
+SHARD_WORKERS = 6
+CALENDAR_QPS = 5
+
 
 def get_calendar_service():
     """
@@ -41,15 +65,155 @@ def get_calendar_service():
     Returns:
         Google Calendar API service object
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
-    return service
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
-def sync_all_lessons(service, calendar_id, start_date, end_date, db_path):
+def fetch_events(service, calendar_id, time_min, time_max, local_recurrence=False, limiter=None):
+    """
+    Scarica tutti gli eventi del range, con le occorrenze dei ricorrenti espanse.
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        time_min, time_max: Range (RFC 3339)
+        local_recurrence: True = scarica master ed eccezioni ed espande in locale
+        limiter: QpsLimiter condiviso (None = nessun limite)
+
+    Returns:
+        Tupla (lista eventi, eventi scaricati dall'API)
+    """
+    if not local_recurrence:
+        events = list(gcal_client.iter_events(
+            service, calendar_id,
+            fields=MIRROR_EVENT_FIELDS,
+            limiter=limiter,
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=True,  # Espande eventi ricorrenti
+            orderBy='startTime'
+        ))
+        return events, len(events)
+
+    # orderBy='startTime' è ammesso solo con singleEvents=True
+    downloaded = []
+    calendar_timezone = None
+    for page in gcal_client.iter_event_pages(
+        service, calendar_id,
+        fields=RECURRENCE_EVENT_FIELDS,
+        limiter=limiter,
+        timeMin=time_min,
+        timeMax=time_max,
+        singleEvents=False
+    ):
+        downloaded.extend(page.get('items', []))
+        # Fuso del calendario: per i master senza start.timeZone
+        calendar_timezone = page.get('timeZone') or calendar_timezone
+
+    return expand_events(downloaded, time_min, time_max, calendar_timezone), len(downloaded)
+
+
+def month_shards(start_date, end_date):
+    """
+    Divide il range in mesi (il primo e l'ultimo possono essere parziali).
+
+    Args:
+        start_date: Data inizio (datetime)
+        end_date: Data fine (datetime, inclusa fino a fine giornata)
+
+    Returns:
+        Lista di tuple (etichetta 'YYYY-MM', timeMin, timeMax) RFC 3339
+    """
+    shards = []
+    shard_start = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = end_date.replace(hour=23, minute=59, second=59, microsecond=0)
+
+    while shard_start <= end:
+        if shard_start.month == 12:
+            next_month = shard_start.replace(year=shard_start.year + 1, month=1, day=1)
+        else:
+            next_month = shard_start.replace(month=shard_start.month + 1, day=1)
+
+        # timeMax è esclusivo: il mese finisce dove inizia il successivo
+        shard_end = min(next_month, end)
+        shards.append((
+            shard_start.strftime('%Y-%m'),
+            shard_start.isoformat() + 'Z',
+            shard_end.isoformat() + 'Z'
+        ))
+        shard_start = next_month
+
+    return shards
+
+
+def fetch_shard(calendar_id, shard, local_recurrence, limiter):
+    """
+    Scarica gli eventi di un mese (eseguita nei thread del pool).
+
+    Returns:
+        Tupla (etichetta, lista eventi, eventi scaricati, secondi)
+    """
+    label, time_min, time_max = shard
+    started = time.monotonic()
+
+    # Client per thread (httplib2 non è thread-safe), vedi utils/gcal_client.py
+    service = get_calendar_service()
+    events, downloaded = fetch_events(service, calendar_id, time_min, time_max, local_recurrence, limiter)
+    return label, events, downloaded, time.monotonic() - started
+
+
+def fetch_all_shards(service, calendar_id, start_date, end_date, local_recurrence=False):
+    """
+    Scarica tutti gli eventi del range, un mese per thread.
+
+    Gli eventi a cavallo tra due mesi arrivano in entrambi: vengono uniti per id.
+    Con --ricorrenze-locali un'eccezione spostata in un altro mese arriva da quel
+    mese, mentre il mese originale genera l'occorrenza dal master: vince l'evento
+    letto dall'API (con etag).
+
+    Args:
+        service: Google Calendar API service object (usato se il range è di un solo mese)
+        calendar_id: ID del calendario Google
+        start_date, end_date: Range (datetime)
+        local_recurrence: True = espande in locale gli eventi ricorrenti
+
+    Returns:
+        Tupla (lista eventi, eventi scaricati dall'API)
+    """
+    shards = month_shards(start_date, end_date)
+    limiter = QpsLimiter(CALENDAR_QPS)
+
+    if len(shards) == 1:
+        _, time_min, time_max = shards[0]
+        return fetch_events(service, calendar_id, time_min, time_max, local_recurrence, limiter)
+
+    workers = min(SHARD_WORKERS, len(shards))
+    print(f"   {len(shards)} mesi, {workers} download paralleli (max {CALENDAR_QPS} richieste/s)")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(fetch_shard, calendar_id, shard, local_recurrence, limiter)
+            for shard in shards
+        ]
+        for future in as_completed(futures):
+            label, events, downloaded, elapsed = future.result()
+            results[label] = (events, downloaded)
+            print(f"   ✅ {label}: {len(events):>5} eventi ({elapsed:.1f}s) "
+                  f"[{len(results)}/{len(shards)}]")
+
+    merged = {}
+    downloaded_total = 0
+    for label, _, _ in shards:
+        events, downloaded = results[label]
+        downloaded_total += downloaded
+        for event in events:
+            if 'etag' in event or event['id'] not in merged:
+                merged[event['id']] = event
+
+    return list(merged.values()), downloaded_total
+
+
+def sync_all_lessons(service, calendar_id, start_date, end_date, db_path, local_recurrence=False):
     """
     Sincronizza TUTTE le lezioni dal calendario nel database.
 
@@ -59,6 +223,7 @@ def sync_all_lessons(service, calendar_id, start_date, end_date, db_path):
         start_date: Data inizio (datetime)
         end_date: Data fine (datetime)
         db_path: Path del database SQLite
+        local_recurrence: True = espande in locale gli eventi ricorrenti
 
     Returns:
         Dizionario con statistiche di sincronizzazione
@@ -67,115 +232,50 @@ def sync_all_lessons(service, calendar_id, start_date, end_date, db_path):
     print(f"   Range: {start_date.strftime('%Y-%m-%d')} → {end_date.strftime('%Y-%m-%d')}")
     print(f"   Calendario: {calendar_id[:40]}...\n")
 
-    # Imposta range di tempo
-    # IMPORTANTE: finiamo a fine giornata di oggi
-    time_min = start_date.replace(hour=0, minute=0, second=0).isoformat() + 'Z'
-    time_max = end_date.replace(hour=23, minute=59, second=59).isoformat() + 'Z'
+    # Ora locale PRIMA di leggere il calendario: le lezioni sono aggiornate a questo momento
+    fetch_started = datetime.now()
 
     try:
-        # Recupera TUTTI gli eventi (nessun limite maxResults)
+        # Recupera TUTTI gli eventi, fino a fine giornata di end_date (un mese per thread)
         print("🔍 Recupero eventi dal calendario...")
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=time_min,
-            timeMax=time_max,
-            singleEvents=True,  # Espande eventi ricorrenti
-            orderBy='startTime'
-        ).execute()
-
-        events = events_result.get('items', [])
-        print(f"✅ Trovati {len(events)} eventi totali\n")
-
+        events, downloaded = fetch_all_shards(service, calendar_id, start_date, end_date, local_recurrence)
+        if local_recurrence:
+            print(f"✅ Scaricati {downloaded} eventi (master ed eccezioni), "
+                  f"espansi in {len(events)} eventi totali\n")
+        else:
+            print(f"✅ Trovati {len(events)} eventi totali\n")
+
+        # Anche senza eventi si prosegue: la riconciliazione cancella le lezioni del range
         if not events:
             print("⚠️  Nessun evento trovato nel range specificato.")
-            return {
-                'total_events': 0,
-                'synced': 0,
-                'skipped_prova': 0,
-                'errors': 0,
-                'students': {}
-            }
 
         # Connessione database
         conn = sqlite3.connect(db_path)
+        ensure_calendar_events_table(conn)
         cursor = conn.cursor()
 
-        # Statistiche
-        synced = 0
-        skipped_prova = 0
-        errors = 0
-        students_stats = {}  # Dict: nome_studente → count lezioni
-
         print("📝 Processamento eventi...\n")
 
-        for i, event in enumerate(events, 1):
-            # Progresso ogni 50 eventi
-            if i % 50 == 0:
-                print(f"   Processati {i}/{len(events)} eventi...")
-
-            event_id = event['id']
-            summary = event.get('summary', '').strip()
-            start = event['start'].get('dateTime', event['start'].get('date'))
-
-            # Salta eventi senza titolo
-            if not summary:
-                errors += 1
-                continue
-
-            # Identifica eventi "prova" (lezioni gratis)
-            is_prova = summary.lower().startswith('prova')
-
-            if is_prova:
-                skipped_prova += 1
-                # print(f"🎁 Lezione gratis (prova): {summary} - {start}")
-                continue
-
-            # Parse date e time
-            if 'T' in start:
-                # Evento con orario
-                dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                giorno = dt.strftime('%Y-%m-%d')
-                ora = dt.strftime('%H:%M:%S')
-            else:
-                # Evento all-day
-                giorno = start
-                ora = '00:00:00'
-
-            # FILTRO: SOLO dal 1 agosto 2025 a oggi (NO futuro, NO prima agosto)
-            oggi = datetime.now().date().isoformat()
-            if giorno > oggi or giorno < '2025-08-01':
-                continue
-
-            # Normalizza nome studente
-            # Rimuovi varianti tipo "dmitry1" → "dmitry"
-            nome_studente = summary.replace('dmitry1', 'dmitry').strip()
-
-            # Statistiche per studente
-            if nome_studente not in students_stats:
-                students_stats[nome_studente] = 0
-            students_stats[nome_studente] += 1
-
-            # Insert or update nel database
-            # Il costo di default (2000 RUB) viene impostato dalla tabella
-            try:
-                cursor.execute('''
-                    INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
-                    VALUES (?, ?, ?, ?, 'prevista')
-                    ON CONFLICT(nextcloud_event_id) DO UPDATE SET
-                        nome_studente = excluded.nome_studente,
-                        giorno = excluded.giorno,
-                        ora = excluded.ora
-                ''', (event_id, nome_studente, giorno, ora))
-
-                synced += 1
-                print(f"✅ Sincronizzato: {nome_studente} - {giorno} {ora}")
-
-            except sqlite3.IntegrityError as e:
-                errors += 1
-                print(f"❌ Errore inserimento {event_id}: {e}")
-
-        # Commit modifiche
+        # FILTRO: SOLO dal 1 agosto 2025 a oggi (NO futuro, NO prima agosto).
+        # events sono tutti gli eventi del range: le lezioni senza evento vengono
+        # cancellate (quelle già pagate segnalate in lezioni_da_verificare)
+        min_day = max(start_date.strftime('%Y-%m-%d'), '2025-08-01')
+        max_day = min(end_date.strftime('%Y-%m-%d'), datetime.now().date().isoformat())
+        stats = apply_events(
+            cursor, events,
+            min_day=min_day,
+            max_day=max_day,
+            reconcile_days=(min_day, max_day)
+        )
+
+        # Copia locale degli eventi (etag, titolo, colore) per gli script di scrittura;
+        # le occorrenze espanse in locale non hanno etag e non vengono salvate
+        mirror_events(cursor, events)
+
+        # Commit modifiche (un'unica transazione)
         conn.commit()
+        if max_day == fetch_started.date().isoformat():
+            mark_lessons_fresh(conn, fetch_started)
 
         # Verifica totale nel database
         cursor.execute("SELECT COUNT(*) FROM lezioni WHERE stato='prevista'")
@@ -186,10 +286,13 @@ def sync_all_lessons(service, calendar_id, start_date, end_date, db_path):
         # Return statistiche
         return {
             'total_events': len(events),
-            'synced': synced,
-            'skipped_prova': skipped_prova,
-            'errors': errors,
-            'students': students_stats,
+            'synced': stats['synced'],
+            'changed': stats['changed'],
+            'deleted': stats['deleted'],
+            'flagged': stats['flagged'],
+            'skipped_prova': stats['skipped_prova'],
+            'errors': stats['errors'],
+            'students': dict(stats['students']),
             'total_in_db': total_in_db
         }
 
@@ -215,7 +318,10 @@ def print_statistics(stats):
     print("RIEPILOGO SINCRONIZZAZIONE LEZIONI")
     print("="*60)
     print(f"Eventi trovati: {stats['total_events']}")
-    print(f"Lezioni sincronizzate: {stats['synced']}")
+    print(f"Lezioni sincronizzate: {stats['synced']} ({stats.get('changed', 0)} nuove o modificate)")
+    print(f"Lezioni cancellate (evento non più nel calendario): {stats.get('deleted', 0)}")
+    if stats.get('flagged'):
+        print(f"⚠️  Lezioni pagate senza evento (in lezioni_da_verificare): {stats['flagged']}")
     print(f"Lezioni gratis (prova): {stats['skipped_prova']}")
     print(f"Errori: {stats['errors']}")
     print("-"*60)
@@ -247,6 +353,11 @@ def print_statistics(stats):
 
 def main():
     """Funzione principale."""
+    parser = argparse.ArgumentParser(description="Sincronizzazione completa lezioni da Google Calendar")
+    parser.add_argument('--ricorrenze-locali', action='store_true',
+                        help="Scarica solo master ed eccezioni degli eventi ricorrenti e li espande in locale")
+    args = parser.parse_args()
+
     print("="*60)
     print("SINCRONIZZAZIONE COMPLETA LEZIONI DA GOOGLE CALENDAR")
     print("="*60)
@@ -293,7 +404,10 @@ def main():
         return
 
     # Sincronizza lezioni
-    stats = sync_all_lessons(service, CALENDAR_ID, START_DATE, END_DATE, DB_PATH)
+    stats = sync_all_lessons(
+        service, CALENDAR_ID, START_DATE, END_DATE, DB_PATH,
+        local_recurrence=args.ricorrenze_locali
+    )
 
     # Stampa statistiche
     print_statistics(stats)
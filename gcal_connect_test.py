@@ -7,10 +7,10 @@ import os
 from pathlib import Path
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client
+
 # Carica variabili d'ambiente
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -28,13 +28,7 @@ def get_calendar_service():
     Returns:
         Google Calendar API service object
     """
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-
-    service = build('calendar', 'v3', credentials=credentials)
-    return service
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def list_calendars(service):
@@ -2,24 +2,29 @@
 """
 Sincronizzazione INCREMENTALE delle lezioni da Google Calendar.
 
-Scarica SOLO le lezioni nuove/modificate dall'ultimo sync, usando il timestamp
-salvato nel database. Più efficiente di gcal_bulk_sync.py.
+Scarica SOLO gli eventi creati/modificati/cancellati dall'ultimo sync, usando
+il sync token di Google Calendar. Più efficiente di gcal_bulk_sync.py.
 
 Features:
-- Legge timestamp ultimo sync dal DB (tabella sync_status)
-- Usa updatedMin parameter di Google Calendar API per scaricare solo modifiche
+- Prima esecuzione: sync completo dal 1 agosto 2025, salva nextSyncToken in sync_status
+- Esecuzioni successive: events().list(syncToken=...) restituisce solo le modifiche
+  (un'unica richiesta piccola, qualunque sia la dimensione del calendario)
+- Token scaduto (HTTP 410): un solo sync completo, poi di nuovo delta
 - Cancella lezioni rimosse dal calendario (eventi cancellati)
-- Salva nuovo timestamp nel DB dopo sync
+- Le lezioni future non entrano nel DB: al primo sync di ogni giorno una richiesta
+  sulla finestra dall'ultimo sync a oggi importa quelle diventate passate
 """
 import os
 import sqlite3
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client, sync_status
+from utils.lesson_sync import apply_events, mark_lessons_fresh
+from utils.calendar_mirror import MIRROR_EVENT_FIELDS, ensure_calendar_events_table, mirror_events
+
 # Carica variabili d'ambiente
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -30,35 +35,51 @@ CALENDAR_ID = os.getenv('GCAL_CALENDAR_ID')
 DB_PATH = Path(__file__).parent / "pagamenti.db"
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 
+# Inizio dello storico lezioni (prima esecuzione / sync completo)
+SYNC_START_DATE = datetime(2025, 8, 1).date()
+
+# Fonte in sync_status per il nextSyncToken
+SYNC_TOKEN_SOURCE = 'google_calendar_sync_token'
+
 
 def get_calendar_service():
     """Crea servizio Google Calendar API."""
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
-    return service
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def ensure_sync_status_table(db_path):
     """
     Crea tabella sync_status se non esiste.
 
-    Tabella per salvare timestamp ultimo sync di ogni fonte.
+    Tabella per salvare timestamp ultimo sync (e cursore/sync token) di ogni fonte.
     """
     conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    sync_status.ensure_sync_status_table(conn)
+    conn.close()
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sync_status (
-            source TEXT PRIMARY KEY,
-            last_sync_at TEXT NOT NULL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
 
+def get_sync_token(db_path):
+    """
+    Recupera il nextSyncToken salvato dall'ultimo sync.
+
+    Returns:
+        Token (stringa) o None se mai salvato
+    """
+    conn = sqlite3.connect(db_path)
+    token = sync_status.get_cursor(conn, SYNC_TOKEN_SOURCE)
+    conn.close()
+    return token
+
+
+def save_sync_token(db_path, token):
+    """
+    Salva il nextSyncToken (None = cancella, il prossimo sync sarà completo).
+    """
+    conn = sqlite3.connect(db_path)
+    if token is None:
+        conn.execute('DELETE FROM sync_status WHERE source = ?', (SYNC_TOKEN_SOURCE,))
+    else:
+        sync_status.save_cursor(conn, SYNC_TOKEN_SOURCE, token)
     conn.commit()
     conn.close()
 
@@ -116,9 +137,77 @@ def save_sync_timestamp(db_path, timestamp, source='google_calendar'):
     conn.close()
 
 
+def list_events(service, calendar_id, **params):
+    """
+    Esegue events().list con paginazione (solo i campi usati da lezioni e copia locale).
+
+    Returns:
+        Tupla (lista eventi, nextSyncToken o None)
+    """
+    all_events = []
+    next_sync_token = None
+
+    for page in gcal_client.iter_event_pages(
+            service, calendar_id, fields=MIRROR_EVENT_FIELDS, **params):
+        all_events.extend(page.get('items', []))
+        # Il nextSyncToken arriva solo con l'ultima pagina
+        next_sync_token = page.get('nextSyncToken', next_sync_token)
+
+    return all_events, next_sync_token
+
+
+def fetch_event_changes(service, calendar_id, sync_token):
+    """
+    Scarica le modifiche al calendario.
+
+    Con sync_token restituisce solo gli eventi creati/modificati/cancellati
+    dopo il sync che lo ha generato; senza, tutti gli eventi da SYNC_START_DATE.
+    I parametri (singleEvents, showDeleted) devono restare uguali tra sync completo
+    e delta; timeMin/orderBy non sono ammessi insieme al syncToken.
+
+    Raises:
+        HttpError: status 410 se il token è scaduto
+
+    Returns:
+        Tupla (lista eventi, nuovo nextSyncToken)
+    """
+    params = {
+        'singleEvents': True,
+        'showDeleted': True,     # Includi eventi cancellati
+    }
+
+    if sync_token:
+        params['syncToken'] = sync_token
+    else:
+        params['timeMin'] = SYNC_START_DATE.isoformat() + 'T00:00:00Z'
+
+    return list_events(service, calendar_id, **params)
+
+
+def fetch_events_now_past(service, calendar_id, last_sync):
+    """
+    Eventi tra il giorno dell'ultimo sync e oggi: erano futuri (quindi non
+    importati) e ora non lo sono più. Una richiesta al primo sync di ogni giorno.
+
+    Returns:
+        Lista eventi (vuota se l'ultimo sync è di oggi)
+    """
+    oggi = datetime.now().date()
+    if last_sync is None or last_sync.date() >= oggi:
+        return []
+
+    events, _ = list_events(
+        service, calendar_id,
+        singleEvents=True,
+        timeMin=last_sync.date().isoformat() + 'T00:00:00Z',
+        timeMax=oggi.isoformat() + 'T23:59:59Z'
+    )
+    return events
+
+
 def sync_incremental_lessons(service, calendar_id, last_sync, db_path):
     """
-    Sincronizza SOLO lezioni modificate/create dall'ultimo sync.
+    Sincronizza SOLO lezioni create/modificate/cancellate dall'ultimo sync (sync token).
 
     Args:
         service: Google Calendar API service object
@@ -131,176 +220,91 @@ def sync_incremental_lessons(service, calendar_id, last_sync, db_path):
     """
     print(f"📥 Sincronizzazione incrementale lezioni da Google Calendar")
 
-    # Calcola range date: dal giorno ultimo sync a oggi
-    oggi = datetime.now().date()
-
-    if last_sync:
-        # Prendi SOLO il giorno dell'ultimo sync (ignora ora)
-        start_date = last_sync.date()
-        # Range: dal giorno ultimo sync fino a oggi
-        time_min = start_date.isoformat() + 'T00:00:00Z'
-        time_max = oggi.isoformat() + 'T23:59:59Z'
-        print(f"   Modalità: INCREMENTALE")
-        print(f"   Range: {start_date} → {oggi} (dal giorno ultimo sync a oggi)")
+    sync_token = get_sync_token(db_path)
+    if sync_token:
+        print(f"   Modalità: DELTA (sync token)")
     else:
-        # Prima esecuzione: scarica tutto (da agosto 2025)
-        start_date = datetime(2025, 8, 1).date()
-        time_min = start_date.isoformat() + 'T00:00:00Z'
-        time_max = oggi.isoformat() + 'T23:59:59Z'
-        print(f"   Modalità: PRIMA ESECUZIONE")
-        print(f"   Range: {start_date} → {oggi} (da agosto 2025 a oggi)")
-
-    # Parametri query
-    params = {
-        'calendarId': calendar_id,
-        'singleEvents': True,
-        'orderBy': 'startTime',  # Ordina per data evento
-        'showDeleted': True,     # Includi eventi cancellati
-        'timeMin': time_min,     # Dal giorno ultimo sync
-        'timeMax': time_max,     # Fino a oggi
-    }
+        print(f"   Modalità: SYNC COMPLETO")
+        print(f"   Range: {SYNC_START_DATE} → oggi")
 
     print()
 
+    # Ora locale PRIMA di leggere il calendario: le lezioni sono aggiornate a questo momento
+    fetch_started = datetime.now()
+
     try:
-        # Recupera eventi (con paginazione)
+        # Recupera le modifiche (con paginazione)
         print("🔍 Recupero eventi modificati dal calendario...")
 
-        all_events = []
-        page_token = None
-
-        while True:
-            if page_token:
-                params['pageToken'] = page_token
-
-            events_result = service.events().list(**params).execute()
-            events = events_result.get('items', [])
-            all_events.extend(events)
-
-            page_token = events_result.get('nextPageToken')
-            if not page_token:
-                break
+        try:
+            all_events, next_sync_token = fetch_event_changes(service, calendar_id, sync_token)
+        except HttpError as error:
+            if error.resp.status != 410 or not sync_token:
+                raise
+            # Token scaduto/invalidato da Google: un solo sync completo
+            print("⚠️  Sync token scaduto (410): sync completo")
+            sync_token = None
+            save_sync_token(db_path, None)
+            all_events, next_sync_token = fetch_event_changes(service, calendar_id, None)
+
+        oggi = datetime.now().date()
+
+        # Sync completo: tutti gli eventi da SYNC_START_DATE, le lezioni senza evento
+        # vanno cancellate (quelle già pagate segnalate in lezioni_da_verificare)
+        reconcile_days = None
+        if not sync_token:
+            reconcile_days = (SYNC_START_DATE.isoformat(), oggi.isoformat())
+
+        # Eventi passati da futuri a passati dall'ultimo sync (solo in modalità delta).
+        # La finestra contiene tutti gli eventi dei giorni successivi all'ultimo sync:
+        # quei giorni si riconciliano (il giorno dell'ultimo sync era già importato)
+        elif last_sync is not None and last_sync.date() < oggi:
+            all_events.extend(fetch_events_now_past(service, calendar_id, last_sync))
+            first_day = last_sync.date() + timedelta(days=1)
+            reconcile_days = (first_day.isoformat(), oggi.isoformat())
 
         print(f"✅ Trovati {len(all_events)} eventi\n")
 
         # Connessione database (necessaria anche se nessun evento)
         conn = sqlite3.connect(db_path)
+        ensure_calendar_events_table(conn)
         cursor = conn.cursor()
 
-        # Conta totale lezioni nel DB
-        cursor.execute("SELECT COUNT(*) FROM lezioni")
-        total_in_db = cursor.fetchone()[0]
-
         if not all_events:
             print("✅ Nessuna modifica da sincronizzare!")
-            conn.close()
-            return {
-                'total_events': 0,
-                'synced': 0,
-                'deleted': 0,
-                'skipped_prova': 0,
-                'errors': 0,
-                'total_in_db': total_in_db
-            }
-
-        # Statistiche
-        synced = 0
-        deleted = 0
-        skipped_prova = 0
-        errors = 0
-
-        print("📝 Processamento eventi modificati...\n")
-
-        for i, event in enumerate(all_events, 1):
-            event_id = event['id']
-            status = event.get('status', 'confirmed')
-            summary = event.get('summary', '').strip()
-
-            # Progresso ogni 50 eventi
-            if i % 50 == 0:
-                print(f"   Processati {i}/{len(all_events)} eventi...")
-
-            # Eventi cancellati: rimuovi dal database
-            if status == 'cancelled':
-                try:
-                    cursor.execute('''
-                        DELETE FROM lezioni WHERE nextcloud_event_id = ?
-                    ''', (event_id,))
-
-                    if cursor.rowcount > 0:
-                        deleted += 1
-                        print(f"🗑️  Rimosso evento cancellato: {summary or event_id}")
-                except Exception as e:
-                    errors += 1
-                    print(f"❌ Errore cancellazione {event_id}: {e}")
-
-                continue
-
-            # Salta eventi senza titolo
-            if not summary:
-                errors += 1
-                continue
-
-            # Identifica eventi "prova" (lezioni gratis)
-            is_prova = any(keyword in summary.lower() for keyword in ['prova', 'пробный', 'trial'])
-
-            if is_prova:
-                skipped_prova += 1
-                continue
-
-            # Parse start time
-            start = event['start'].get('dateTime', event['start'].get('date'))
-
-            if 'T' in start:
-                # Evento con orario
-                dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-                giorno = dt.strftime('%Y-%m-%d')
-                ora = dt.strftime('%H:%M:%S')
-            else:
-                # Evento all-day
-                giorno = start
-                ora = '00:00:00'
-
-            # Normalizza nome studente
-            nome_studente = summary.strip()
-
-            # Insert or update nel database
-            try:
-                cursor.execute('''
-                    INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
-                    VALUES (?, ?, ?, ?, 'prevista')
-                    ON CONFLICT(nextcloud_event_id) DO UPDATE SET
-                        nome_studente = excluded.nome_studente,
-                        giorno = excluded.giorno,
-                        ora = excluded.ora,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', (event_id, nome_studente, giorno, ora))
-
-                synced += 1
-                print(f"✅ Sincronizzato: {nome_studente} - {giorno} {ora}")
-
-            except sqlite3.IntegrityError as e:
-                errors += 1
-                print(f"❌ Errore inserimento {event_id}: {e}")
+        else:
+            print("📝 Processamento eventi modificati...\n")
+
+        # Solo dal 1 agosto 2025 a oggi (NO futuro): le future arrivano con fetch_events_now_past.
+        # Un evento spostato da oggi/passato al futuro toglie la lezione alla vecchia data
+        stats = apply_events(
+            cursor, all_events,
+            min_day=SYNC_START_DATE.isoformat(),
+            max_day=oggi.isoformat(),
+            reconcile_days=reconcile_days
+        )
+        stats['mode'] = 'delta' if sync_token else 'full'
+        stats['total_events'] = len(all_events)
+
+        # Copia locale degli eventi (etag, titolo, colore) per gli script di scrittura
+        mirror_events(cursor, all_events)
 
         # Commit modifiche
         conn.commit()
 
+        # Token salvato solo dopo il commit: se qualcosa fallisce prima, il prossimo
+        # sync riparte dallo stesso token e rivede le stesse modifiche
+        if next_sync_token:
+            save_sync_token(db_path, next_sync_token)
+        mark_lessons_fresh(conn, fetch_started)
+
         # Verifica totale nel database DOPO le modifiche
         cursor.execute("SELECT COUNT(*) FROM lezioni")
-        total_in_db_after = cursor.fetchone()[0]
+        stats['total_in_db'] = cursor.fetchone()[0]
 
         conn.close()
 
-        # Return statistiche
-        return {
-            'total_events': len(all_events),
-            'synced': synced,
-            'deleted': deleted,
-            'skipped_prova': skipped_prova,
-            'errors': errors,
-            'total_in_db': total_in_db_after
-        }
+        return stats
 
     except HttpError as error:
         print(f"❌ Errore API Google Calendar: {error}")
@@ -320,10 +324,14 @@ def print_statistics(stats):
     print("\n" + "="*60)
     print("RIEPILOGO SINCRONIZZAZIONE INCREMENTALE")
     print("="*60)
+    print(f"Modalità: {'delta (sync token)' if stats['mode'] == 'delta' else 'sync completo'}")
     print(f"Eventi modificati: {stats['total_events']}")
-    print(f"Lezioni sincronizzate: {stats['synced']}")
+    print(f"Lezioni sincronizzate: {stats['synced']} ({stats['changed']} nuove o modificate)")
     print(f"Lezioni cancellate: {stats['deleted']}")
+    if stats['flagged']:
+        print(f"⚠️  Lezioni pagate senza evento (in lezioni_da_verificare): {stats['flagged']}")
     print(f"Eventi prova (ignorati): {stats['skipped_prova']}")
+    print(f"Eventi fuori range (futuri o prima di agosto): {stats['skipped_range']}")
     print(f"Errori: {stats['errors']}")
     print("-"*60)
     print(f"TOTALE nel database: {stats['total_in_db']} lezioni")
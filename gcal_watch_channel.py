@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Gestione del watch channel di Google Calendar (notifiche push all'interfaccia web).
+
+Senza argomenti apre il canale se manca e lo rinnova se scade entro un giorno:
+va lanciato da cron (es. ogni 6 ore). Il nuovo canale viene aperto prima di
+chiudere il vecchio, così non si perdono notifiche.
+
+Richiede nel file .env:
+    GCAL_WEBHOOK_URL=https://.../api/calendar_notification   (HTTPS pubblico)
+    GCAL_WEBHOOK_TOKEN=...                                    (segreto a piacere)
+
+Uso:
+    python gcal_watch_channel.py            # apri/rinnova se necessario
+    python gcal_watch_channel.py --force    # rinnova comunque
+    python gcal_watch_channel.py --status   # mostra il canale attivo
+    python gcal_watch_channel.py --stop     # chiudi il canale
+"""
+import os
+import sqlite3
+import argparse
+
+from googleapiclient.errors import HttpError
+
+from gcal_incremental_sync import get_calendar_service, CALENDAR_ID, DB_PATH
+from utils.calendar_watch import (
+    load_channel, save_channel, needs_renewal, create_channel, stop_channel
+)
+
+WEBHOOK_URL = os.getenv('GCAL_WEBHOOK_URL')
+WEBHOOK_TOKEN = os.getenv('GCAL_WEBHOOK_TOKEN')
+
+
+def renew_channel(service, conn, force=False):
+    """
+    Apre un nuovo canale se necessario e chiude quello vecchio.
+
+    Args:
+        service: Google Calendar API service object
+        conn: Connessione SQLite attiva
+        force: Se True rinnova anche se il canale non è in scadenza
+
+    Returns:
+        Canale attivo (dict)
+    """
+    old = load_channel(conn)
+    if not force and not needs_renewal(old):
+        print(f"✅ Canale attivo fino a {old['expiration']:%Y-%m-%d %H:%M} UTC, nessun rinnovo")
+        return old
+
+    channel = create_channel(service, CALENDAR_ID, WEBHOOK_URL, WEBHOOK_TOKEN)
+    save_channel(conn, channel)
+    print(f"✅ Nuovo canale {channel['id']} attivo fino a {channel['expiration']:%Y-%m-%d %H:%M} UTC")
+
+    if old is not None:
+        try:
+            stop_channel(service, old)
+            print(f"🗑️  Chiuso canale precedente {old['id']}")
+        except HttpError as e:
+            # Già scaduto o chiuso: nessun problema
+            print(f"⚠️  Canale precedente non chiuso: {e}")
+
+    return channel
+
+
+def main():
+    """Funzione principale."""
+    parser = argparse.ArgumentParser(description="Gestione watch channel Google Calendar")
+    parser.add_argument('--force', action='store_true', help="Rinnova anche se non in scadenza")
+    parser.add_argument('--status', action='store_true', help="Mostra il canale attivo")
+    parser.add_argument('--stop', action='store_true', help="Chiudi il canale attivo")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DB_PATH)
+
+    try:
+        channel = load_channel(conn)
+
+        if args.status:
+            if channel is None:
+                print("📭 Nessun canale attivo")
+            else:
+                print(f"📡 Canale {channel['id']} (risorsa {channel['resource_id']})")
+                print(f"   Scadenza: {channel['expiration']:%Y-%m-%d %H:%M} UTC")
+            return
+
+        if not WEBHOOK_URL or not WEBHOOK_TOKEN:
+            print("❌ GCAL_WEBHOOK_URL e GCAL_WEBHOOK_TOKEN devono essere nel file .env")
+            return
+
+        service = get_calendar_service()
+
+        if args.stop:
+            if channel is not None:
+                stop_channel(service, channel)
+                save_channel(conn, None)
+                print(f"🗑️  Canale {channel['id']} chiuso")
+            else:
+                print("📭 Nessun canale attivo")
+            return
+
+        renew_channel(service, conn, force=args.force)
+
+    except HttpError as error:
+        print(f"❌ Errore API Google Calendar: {error}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 """
-Payment Monitor - Controlla nuovi pagamenti ogni ora e notifica su Telegram.
-Esegue telegram_ingestor.py e notifica solo i nuovi pagamenti con lezioni dello stesso giorno.
+Payment Monitor - Servizio residente che importa e notifica i nuovi pagamenti.
+
+Mantiene UN solo TelegramClient connesso al canale SMS: ogni nuovo messaggio
+viene parsato e inserito nel DB appena arriva (vedi telegram_ingestor.ingest_message)
+e notificato su Telegram con le lezioni dello stesso giorno.
+
+Le notifiche usano un cursore persistente (sync_status, source='payment_notifications')
+sull'ultimo id_pagamento notificato: un ciclo in ritardo o saltato non perde pagamenti.
 """
 import os
 import sqlite3
@@ -10,9 +16,14 @@ from pathlib import Path
 from datetime import datetime, date
 from dotenv import load_dotenv
 from telegram import Bot
-import subprocess
+from telethon import events
 import logging
 
+import telegram_ingestor
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+from utils.payments_db import ensure_content_hash_column
+from utils.message_archive import ensure_archive_table
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -32,22 +43,64 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 DB_PATH = Path(__file__).parent / "pagamenti.db"
 
+# Cursore notifiche in sync_status
+NOTIFY_CURSOR_SOURCE = 'payment_notifications'
+
+# Controllo di sicurezza periodico anche senza nuovi messaggi (es. notifiche fallite)
+SAFETY_SWEEP_SECONDS = 3600
+
+
+def get_notification_cursor(conn):
+    """
+    Legge l'ultimo id_pagamento notificato.
+
+    Alla prima esecuzione il cursore parte dai pagamenti creati più di un'ora fa,
+    così il comportamento coincide con la vecchia finestra "ultima ora" e non
+    viene rinotificato tutto lo storico.
+    """
+    ensure_sync_status_table(conn)
+    value = get_cursor(conn, NOTIFY_CURSOR_SOURCE)
+
+    if value is not None:
+        return int(value)
+
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COALESCE(MAX(id_pagamento), 0)
+        FROM pagamenti
+        WHERE created_at < datetime('now', '-1 hour')
+    ''')
+    initial = cursor.fetchone()[0]
+    save_cursor(conn, NOTIFY_CURSOR_SOURCE, initial)
+    conn.commit()
+    logger.info(f"📌 Cursore notifiche inizializzato a id_pagamento={initial}")
+    return initial
+
+
+def advance_notification_cursor(payment_id):
+    """Avanza il cursore notifiche fino a payment_id (incluso)."""
+    conn = sqlite3.connect(DB_PATH)
+    save_cursor(conn, NOTIFY_CURSOR_SOURCE, payment_id)
+    conn.commit()
+    conn.close()
+
 
 def get_new_payments():
     """
-    Recupera pagamenti inseriti nell'ultima ora che non sono ancora stati notificati.
+    Recupera pagamenti successivi al cursore notifiche e non ancora notificati.
+    Ordinati per id crescente (ordine di arrivo) per poter avanzare il cursore.
     """
     conn = sqlite3.connect(DB_PATH)
+    last_notified = get_notification_cursor(conn)
     cursor = conn.cursor()
 
-    # Pagamenti inseriti nell'ultima ora, non ancora notificati
     cursor.execute('''
         SELECT id_pagamento, nome_pagante, giorno, ora, somma, valuta
         FROM pagamenti
-        WHERE created_at >= datetime('now', '-1 hour')
+        WHERE id_pagamento > ?
         AND (notificato IS NULL OR notificato = 0)
-        ORDER BY giorno DESC, ora DESC
-    ''')
+        ORDER BY id_pagamento ASC
+    ''', (last_notified,))
 
     payments = []
     for row in cursor.fetchall():
@@ -159,29 +212,14 @@ async def notify_new_payment(bot, payment):
     logger.info(f"✅ Notificato pagamento {payment['id']}: {payment['nome_pagante']} - {payment['somma']}")
 
 
-async def check_and_notify():
-    """
-    Esegue telegram_ingestor, controlla nuovi pagamenti e notifica.
+async def check_and_notify(bot):
     """
-    logger.info("🔄 Avvio controllo nuovi pagamenti...")
+    Notifica i pagamenti successivi al cursore.
 
-    # 1. Esegui telegram_ingestor per importare nuovi messaggi
-    try:
-        result = subprocess.run(
-            ['.cal/bin/python', 'telegram_ingestor.py'],
-            cwd=Path(__file__).parent,
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
-        logger.info(f"telegram_ingestor output: {result.stdout}")
-        if result.stderr:
-            logger.warning(f"telegram_ingestor errors: {result.stderr}")
-    except Exception as e:
-        logger.error(f"Errore esecuzione telegram_ingestor: {e}")
-        return
-
-    # 2. Controlla nuovi pagamenti
+    Il cursore avanza solo finché le notifiche riescono: se una fallisce,
+    resta fermo e il pagamento viene ritentato al prossimo ciclo
+    (quelli successivi già notificati sono esclusi dal flag notificato).
+    """
     new_payments = get_new_payments()
 
     if not new_payments:
@@ -190,29 +228,99 @@ async def check_and_notify():
 
     logger.info(f"📋 Trovati {len(new_payments)} nuovi pagamenti")
 
-    # 3. Invia notifiche
-    bot = Bot(token=BOT_TOKEN)
-
+    cursor_blocked = False
     for payment in new_payments:
         try:
             await notify_new_payment(bot, payment)
         except Exception as e:
+            cursor_blocked = True
             logger.error(f"Errore notifica pagamento {payment['id']}: {e}")
+            continue
+
+        if not cursor_blocked:
+            advance_notification_cursor(payment['id'])
+
+
+async def catch_up(client, valid_senders, limiter=None):
+    """
+    Importa i messaggi successivi al cursore di ogni canale: all'avvio recupera
+    quelli arrivati mentre il servizio era fermo, nei controlli periodici
+    fa avanzare i cursori oltre i messaggi già ricevuti in tempo reale.
+    I canali sono letti in parallelo con un budget di richieste condiviso.
+    """
+    per_channel = await telegram_ingestor.ingest_channels(
+        client, telegram_ingestor.CHANNEL_IDS, valid_senders,
+        db_path=DB_PATH, verbose=False, limiter=limiter
+    )
+    inserted = sum(stats['inserted'] for stats in per_channel.values())
+
+    logger.info(f"📥 Recupero dai cursori: {inserted} nuovi pagamenti inseriti")
 
 
-async def run_periodic():
-    """Esegue il controllo ogni ora."""
+async def notification_loop(bot, client, valid_senders, new_payment_event, limiter=None):
+    """Notifica appena arriva un pagamento, con controllo di sicurezza ogni ora."""
     while True:
         try:
-            await check_and_notify()
+            await asyncio.wait_for(new_payment_event.wait(), timeout=SAFETY_SWEEP_SECONDS)
+        except asyncio.TimeoutError:
+            logger.info("⏳ Controllo periodico di sicurezza...")
+            try:
+                await catch_up(client, valid_senders, limiter)
+            except Exception as e:
+                logger.error(f"Errore recupero dal cursore: {e}")
+        new_payment_event.clear()
+
+        try:
+            await check_and_notify(bot)
         except Exception as e:
-            logger.error(f"Errore nel ciclo periodico: {e}")
+            logger.error(f"Errore nel ciclo notifiche: {e}")
+
+
+async def run_daemon():
+    """
+    Servizio residente: un solo TelegramClient connesso, iscritto ai nuovi
+    messaggi di tutti i canali configurati. Ogni pagamento viene inserito e notificato entro pochi secondi.
+    """
+    bot = Bot(token=BOT_TOKEN)
+    valid_senders = telegram_ingestor.load_whitelist(telegram_ingestor.WHITELIST_PATH)
+    client = await telegram_ingestor.connect_client()
+    new_payment_event = asyncio.Event()
+    limiter = telegram_ingestor.create_rate_limiter()
+
+    conn = sqlite3.connect(DB_PATH)
+    ensure_content_hash_column(conn)
+    ensure_archive_table(conn)
+    conn.close()
 
-        # Attendi 1 ora
-        logger.info("⏳ Prossimo controllo tra 1 ora...")
-        await asyncio.sleep(3600)
+    # Inserimento immediato; il cursore del canale avanza nei recuperi (catch_up),
+    # così un errore qui non può far saltare messaggi.
+    @client.on(events.NewMessage(chats=telegram_ingestor.CHANNEL_IDS))
+    async def on_new_message(event):
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            esito, payment_data = telegram_ingestor.ingest_message(
+                conn.cursor(), event.message, valid_senders, channel_id=event.chat_id
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        if esito == 'inserted':
+            logger.info(f"💰 Nuovo pagamento: {payment_data['nome_pagante']} - {payment_data['somma']}")
+            new_payment_event.set()
+        elif esito == 'filtered':
+            logger.info(f"🚫 Filtrato: {payment_data['nome_pagante']} (non è studente)")
+
+    await catch_up(client, valid_senders, limiter)
+    new_payment_event.set()
+
+    notifier = asyncio.create_task(notification_loop(bot, client, valid_senders, new_payment_event, limiter))
+    try:
+        await client.run_until_disconnected()
+    finally:
+        notifier.cancel()
 
 
 if __name__ == "__main__":
-    logger.info("🚀 Payment Monitor avviato - Controllo ogni ora")
-    asyncio.run(run_periodic())
+    logger.info("🚀 Payment Monitor avviato - In ascolto sul canale Telegram")
+    asyncio.run(run_daemon())
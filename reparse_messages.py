@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Rielabora l'archivio dei messaggi grezzi (messaggi_raw) con il parser attuale.
+
+Dopo una modifica a utils/sms_parser.py (nuovo template bancario, regex corretta)
+basta lanciare questo script: nessuna richiesta a Telegram, solo CPU locale.
+- i messaggi ora riconosciuti diventano nuovi pagamenti
+- i pagamenti già presenti vengono aggiornati se i campi estratti sono cambiati
+  (stato e abbinamenti restano invariati)
+- whitelist e deduplicazione per hash contenuto valgono come nell'ingestione
+
+Uso:
+    python reparse_messages.py
+    python reparse_messages.py --batch-size 5000
+"""
+import sqlite3
+import argparse
+from pathlib import Path
+
+from utils.sms_parser import parse_many
+from utils.payments_db import upsert_payments, ensure_content_hash_column
+from utils.message_archive import iter_archive, ensure_archive_table
+from utils.whitelist import load_sender_whitelist
+
+DB_PATH = Path(__file__).parent / "pagamenti.db"
+WHITELIST_PATH = Path(__file__).parent / 'mittenti_whitelist.csv'
+
+BATCH_SIZE = 1000
+
+
+def reparse_archive(db_path, valid_senders, batch_size=BATCH_SIZE):
+    """
+    Applica il parser attuale a tutto l'archivio, a batch.
+
+    Args:
+        db_path: Path del database SQLite
+        valid_senders: Whitelist mittenti (None = nessun filtro)
+        batch_size: Messaggi per batch (un commit per batch)
+
+    Returns:
+        dict con messages, parsed, inserted, updated, unchanged, filtered
+    """
+    conn = sqlite3.connect(db_path)
+    ensure_content_hash_column(conn)
+    ensure_archive_table(conn)
+
+    # Connessione separata per le scritture: la lettura dell'archivio resta paginata
+    write_conn = sqlite3.connect(db_path)
+    cursor = write_conn.cursor()
+
+    stats = {'messages': 0, 'parsed': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'filtered': 0}
+
+    try:
+        for batch in iter_archive(conn, batch_size):
+            stats['messages'] += len(batch)
+            parsed = parse_many((text, date) for _, text, date in batch)
+
+            payments = []
+            for (fonte_msg_id, _, _), payment_data in zip(batch, parsed):
+                if not payment_data:
+                    continue
+                stats['parsed'] += 1
+
+                if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
+                    stats['filtered'] += 1
+                    continue
+                payments.append((payment_data, fonte_msg_id))
+
+            inserted, updated, unchanged = upsert_payments(cursor, payments)
+            write_conn.commit()
+
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+            stats['unchanged'] += unchanged
+            print(f"   ... {stats['messages']} messaggi rielaborati", end='\r')
+    finally:
+        write_conn.close()
+        conn.close()
+
+    return stats
+
+
+def main():
+    """Funzione principale."""
+    parser = argparse.ArgumentParser(description="Rielabora l'archivio dei messaggi con il parser attuale")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Messaggi per batch")
+    args = parser.parse_args()
+
+    print("="*60)
+    print("REPARSE ARCHIVIO MESSAGGI")
+    print("="*60)
+    print(f"Database: {DB_PATH}")
+    print("="*60 + "\n")
+
+    # Stessa whitelist dell'ingestione: vuota = nessun pagamento, file mancante = nessun filtro
+    valid_senders = load_sender_whitelist(DB_PATH, WHITELIST_PATH)
+    print()
+
+    stats = reparse_archive(DB_PATH, valid_senders, batch_size=args.batch_size)
+
+    print("\n" + "="*60)
+    print("RIEPILOGO REPARSE")
+    print("="*60)
+    print(f"Messaggi in archivio: {stats['messages']}")
+    print(f"Riconosciuti come pagamenti: {stats['parsed']}")
+    print(f"Nuovi pagamenti inseriti: {stats['inserted']}")
+    print(f"Pagamenti aggiornati: {stats['updated']}")
+    print(f"Invariati o duplicati: {stats['unchanged']}")
+    print(f"Filtrati (non studenti): {stats['filtered']}")
+    print("="*60)
+
+
+if __name__ == "__main__":
+    main()
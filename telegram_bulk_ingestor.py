@@ -8,19 +8,47 @@ Differenze rispetto a telegram_ingestor.py:
 - Rimuove il limite di 100 messaggi
 - Supporta range di date personalizzato
 - Ottimizzato per import storico completo
+
+Pipeline producer/consumer: il downloader mette i batch in una coda limitata
+(QUEUE_MAX_BATCHES) e lo stage di parsing/inserimento li committa man mano.
+La memoria resta quella di pochi batch qualunque sia la lunghezza dello storico,
+e un errore a metà non perde i batch già salvati.
+
+Dopo ogni batch committato salva un checkpoint (offset_id e data raggiunta) in
+sync_status: se lo script si interrompe, `--resume` riprende da lì senza
+riscaricare nulla.
+
+In alternativa all'API, --from-export importa offline un export di Telegram
+Desktop (result.json): stessi fonte_msg_id, quindi i run successivi via API
+deduplicano contro i pagamenti importati dall'export.
+
+Uso:
+    python telegram_bulk_ingestor.py            # import completo da oggi a START_DATE
+    python telegram_bulk_ingestor.py --resume   # riprende dall'ultimo checkpoint
+    python telegram_bulk_ingestor.py --from-export ChatExport/result.json
 """
 import os
-import re
+import json
+import time
+import argparse
 import sqlite3
-import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from tqdm import tqdm
+import ijson
 from telethon import TelegramClient
 from telethon.errors import SessionPasswordNeededError, FloodWaitError
 import asyncio
-import time
+
+from utils.sms_parser import parse_many
+from utils.payments_db import insert_payments, telegram_fonte_msg_id, ensure_content_hash_column
+from utils.message_archive import archive_messages, ensure_archive_table
+from utils.whitelist import load_sender_whitelist
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+from utils.rate_limiter import AdaptiveRateLimiter
 
 # Configurazione
 env_path = Path(__file__).parent / '.env'
@@ -40,238 +68,536 @@ WHITELIST_PATH = Path(__file__).parent / 'mittenti_whitelist.csv'
 START_DATE = datetime(2025, 8, 1, tzinfo=timezone.utc)  # 1 agosto 2025 (UTC aware)
 END_DATE = datetime.now(timezone.utc)  # Oggi (UTC aware)
 
-# Rate limiting configuration
+# Rate limiting configuration: valori INIZIALI del limiter adattivo
+# (utils/rate_limiter.py), che li aumenta finché Telegram accetta e li dimezza su FloodWait
 BATCH_SIZE = 100  # Scarica 100 messaggi alla volta
 DELAY_BETWEEN_BATCHES = 3  # Pausa 3 secondi tra batch (max 20 req/sec = safe con 3s ogni 100 msg)
+MAX_BATCH_SIZE = 1000  # Batch massimo (10 richieste GetHistory)
+MAX_REQUESTS_PER_SECOND = 10  # Tetto del rate (metà del limite Telegram di 20 req/s)
+QUEUE_MAX_BATCHES = 1  # Batch in attesa tra downloader e inserimento (backpressure)
+
+# Retry per batch: oltre questi tentativi l'import si ferma (riprendibile con --resume)
+MAX_BATCH_RETRIES = 5
+RETRY_BASE_DELAY = 2  # Secondi, raddoppia a ogni tentativo
 
-# Pattern regex per il parsing degli SMS dalla banca russa
-# Formato: СЧЁТ3185 HH:MM Перевод [dettagli] XXXXр от NOME COGNOME Баланс: YYYYр
-SMS_PATTERN = re.compile(
-    r'СЧЁТ\d+\s+'  # Numero conto
-    r'(\d{1,2}):(\d{2})\s+'  # Ora (gruppo 1, 2)
-    r'Перевод.*?'  # "Перевод" con dettagli opzionali
-    r'([\d\s]+)р\s+'  # Somma (gruppo 3) - può avere spazi nei numeri
-    r'от\s+'  # "от"
-    r'([А-ЯЁA-Za-zА-яё]+(?:\s+[А-ЯЁA-Za-zА-яё]\.?)?)'  # Nome pagante (gruppo 4)
-)
+# Import da export Telegram Desktop: messaggi per blocco inviato al pool di parsing
+EXPORT_CHUNK_SIZE = 5000
 
 
 def load_whitelist(whitelist_path):
     """
-    Carica la whitelist dei mittenti validi dal file CSV.
+    Carica la whitelist dei mittenti validi (vedi utils.whitelist.load_sender_whitelist).
 
     Args:
         whitelist_path: Path al file CSV
 
     Returns:
-        Set di nomi paganti validi (studenti)
+        SenderWhitelist (anche vuota) o None se il file non esiste (nessun filtro)
     """
-    valid_senders = set()
+    return load_sender_whitelist(DB_PATH, whitelist_path)
 
-    if not whitelist_path.exists():
-        print(f"⚠️  File whitelist non trovato: {whitelist_path}")
-        print("    Tutti i pagamenti verranno processati.")
-        return None
 
-    try:
-        with open(whitelist_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # Solo i mittenti con studente=1 sono validi
-                if row.get('studente') == '1':
-                    valid_senders.add(row['nome_pagante'])
-
-        print(f"✅ Whitelist caricata: {len(valid_senders)} studenti validi")
-        return valid_senders
-    except Exception as e:
-        print(f"❌ Errore caricamento whitelist: {e}")
-        return None
+def checkpoint_source(channel_id):
+    """Nome della fonte in sync_status per il checkpoint dell'import storico."""
+    return f"telegram_bulk_{channel_id}"
 
 
-def parse_payment_message(message_text, message_date):
+def load_checkpoint(conn, channel_id):
     """
-    Estrae i dati di pagamento da un messaggio SMS.
+    Legge il checkpoint dell'import storico.
 
-    Args:
-        message_text: Testo del messaggio
-        message_date: Data del messaggio (datetime object)
+    Returns:
+        dict con offset_id, date (ISO) e completed, oppure None
+    """
+    ensure_sync_status_table(conn)
+    value = get_cursor(conn, checkpoint_source(channel_id))
+    return json.loads(value) if value else None
+
+
+def save_checkpoint(conn, channel_id, offset_id, reached_date, completed=False):
+    """
+    Salva il checkpoint dell'import storico.
+    NON esegue commit: va committato insieme al batch appena inserito.
+    """
+    save_cursor(conn, checkpoint_source(channel_id), json.dumps({
+        'offset_id': offset_id,
+        'date': reached_date.isoformat() if reached_date else None,
+        'completed': completed
+    }))
+
+
+def create_rate_limiter():
+    """Crea il limiter adattivo partendo dai valori BATCH_SIZE / DELAY_BETWEEN_BATCHES."""
+    return AdaptiveRateLimiter(
+        rate=1 / DELAY_BETWEEN_BATCHES,
+        max_rate=MAX_REQUESTS_PER_SECOND,
+        batch_size=BATCH_SIZE,
+        min_batch_size=BATCH_SIZE,
+        max_batch_size=MAX_BATCH_SIZE
+    )
+
+
+async def fetch_batch(client, channel_id, offset_id, batch_number, limiter):
+    """
+    Scarica un batch di messaggi (dal più recente al più vecchio) con retry limitato.
+
+    La dimensione del batch e il ritmo delle richieste li decide il limiter.
+    FloodWait: il limiter rallenta e attende i secondi richiesti da Telegram.
+    Altri errori: backoff esponenziale (RETRY_BASE_DELAY, 2x, 4x...).
+    Dopo MAX_BATCH_RETRIES tentativi falliti rilancia l'ultima eccezione.
 
     Returns:
-        dict con i dati estratti o None se il parsing fallisce
+        Tupla (messaggi, batch_size richiesto); i messaggi includono anche quelli senza testo
     """
-    match = SMS_PATTERN.search(message_text)
+    for attempt in range(1, MAX_BATCH_RETRIES + 1):
+        batch_size = await limiter.acquire()
+        try:
+            messages = [
+                message async for message in client.iter_messages(
+                    channel_id,
+                    limit=batch_size,  # Dimensione decisa dal limiter
+                    offset_id=offset_id,  # Continua da dove ci siamo fermati
+                    reverse=False,  # Dal più recente al più vecchio
+                    wait_time=0  # Il ritmo tra le richieste lo gestisce il limiter
+                )
+            ]
+            limiter.on_success(len(messages))
+            return messages, batch_size
+
+        except FloodWaitError as e:
+            # Telegram ci chiede di aspettare: il limiter attende e rallenta
+            limiter.on_flood_wait(e.seconds)
+            if attempt == MAX_BATCH_RETRIES:
+                raise
+            tqdm.write(f"   ⚠️  FloodWait: attendo {e.seconds}s come richiesto da Telegram, "
+                       f"nuovo ritmo {limiter.rate:.2f} req/s, batch {limiter.batch_size} "
+                       f"(tentativo {attempt}/{MAX_BATCH_RETRIES})...")
+
+        except Exception as e:
+            if attempt == MAX_BATCH_RETRIES:
+                raise
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            tqdm.write(f"   ❌ Errore nel batch #{batch_number}: {e} "
+                       f"(tentativo {attempt}/{MAX_BATCH_RETRIES}, riprovo tra {delay}s)")
+            await asyncio.sleep(delay)
+
+
+async def download_batches(client, channel_id, start_date, end_date, queue, limiter, offset_id=0):
+    """
+    Producer: scarica i messaggi del canale a batch e li mette in coda.
+
+    Gestisce:
+    - Paginazione automatica (batch di dimensione adattiva)
+    - Rate limiting adattivo (token bucket, vedi utils/rate_limiter.py)
+    - FloodWait ed errori con retry limitato (vedi fetch_batch)
+
+    La coda è limitata: se l'inserimento è più lento, il download si ferma
+    finché c'è posto. Ogni elemento è (messaggi, offset_id, data_raggiunta, ultimo);
+    a fine download (o in caso di errore) mette None in coda.
+
+    Args:
+        client: TelegramClient instance
+        channel_id: ID del canale
+        start_date: Data inizio (datetime)
+        end_date: Data fine (datetime)
+        queue: asyncio.Queue dove pubblicare i batch
+        limiter: AdaptiveRateLimiter che decide batch e ritmo
+        offset_id: Id da cui ripartire (0 = dall'ultimo messaggio)
+    """
+    print(f"📥 Recupero TUTTI i messaggi dal canale {channel_id}")
+    print(f"   Range: {start_date.strftime('%Y-%m-%d')} → {end_date.strftime('%Y-%m-%d')}")
+    if offset_id:
+        print(f"   Ripresa da checkpoint: messaggi precedenti all'id {offset_id}")
+    print(f"   Rate limiting adattivo: parte da {BATCH_SIZE} msg/batch ogni {DELAY_BETWEEN_BATCHES}s, "
+          f"fino a {MAX_BATCH_SIZE} msg/batch e {MAX_REQUESTS_PER_SECOND} req/s\n")
+
+    batch_count = 0
+
+    try:
+        while True:
+            batch_count += 1
+
+            # Scarica un batch di messaggi (rilancia dopo MAX_BATCH_RETRIES)
+            raw_messages, batch_size = await fetch_batch(client, channel_id, offset_id, batch_count, limiter)
+
+            batch_messages = []
+            reached_start = False
+            reached_date = None
+            for message in raw_messages:
+                # Verifica range di date
+                if message.date < start_date:
+                    # Troppo vecchio, fermiamo tutto
+                    reached_start = True
+                    break
+
+                offset_id = message.id  # Aggiorna offset per prossimo batch
+                reached_date = message.date
 
-    if not match:
-        return None
+                if message.date > end_date:
+                    # Troppo recente, salta ma continua
+                    continue
 
-    ora_hh = match.group(1)
-    ora_mm = match.group(2)
-    somma_str = match.group(3).strip()
-    nome_pagante = match.group(4).strip()
+                if message.text:
+                    batch_messages.append(message)
 
-    # Normalizza il nome (Title Case)
-    nome_pagante = nome_pagante.title()
+            # Se il batch è più piccolo di quanto richiesto, abbiamo finito
+            is_last = reached_start or len(raw_messages) < batch_size
 
-    # Costruisci data dal message_date
-    giorno = message_date.strftime('%Y-%m-%d')
-    ora = f"{ora_hh.zfill(2)}:{ora_mm}:00"
+            # Attende se lo stage di inserimento è indietro
+            await queue.put((batch_messages, offset_id, reached_date, is_last))
 
-    # Rimuovi tutti gli spazi dalla somma (gestisce "10 000" -> "10000")
-    somma_clean = somma_str.replace(' ', '').replace('\xa0', '')  # Rimuove spazi normali e non-breaking spaces
+            if reached_start:
+                tqdm.write(f"   ⏹️  Raggiunta data minima ({start_date.strftime('%Y-%m-%d')}), stop.")
+                break
+
+            if is_last:
+                tqdm.write(f"   ✅ Ultimo batch ricevuto (parziale), scaricamento completo.")
+                break
+
+        tqdm.write(f"\n✅ Scaricamento completato in {batch_count} batch")
+
+    finally:
+        # Segnale di fine per il consumer
+        await queue.put(None)
+
+
+async def insert_batches(queue, conn, channel_id, valid_senders, stats):
+    """
+    Consumer: parsa e inserisce i batch dalla coda, con commit dopo ogni batch.
+    Il checkpoint viene salvato nella stessa transazione del batch.
+
+    Args:
+        queue: asyncio.Queue con i batch del producer (None = fine)
+        conn: Connessione SQLite
+        channel_id: ID del canale (per il checkpoint)
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        stats: dict contatori aggiornato in place
+    """
+    ensure_sync_status_table(conn)
+    ensure_content_hash_column(conn)
+    ensure_archive_table(conn)
+    cursor = conn.cursor()
+
+    # Progress bar con tqdm (totale sconosciuto: lo storico arriva in streaming)
+    pbar = tqdm(desc="📝 Elaborazione DB", unit=" msg", ncols=100)
 
     try:
-        somma = float(somma_clean)
-    except ValueError:
-        print(f"⚠️  Errore conversione somma: '{somma_str}' -> '{somma_clean}'")
-        return None
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            batch, offset_id, reached_date, is_last = item
+
+            # Archivio dei messaggi grezzi (per reparse_messages.py)
+            archive_messages(cursor, [
+                (telegram_fonte_msg_id(channel_id, msg.id), msg.text, msg.date) for msg in batch if msg.text
+            ])
+
+            # Parsing dell'intero batch (prefiltro + template precompilati)
+            parsed = parse_many((msg.text, msg.date) for msg in batch)
+
+            payments = []
+            for msg, payment_data in zip(batch, parsed):
+                stats['found'] += 1
+
+                if not payment_data:
+                    stats['errors'] += 1
+                    continue
+
+                # Filtra mittenti non validi (se whitelist è attiva)
+                if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
+                    stats['filtered'] += 1
+                    continue
 
-    return {
-        'nome_pagante': nome_pagante,
-        'giorno': giorno,
-        'ora': ora,
-        'somma': somma,
-        'valuta': 'RUB',
-        'stato': 'sospeso'
-    }
+                payments.append((payment_data, telegram_fonte_msg_id(channel_id, msg.id)))
+
+            # Inserimento set-based dell'intero batch (duplicati scartati da ON CONFLICT)
+            inserted, duplicates = insert_payments(cursor, payments)
+            stats['inserted'] += inserted
+            stats['skipped'] += duplicates
+
+            # Commit del batch + checkpoint: il lavoro fatto resta anche se un batch successivo fallisce
+            save_checkpoint(conn, channel_id, offset_id, reached_date, completed=is_last)
+            conn.commit()
+
+            pbar.update(len(batch))
+            pbar.set_postfix({
+                'Inseriti': stats['inserted'],
+                'Filtrati': stats['filtered'],
+                'Duplicati': stats['skipped'],
+                'Errori': stats['errors']
+            }, refresh=True)
+    finally:
+        pbar.close()
 
 
-def insert_payment(cursor, payment_data, message_id):
+async def run_pipeline(client, channel_id, start_date, end_date, conn, valid_senders, stats,
+                       offset_id=0, limiter=None):
     """
-    Inserisce un pagamento nel database con deduplicazione basata su message_id.
+    Esegue download e inserimento in parallelo, collegati da una coda limitata.
+    Rilancia l'errore del download se i retry di un batch sono esauriti.
 
     Args:
-        cursor: Cursore SQLite
-        payment_data: Dizionario con i dati del pagamento
-        message_id: ID del messaggio Telegram (per deduplicazione)
+        stats: dict contatori (found, inserted, skipped, filtered, errors) aggiornato in place
+        offset_id: Id da cui ripartire (0 = dall'ultimo messaggio)
+        limiter: AdaptiveRateLimiter (None = create_rate_limiter())
+    """
+    if limiter is None:
+        limiter = create_rate_limiter()
+    queue = asyncio.Queue(maxsize=QUEUE_MAX_BATCHES)
+
+    producer = asyncio.create_task(
+        download_batches(client, channel_id, start_date, end_date, queue, limiter, offset_id=offset_id)
+    )
+    consumer = asyncio.create_task(insert_batches(queue, conn, channel_id, valid_senders, stats))
+
+    try:
+        await consumer
+    except BaseException:
+        # Se l'inserimento fallisce, non ha senso continuare a scaricare
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        raise
+
+    # Propaga un eventuale errore del download (retry esauriti)
+    await producer
+
+
+# ============================================================
+# Import offline da export Telegram Desktop (result.json)
+# ============================================================
+
+def export_chat_id(chat_type, chat_id):
+    """
+    Converte l'id di un export nel formato usato da Telethon/CHANNEL_ID.
+
+    Telegram Desktop esporta l'id "nudo" (es. 2452167729); per i canali
+    e i supergruppi l'API usa l'id marcato -100... (es. -1002452167729).
+    """
+    if chat_type in ('public_channel', 'private_channel', 'public_supergroup', 'private_supergroup'):
+        return int(f"-100{chat_id}")
+    return int(chat_id)
+
+
+def read_export_header(export_path):
+    """
+    Legge tipo e id della chat in testa all'export, senza leggere i messaggi.
 
     Returns:
-        ID del record inserito/aggiornato o None se già esistente
+        Tupla (chat_id marcato o None, nome chat o None)
     """
-    fonte_msg_id = f"tg_{CHANNEL_ID}_{message_id}"
+    header = {}
+    with open(export_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix == 'messages':
+                break
+            if prefix in ('id', 'type', 'name') and event in ('number', 'string'):
+                header[prefix] = value
 
-    try:
-        cursor.execute('''
-            INSERT INTO pagamenti
-            (nome_pagante, giorno, ora, somma, valuta, stato, fonte_msg_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            payment_data['nome_pagante'],
-            payment_data['giorno'],
-            payment_data['ora'],
-            payment_data['somma'],
-            payment_data['valuta'],
-            payment_data['stato'],
-            fonte_msg_id
-        ))
-        return cursor.lastrowid
-    except sqlite3.IntegrityError:
-        # Messaggio già processato (vincolo UNIQUE su fonte_msg_id)
-        return None
-
-
-async def fetch_all_channel_messages(client, channel_id, start_date, end_date):
-    """
-    Recupera TUTTI i messaggi da un canale in un range di date con rate limiting.
+    if 'id' not in header:
+        return None, header.get('name')
+    return export_chat_id(header.get('type'), header['id']), header.get('name')
 
-    Gestisce:
-    - Paginazione automatica (scarica a batch di BATCH_SIZE)
-    - Rate limiting (delay tra batch)
-    - FloodWait errors di Telegram
+
+def export_message_text(text):
+    """
+    Testo semplice di un messaggio esportato: Telegram Desktop salva il testo
+    come stringa o come lista di pezzi (stringhe ed entità {type, text}).
+    """
+    if isinstance(text, str):
+        return text
+    return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+
+
+def export_message_timestamp(message):
+    """
+    Timestamp UTC di un messaggio esportato. Gli export recenti hanno date_unixtime;
+    in quelli vecchi "date" è nell'ora locale di chi ha esportato.
+    """
+    if 'date_unixtime' in message:
+        return int(message['date_unixtime'])
+    return int(datetime.fromisoformat(message['date']).astimezone(timezone.utc).timestamp())
+
+
+def iter_export_messages(export_path):
+    """
+    Legge i messaggi dell'export in streaming (parser JSON incrementale):
+    in memoria c'è un messaggio alla volta, qualunque sia la dimensione del file.
+
+    Yields:
+        Tuple (message_id, testo, timestamp UTC)
+    """
+    with open(export_path, 'rb') as f:
+        for message in ijson.items(f, 'messages.item', use_float=True):
+            if message.get('type') != 'message':
+                continue
+            text = export_message_text(message.get('text', ''))
+            if text:
+                yield message['id'], text, export_message_timestamp(message)
+
+
+def iter_chunks(items, size):
+    """Raggruppa un iterabile in liste di `size` elementi."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_export_chunk(chunk):
+    """
+    Parsa un blocco di messaggi dell'export (eseguito nei processi del pool).
 
     Args:
-        client: TelegramClient instance
-        channel_id: ID del canale
-        start_date: Data inizio (datetime)
-        end_date: Data fine (datetime)
+        chunk: Lista di tuple (message_id, testo, timestamp UTC)
 
     Returns:
-        Lista di messaggi
+        Tupla (messaggi nel blocco, lista di (message_id, payment_data) riconosciuti)
     """
-    print(f"📥 Recupero TUTTI i messaggi dal canale {channel_id}")
-    print(f"   Range: {start_date.strftime('%Y-%m-%d')} → {end_date.strftime('%Y-%m-%d')}")
-    print(f"   Rate limiting: {BATCH_SIZE} msg/batch, {DELAY_BETWEEN_BATCHES}s delay\n")
+    parsed = parse_many(
+        (text, datetime.fromtimestamp(timestamp, timezone.utc)) for _, text, timestamp in chunk
+    )
+    return len(chunk), [
+        (message_id, payment_data)
+        for (message_id, _, _), payment_data in zip(chunk, parsed)
+        if payment_data
+    ]
+
+
+def import_export(export_path, channel_id, conn, valid_senders, stats, workers=None):
+    """
+    Importa un export Telegram Desktop nel DB.
+
+    Il file è letto in streaming nel processo principale, il parsing gira in un
+    pool di processi (al massimo 2 blocchi per worker in volo, così la memoria
+    resta limitata) e ogni blocco è inserito con un solo insert_payments.
+    I fonte_msg_id sono gli stessi dell'import via API (tg_{canale}_{id}).
+
+    Args:
+        export_path: Path di result.json
+        channel_id: ID del canale (formato CHANNEL_ID, -100...)
+        conn: Connessione SQLite
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        stats: dict contatori aggiornato in place
+        workers: Processi del pool (None = numero di CPU)
+    """
+    ensure_content_hash_column(conn)
+    ensure_archive_table(conn)
+    cursor = conn.cursor()
+    pbar = tqdm(desc="📝 Import export", unit=" msg", ncols=100)
+
+    def store(chunk, result):
+        count, payments = result
+
+        # Archivio dei messaggi grezzi (per reparse_messages.py)
+        archive_messages(cursor, [
+            (telegram_fonte_msg_id(channel_id, message_id), text, datetime.fromtimestamp(timestamp, timezone.utc))
+            for message_id, text, timestamp in chunk
+        ])
+        stats['found'] += count
+        stats['errors'] += count - len(payments)
+
+        rows = []
+        for message_id, payment_data in payments:
+            # Filtra mittenti non validi (se whitelist è attiva)
+            if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
+                stats['filtered'] += 1
+                continue
+            rows.append((payment_data, telegram_fonte_msg_id(channel_id, message_id)))
+
+        inserted, duplicates = insert_payments(cursor, rows)
+        stats['inserted'] += inserted
+        stats['skipped'] += duplicates
+        conn.commit()
+
+        pbar.update(count)
+        pbar.set_postfix({'Inseriti': stats['inserted'], 'Duplicati': stats['skipped']})
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = 2 * workers
 
     try:
-        messages = []
-        message_count = 0
-        batch_count = 0
-        offset_id = 0  # Inizia dall'ultimo messaggio
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
 
-        while True:
-            batch_count += 1
-            batch_start = time.time()
+            for chunk in iter_chunks(iter_export_messages(export_path), EXPORT_CHUNK_SIZE):
+                pending.append((chunk, pool.submit(parse_export_chunk, chunk)))
+                if len(pending) >= max_pending:
+                    chunk, future = pending.popleft()
+                    store(chunk, future.result())
 
-            print(f"   📦 Batch #{batch_count}: scaricamento fino a {BATCH_SIZE} messaggi...")
+            while pending:
+                chunk, future = pending.popleft()
+                store(chunk, future.result())
+    finally:
+        pbar.close()
 
-            try:
-                # Scarica un batch di messaggi
-                batch_messages = []
-                async for message in client.iter_messages(
-                    channel_id,
-                    limit=BATCH_SIZE,  # Limita a BATCH_SIZE per batch
-                    offset_id=offset_id,  # Continua da dove ci siamo fermati
-                    reverse=False  # Dal più recente al più vecchio
-                ):
-                    # Verifica range di date
-                    if message.date < start_date:
-                        # Troppo vecchio, fermiamo tutto
-                        print(f"   ⏹️  Raggiunta data minima ({start_date.strftime('%Y-%m-%d')}), stop.")
-                        batch_messages = []  # Svuota batch, usciamo
-                        break
-
-                    if message.date > end_date:
-                        # Troppo recente, salta ma continua
-                        continue
-
-                    if message.text:
-                        batch_messages.append(message)
-                        offset_id = message.id  # Aggiorna offset per prossimo batch
-
-                # Se batch vuoto, abbiamo finito
-                if not batch_messages:
-                    print(f"   ✅ Nessun altro messaggio da scaricare.")
-                    break
 
-                # Aggiungi batch ai messaggi totali
-                messages.extend(batch_messages)
-                message_count += len(batch_messages)
+def main_from_export(export_path, channel_id=None, workers=None):
+    """
+    Import offline da export Telegram Desktop: nessuna richiesta API.
 
-                print(f"   ✅ Batch #{batch_count}: {len(batch_messages)} messaggi (totale: {message_count})")
+    Args:
+        export_path: Path di result.json
+        channel_id: ID del canale (None = dall'export, altrimenti CHANNEL_ID)
+        workers: Processi del pool di parsing
+    """
+    export_path = Path(export_path)
+    if not export_path.exists():
+        print(f"❌ Export non trovato: {export_path}")
+        return
 
-                # Se il batch è più piccolo di BATCH_SIZE, abbiamo finito
-                if len(batch_messages) < BATCH_SIZE:
-                    print(f"   ✅ Ultimo batch ricevuto (parziale), scaricamento completo.")
-                    break
+    export_channel_id, chat_name = read_export_header(export_path)
+    if channel_id is None:
+        channel_id = export_channel_id or CHANNEL_ID
+    elif export_channel_id is not None and export_channel_id != channel_id:
+        print(f"⚠️  L'export è della chat {export_channel_id}, ma i pagamenti verranno salvati come canale {channel_id}")
 
-                # Rate limiting: pausa tra batch
-                batch_duration = time.time() - batch_start
-                if batch_duration < DELAY_BETWEEN_BATCHES:
-                    sleep_time = DELAY_BETWEEN_BATCHES - batch_duration
-                    print(f"   ⏳ Pausa {sleep_time:.1f}s (rate limiting)...")
-                    await asyncio.sleep(sleep_time)
-
-            except FloodWaitError as e:
-                # Telegram ci chiede di aspettare
-                wait_time = e.seconds
-                print(f"   ⚠️  FloodWait: attendo {wait_time}s come richiesto da Telegram...")
-                await asyncio.sleep(wait_time)
-                continue  # Riprova questo batch
-
-            except Exception as e:
-                print(f"   ❌ Errore nel batch #{batch_count}: {e}")
-                # Continua con il prossimo batch invece di fallire completamente
-                continue
+    print("="*60)
+    print("IMPORT PAGAMENTI DA EXPORT TELEGRAM DESKTOP")
+    print("="*60)
+    print(f"Export: {export_path} ({chat_name or 'chat senza nome'})")
+    print(f"Canale: {channel_id}")
+    print(f"Database: {DB_PATH}")
+    print("="*60 + "\n")
 
-        print(f"\n✅ Scaricamento completato: {len(messages)} messaggi in {batch_count} batch")
-        return messages
+    # Carica whitelist
+    valid_senders = load_whitelist(WHITELIST_PATH)
+    print()
+
+    conn = sqlite3.connect(DB_PATH)
+    stats = {'found': 0, 'inserted': 0, 'skipped': 0, 'filtered': 0, 'errors': 0}
+    started = time.perf_counter()
+    try:
+        import_export(export_path, channel_id, conn, valid_senders, stats, workers=workers)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
+
+    # Riepilogo
+    print("\n" + "="*60)
+    print("RIEPILOGO IMPORT DA EXPORT")
+    print("="*60)
+    print(f"Messaggi letti: {stats['found']}")
+    print(f"Pagamenti inseriti: {stats['inserted']}")
+    print(f"Già esistenti (saltati): {stats['skipped']}")
+    print(f"Filtrati (non studenti): {stats['filtered']}")
+    print(f"Messaggi non di pagamento: {stats['errors']}")
+    print(f"Tempo: {elapsed:.1f}s ({stats['found'] / elapsed if elapsed > 0 else 0:,.0f} msg/s)")
+    print("="*60)
 
-    except Exception as e:
-        print(f"❌ Errore fatale nel recuperare messaggi: {e}")
-        return []
 
+async def main(resume=False):
+    """
+    Funzione principale.
 
-async def main():
-    """Funzione principale."""
+    Args:
+        resume: Se True riprende dall'ultimo checkpoint salvato
+    """
     if not API_ID or not API_HASH:
         print("❌ API_ID o API_HASH non trovati nel file .env")
         return
@@ -296,8 +622,24 @@ async def main():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
+    # Checkpoint per --resume
+    offset_id = 0
+    if resume:
+        checkpoint = load_checkpoint(conn, CHANNEL_ID)
+        if not checkpoint:
+            print("⚠️  Nessun checkpoint trovato: import completo dall'inizio.\n")
+        elif checkpoint['completed']:
+            print(f"✅ L'ultimo import è già completo (fino al {checkpoint['date']}). Niente da riprendere.")
+            conn.close()
+            return
+        else:
+            offset_id = checkpoint['offset_id']
+            print(f"↩️  Ripresa dal checkpoint: offset_id={offset_id}, data raggiunta {checkpoint['date']}\n")
+
     # Inizializza Telethon client
-    client = TelegramClient(str(SESSION_NAME), API_ID, API_HASH)
+    # flood_sleep_threshold=0: Telethon non attende da solo i FloodWait, che arrivano
+    # come FloodWaitError al rate limiter adattivo
+    client = TelegramClient(str(SESSION_NAME), API_ID, API_HASH, flood_sleep_threshold=0)
 
     # Start con callback per autenticazione interattiva
     print("🔐 Autenticazione Telegram in corso...")
@@ -310,74 +652,21 @@ async def main():
     )
     print("✅ Client Telegram connesso\n")
 
-    # Recupera TUTTI i messaggi nel range di date
-    messages = await fetch_all_channel_messages(client, CHANNEL_ID, START_DATE, END_DATE)
-
-    if not messages:
-        print("\n⚠️  Nessun messaggio disponibile nel range di date specificato.")
-        await client.disconnect()
-        conn.close()
-        return
-
-    # Processa messaggi
-    inserted_count = 0
-    skipped_count = 0
-    error_count = 0
-    filtered_count = 0
-
-    print("\n📝 Processamento messaggi...\n")
-
-    # Progress bar con tqdm
-    pbar = tqdm(messages, desc="📝 Elaborazione DB", unit=" msg", ncols=100)
-
-    for msg in pbar:
-        # Parsing del messaggio
-        payment_data = parse_payment_message(msg.text, msg.date)
-
-        if not payment_data:
-            error_count += 1
-            # Aggiorna descrizione progress bar
-            pbar.set_postfix({
-                'Inseriti': inserted_count,
-                'Filtrati': filtered_count,
-                'Duplicati': skipped_count,
-                'Errori': error_count
-            }, refresh=True)
-            continue
-
-        # Filtra mittenti non validi (se whitelist è attiva)
-        if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
-            filtered_count += 1
-            # Aggiorna descrizione progress bar
-            pbar.set_postfix({
-                'Inseriti': inserted_count,
-                'Filtrati': filtered_count,
-                'Duplicati': skipped_count,
-                'Errori': error_count
-            }, refresh=True)
-            continue
-
-        # Inserimento nel database
-        record_id = insert_payment(cursor, payment_data, msg.id)
-
-        if record_id:
-            inserted_count += 1
-        else:
-            skipped_count += 1
-
-        # Aggiorna descrizione progress bar
-        pbar.set_postfix({
-            'Inseriti': inserted_count,
-            'Filtrati': filtered_count,
-            'Duplicati': skipped_count,
-            'Errori': error_count
-        }, refresh=True)
-
-    pbar.close()
+    # Scarica e inserisce in streaming TUTTI i messaggi nel range di date
+    stats = {'found': 0, 'inserted': 0, 'skipped': 0, 'filtered': 0, 'errors': 0}
+    interrupted = False
+    limiter = create_rate_limiter()
+    try:
+        await run_pipeline(client, CHANNEL_ID, START_DATE, END_DATE, conn, valid_senders, stats,
+                           offset_id=offset_id, limiter=limiter)
+    except Exception as e:
+        interrupted = True
+        print(f"\n❌ Import interrotto: {e}")
+        print("   I batch già salvati restano nel DB. Rilancia con --resume per continuare.")
     print()  # Newline dopo progress bar
 
-    # Commit delle modifiche
-    conn.commit()
+    if not stats['found']:
+        print("\n⚠️  Nessun messaggio disponibile nel range di date specificato.")
 
     # Verifica totale nel database
     cursor.execute("SELECT COUNT(*) FROM pagamenti")
@@ -393,14 +682,20 @@ async def main():
 
     # Riepilogo
     print("\n" + "="*60)
-    print("RIEPILOGO SCARICAMENTO COMPLETO")
+    print("RIEPILOGO SCARICAMENTO " + ("PARZIALE (riprendibile con --resume)" if interrupted else "COMPLETO"))
     print("="*60)
     print(f"Range date: {START_DATE.strftime('%d/%m/%Y')} → {END_DATE.strftime('%d/%m/%Y')}")
-    print(f"Messaggi trovati: {len(messages)}")
-    print(f"Pagamenti inseriti: {inserted_count}")
-    print(f"Già esistenti (saltati): {skipped_count}")
-    print(f"Filtrati (non studenti): {filtered_count}")
-    print(f"Errori di parsing: {error_count}")
+    print(f"Messaggi trovati: {stats['found']}")
+    print(f"Pagamenti inseriti: {stats['inserted']}")
+    print(f"Già esistenti (saltati): {stats['skipped']}")
+    print(f"Filtrati (non studenti): {stats['filtered']}")
+    print(f"Errori di parsing: {stats['errors']}")
+    print("-"*60)
+    rate = limiter.report()
+    print(f"Rate ottenuto: {rate['req_per_sec']:.2f} req/s, {rate['msg_per_sec']:.1f} msg/s "
+          f"({rate['requests']} richieste in {rate['elapsed']:.0f}s)")
+    print(f"FloodWait: {rate['flood_waits']} (attesa totale {rate['flood_wait_seconds']}s), "
+          f"ritmo finale {rate['rate']:.2f} req/s, batch {rate['batch_size']}")
     print("-"*60)
     print(f"TOTALE nel database: {total_in_db} pagamenti")
     print(f"TOTALE importo: {total_amount:,.2f} RUB")
@@ -408,4 +703,18 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Import storico completo dei pagamenti da Telegram")
+    parser.add_argument('--resume', action='store_true',
+                        help="Riprende dall'ultimo checkpoint invece di ripartire da oggi")
+    parser.add_argument('--from-export', metavar='RESULT_JSON',
+                        help="Importa offline un export Telegram Desktop (result.json) invece di usare l'API")
+    parser.add_argument('--channel', type=int,
+                        help="ID del canale dell'export (default: letto dall'export)")
+    parser.add_argument('--workers', type=int,
+                        help="Processi per il parsing dell'export (default: numero di CPU)")
+    args = parser.parse_args()
+
+    if args.from_export:
+        main_from_export(args.from_export, channel_id=args.channel, workers=args.workers)
+    else:
+        asyncio.run(main(resume=args.resume))
@@ -4,23 +4,30 @@ Componente 1: Ingestore Pagamenti
 Legge messaggi dal canale Telegram, estrae dati di pagamento e li inserisce nel database.
 """
 import os
-import re
 import sqlite3
-import csv
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
 import asyncio
 
+from utils.sms_parser import parse_payment_message, parse_many
+from utils.payments_db import insert_payments, telegram_fonte_msg_id, ensure_content_hash_column
+from utils.message_archive import archive_messages, ensure_archive_table
+from utils.whitelist import load_sender_whitelist
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+from utils.rate_limiter import AdaptiveRateLimiter
+
 # Configurazione
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
 
 API_ID = int(os.getenv('API_ID'))
 API_HASH = os.getenv('API_HASH')
-CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
+# Uno o più canali (CHANNEL_IDS=-100111,-100222); CHANNEL_ID resta valido per un solo canale
+CHANNEL_IDS = [int(c) for c in (os.getenv('CHANNEL_IDS') or os.getenv('CHANNEL_ID')).split(',') if c.strip()]
+CHANNEL_ID = CHANNEL_IDS[0]
 PHONE_NUMBER = os.getenv('PHONE_NUMBER')
 VERIFICATION_CODE = os.getenv('VERIFICATION_CODE')
 TELEGRAM_PASSWORD = os.getenv('TELEGRAM_PASSWORD')
@@ -28,157 +35,342 @@ DB_PATH = Path(__file__).parent / "pagamenti.db"
 SESSION_NAME = Path(__file__).parent / 'telegram_session'
 WHITELIST_PATH = Path(__file__).parent / 'mittenti_whitelist.csv'
 
-# Pattern regex per il parsing degli SMS dalla banca russa
-# Formato: СЧЁТ3185 HH:MM Перевод [dettagli] XXXXр от NOME COGNOME Баланс: YYYYр
-SMS_PATTERN = re.compile(
-    r'СЧЁТ\d+\s+'  # Numero conto
-    r'(\d{1,2}):(\d{2})\s+'  # Ora (gruppo 1, 2)
-    r'Перевод.*?'  # "Перевод" con dettagli opzionali
-    r'([\d\s]+)р\s+'  # Somma (gruppo 3) - può avere spazi nei numeri
-    r'от\s+'  # "от"
-    r'([А-ЯЁA-Za-zА-яё]+(?:\s+[А-ЯЁA-Za-zА-яё]\.?)?)'  # Nome pagante (gruppo 4)
-)
+# Messaggi per pagina API (limite Telegram per GetHistory)
+PAGE_SIZE = 100
+
+# Budget globale di richieste, condiviso da tutti i canali
+REQUESTS_PER_SECOND = 2
+MAX_REQUESTS_PER_SECOND = 10
+
+# Tentativi per pagina dopo un FloodWait: oltre, l'errore viene propagato
+MAX_PAGE_RETRIES = 5
 
 
 def load_whitelist(whitelist_path):
     """
-    Carica la whitelist dei mittenti validi dal file CSV.
+    Carica la whitelist dei mittenti validi (vedi utils.whitelist.load_sender_whitelist).
 
     Args:
         whitelist_path: Path al file CSV
 
     Returns:
-        Set di nomi paganti validi (studenti)
+        SenderWhitelist (anche vuota) o None se il file non esiste (nessun filtro)
     """
-    valid_senders = set()
+    return load_sender_whitelist(DB_PATH, whitelist_path)
 
-    if not whitelist_path.exists():
-        print(f"⚠️  File whitelist non trovato: {whitelist_path}")
-        print("    Tutti i pagamenti verranno processati.")
-        return None
 
-    try:
-        with open(whitelist_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # Solo i mittenti con studente=1 sono validi
-                if row.get('studente') == '1':
-                    valid_senders.add(row['nome_pagante'])
-
-        print(f"✅ Whitelist caricata: {len(valid_senders)} studenti validi")
-        return valid_senders
-    except Exception as e:
-        print(f"❌ Errore caricamento whitelist: {e}")
-        return None
+def ingest_message(cursor, msg, valid_senders, channel_id=CHANNEL_ID):
+    """
+    Parsa un messaggio Telegram e, se valido, lo inserisce come pagamento.
+
+    Usato dal servizio residente (payment_monitor.py) per i messaggi che
+    arrivano in tempo reale; le pagine di storico passano da prepare_payments.
 
+    Args:
+        cursor: Cursore SQLite
+        msg: Messaggio Telethon
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        channel_id: ID del canale del messaggio (per fonte_msg_id)
 
-def parse_payment_message(message_text, message_date):
+    Returns:
+        Tupla (esito, payment_data) con esito in
+        'inserted', 'skipped', 'filtered', 'error'
     """
-    Estrae i dati di pagamento da un messaggio SMS.
+    if not msg.text:
+        return 'error', None
+
+    # Archivio del messaggio grezzo (per reparse_messages.py)
+    fonte_msg_id = telegram_fonte_msg_id(channel_id, msg.id)
+    archive_messages(cursor, [(fonte_msg_id, msg.text, msg.date)])
+
+    # Parsing del messaggio
+    payment_data = parse_payment_message(msg.text, msg.date)
+
+    if not payment_data:
+        return 'error', None
+
+    # Filtra mittenti non validi (se whitelist è attiva)
+    if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
+        return 'filtered', payment_data
+
+    # Inserimento nel database (duplicati scartati da ON CONFLICT)
+    inserted, _ = insert_payments(cursor, [(payment_data, fonte_msg_id)])
+
+    if inserted:
+        return 'inserted', payment_data
+    return 'skipped', payment_data
+
+
+def prepare_payments(messages, channel_id, valid_senders, stats, verbose=False):
+    """
+    Parsa una pagina di messaggi e applica la whitelist.
 
     Args:
-        message_text: Testo del messaggio
-        message_date: Data del messaggio (datetime object)
+        messages: Messaggi Telethon con testo
+        channel_id: ID del canale (per fonte_msg_id)
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        stats: dict contatori (errors, filtered) aggiornato in place
+        verbose: Se True stampa ogni pagamento filtrato
 
     Returns:
-        dict con i dati estratti o None se il parsing fallisce
+        Lista di tuple (payment_data, fonte_msg_id) da passare a insert_payments
     """
-    match = SMS_PATTERN.search(message_text)
+    payments = []
+    parsed = parse_many((msg.text, msg.date) for msg in messages)
 
-    if not match:
-        return None
+    for msg, payment_data in zip(messages, parsed):
+        if not payment_data:
+            stats['errors'] += 1
+            continue
 
-    ora_hh = match.group(1)
-    ora_mm = match.group(2)
-    somma_str = match.group(3).strip()
-    nome_pagante = match.group(4).strip()
+        # Filtra mittenti non validi (se whitelist è attiva)
+        if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
+            stats['filtered'] += 1
+            if verbose:
+                print(f"🚫 Filtrato: {payment_data['nome_pagante']} - {payment_data['somma']}₽ (non è studente)")
+            continue
 
-    # Normalizza il nome (Title Case)
-    nome_pagante = nome_pagante.title()
+        payments.append((payment_data, telegram_fonte_msg_id(channel_id, msg.id)))
 
-    # Costruisci data dal message_date
-    giorno = message_date.strftime('%Y-%m-%d')
-    ora = f"{ora_hh.zfill(2)}:{ora_mm}:00"
+    return payments
 
-    # Rimuovi tutti gli spazi dalla somma (gestisce "10 000" -> "10000")
-    somma_clean = somma_str.replace(' ', '').replace('\xa0', '')  # Rimuove spazi normali e non-breaking spaces
 
-    try:
-        somma = float(somma_clean)
-    except ValueError:
-        print(f"⚠️  Errore conversione somma: '{somma_str}' -> '{somma_clean}'")
-        return None
-
-    return {
-        'nome_pagante': nome_pagante,
-        'giorno': giorno,
-        'ora': ora,
-        'somma': somma,
-        'valuta': 'RUB',
-        'stato': 'sospeso'
-    }
-
-
-def insert_payment(cursor, payment_data, message_id):
+async def connect_client():
     """
-    Inserisce un pagamento nel database con deduplicazione basata su message_id.
+    Crea e autentica il TelegramClient con la sessione salvata.
 
-    Args:
-        cursor: Cursore SQLite
-        payment_data: Dizionario con i dati del pagamento
-        message_id: ID del messaggio Telegram (per deduplicazione)
+    Returns:
+        TelegramClient connesso
+    """
+    # flood_sleep_threshold=0: Telethon non attende da solo i FloodWait, che arrivano
+    # come FloodWaitError al rate limiter adattivo
+    client = TelegramClient(str(SESSION_NAME), API_ID, API_HASH, flood_sleep_threshold=0)
+
+    # Start con callback per autenticazione interattiva
+    print("🔐 Autenticazione Telegram in corso...")
+    print(f"    Numero di telefono: {PHONE_NUMBER}\n")
+
+    await client.start(
+        phone=PHONE_NUMBER,
+        code_callback=lambda: VERIFICATION_CODE if VERIFICATION_CODE else input('Please enter the code you received: '),
+        password=lambda: TELEGRAM_PASSWORD if TELEGRAM_PASSWORD else input('Please enter your password: ')
+    )
+    print("✅ Client Telegram connesso\n")
+    return client
+
+
+def channel_cursor_source(channel_id):
+    """Nome della fonte in sync_status per il cursore di un canale."""
+    return f"telegram_channel_{channel_id}"
+
+
+def get_channel_cursor(conn, channel_id):
+    """
+    Legge l'id dell'ultimo messaggio elaborato per un canale.
+    Richiede la tabella sync_status (ensure_sync_status_table).
 
     Returns:
-        ID del record inserito/aggiornato o None se già esistente
+        int message_id o None se il canale non è mai stato letto
     """
-    fonte_msg_id = f"tg_{CHANNEL_ID}_{message_id}"
+    value = get_cursor(conn, channel_cursor_source(channel_id))
+    return int(value) if value is not None else None
 
-    try:
-        cursor.execute('''
-            INSERT INTO pagamenti
-            (nome_pagante, giorno, ora, somma, valuta, stato, fonte_msg_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            payment_data['nome_pagante'],
-            payment_data['giorno'],
-            payment_data['ora'],
-            payment_data['somma'],
-            payment_data['valuta'],
-            payment_data['stato'],
-            fonte_msg_id
-        ))
-        return cursor.lastrowid
-    except sqlite3.IntegrityError:
-        # Messaggio già processato (vincolo UNIQUE su fonte_msg_id)
-        return None
-
-
-async def fetch_channel_history(client, channel_id, limit=100):
+
+def advance_channel_cursor(conn, channel_id, message_id):
+    """
+    Avanza il cursore del canale a message_id (mai all'indietro).
+    NON esegue commit: va committato insieme ai pagamenti inseriti.
+    """
+    current = get_channel_cursor(conn, channel_id)
+    if current is None or message_id > current:
+        save_cursor(conn, channel_cursor_source(channel_id), message_id)
+
+
+def create_rate_limiter():
+    """
+    Budget globale di richieste per l'ingestione (un solo limiter per processo,
+    condiviso da tutti i canali). Pagine fisse da PAGE_SIZE messaggi.
+    """
+    return AdaptiveRateLimiter(
+        rate=REQUESTS_PER_SECOND,
+        max_rate=MAX_REQUESTS_PER_SECOND,
+        batch_size=PAGE_SIZE,
+        min_batch_size=PAGE_SIZE,
+        max_batch_size=PAGE_SIZE
+    )
+
+
+async def fetch_page(client, channel_id, limiter=None, **kwargs):
     """
-    Recupera lo storico messaggi da un canale usando Telethon.
+    Scarica una pagina di messaggi rispettando il budget globale.
+
+    Con un limiter, un FloodWaitError rallenta tutti i canali e la pagina
+    viene richiesta di nuovo (al massimo MAX_PAGE_RETRIES tentativi, poi l'errore
+    viene propagato); senza limiter l'errore viene propagato subito.
 
     Args:
         client: TelegramClient instance
         channel_id: ID del canale
-        limit: Numero massimo di messaggi da recuperare
+        limiter: AdaptiveRateLimiter condiviso (None = nessun limite)
+        **kwargs: Parametri di iter_messages (limit, min_id, reverse...)
 
     Returns:
         Lista di messaggi
     """
-    print(f"📥 Recupero messaggi dal canale {channel_id}...")
+    if limiter is None:
+        return [m async for m in client.iter_messages(channel_id, **kwargs)]
+
+    for attempt in range(1, MAX_PAGE_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            page = [m async for m in client.iter_messages(channel_id, wait_time=0, **kwargs)]
+        except FloodWaitError as e:
+            limiter.on_flood_wait(e.seconds)
+            if attempt == MAX_PAGE_RETRIES:
+                raise
+            print(f"⏳ FloodWait sul canale {channel_id}: attesa {e.seconds}s "
+                  f"(tentativo {attempt}/{MAX_PAGE_RETRIES})")
+            continue
+
+        limiter.on_success(len(page))
+        return page
+
+
+async def fetch_channel_history(client, channel_id, min_id=None, limit=PAGE_SIZE, limiter=None):
+    """
+    Recupera i messaggi nuovi di un canale, a pagine, dal più vecchio al più recente.
+
+    Con min_id usa il cursore: scarica SOLO i messaggi con id > min_id e continua
+    a paginare finché non ha raggiunto l'ultimo messaggio (nessun tetto a 100).
+    Un'ora senza messaggi costa una sola pagina vuota.
+    Senza min_id (prima esecuzione) recupera solo gli ultimi `limit` messaggi.
+
+    Args:
+        client: TelegramClient instance
+        channel_id: ID del canale
+        min_id: Id dell'ultimo messaggio già elaborato (None = prima esecuzione)
+        limit: Messaggi per pagina
+        limiter: AdaptiveRateLimiter condiviso tra i canali (None = nessun limite)
+
+    Yields:
+        Liste di messaggi (una per pagina), in ordine crescente di id.
+        Le pagine includono anche i messaggi senza testo, per far avanzare il cursore.
+    """
+    if min_id is None:
+        print(f"📥 Prima lettura del canale {channel_id}: ultimi {limit} messaggi...")
+        page = await fetch_page(client, channel_id, limiter, limit=limit)
+        page.reverse()
+        if page:
+            yield page
+        return
+
+    print(f"📥 Recupero messaggi dal canale {channel_id} dopo id {min_id}...")
+
+    while True:
+        page = await fetch_page(
+            client, channel_id, limiter,
+            limit=limit,
+            min_id=min_id,
+            reverse=True  # Dal più vecchio al più recente
+        )
+
+        if not page:
+            break
+
+        yield page
+        min_id = page[-1].id
+
+        # Pagina parziale: siamo in pari con il canale
+        if len(page) < limit:
+            break
+
+
+async def ingest_new_messages(client, channel_id, valid_senders, conn, verbose=True, limiter=None):
+    """
+    Scarica i messaggi successivi al cursore del canale e li inserisce nel DB.
+    Cursore e pagamenti vengono committati insieme dopo ogni pagina.
+
+    Args:
+        client: TelegramClient connesso
+        channel_id: ID del canale
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        conn: Connessione SQLite
+        verbose: Se True stampa ogni pagamento inserito/filtrato
+        limiter: AdaptiveRateLimiter condiviso tra i canali (None = nessun limite)
+
+    Returns:
+        dict con contatori: found, inserted, skipped, filtered, errors
+    """
+    stats = {'found': 0, 'inserted': 0, 'skipped': 0, 'filtered': 0, 'errors': 0}
+    ensure_content_hash_column(conn)
+    ensure_archive_table(conn)
+    # Una volta sola: ensure_* esegue commit, nel ciclo committerebbe i pagamenti senza cursore
+    ensure_sync_status_table(conn)
+    cursor = conn.cursor()
+    min_id = get_channel_cursor(conn, channel_id)
 
     try:
-        messages = []
-        async for message in client.iter_messages(channel_id, limit=limit):
-            if message.text:
-                messages.append(message)
+        async for page in fetch_channel_history(client, channel_id, min_id=min_id, limiter=limiter):
+            messages = [msg for msg in page if msg.text]
+            stats['found'] += len(messages)
+
+            # Archivio dei messaggi grezzi, anche quelli non riconosciuti dal parser
+            archive_messages(cursor, [
+                (telegram_fonte_msg_id(channel_id, msg.id), msg.text, msg.date) for msg in messages
+            ])
 
-        print(f"✅ Trovati {len(messages)} messaggi con testo")
-        return messages
+            # Un solo INSERT set-based per pagina, nella stessa transazione del cursore
+            payments = prepare_payments(messages, channel_id, valid_senders, stats, verbose=verbose)
+            inserted, duplicates = insert_payments(cursor, payments)
+            stats['inserted'] += inserted
+            stats['skipped'] += duplicates
+
+            if verbose and inserted:
+                print(f"✅ Inseriti {inserted} pagamenti ({duplicates} già presenti)")
+
+            advance_channel_cursor(conn, channel_id, page[-1].id)
+            conn.commit()
 
     except Exception as e:
         print(f"❌ Errore nel recuperare messaggi: {e}")
-        return []
+
+    print(f"✅ Canale {channel_id}: trovati {stats['found']} messaggi nuovi con testo")
+    return stats
+
+
+async def ingest_channels(client, channel_ids, valid_senders, db_path=DB_PATH, verbose=True, limiter=None):
+    """
+    Ingestione concorrente di più canali sullo stesso TelegramClient.
+
+    Ogni canale ha il suo cursore e la sua connessione SQLite; le richieste
+    passano tutte dallo stesso limiter, che divide il budget tra i canali.
+    Il tempo totale è vicino a quello del canale più lento, non alla somma.
+
+    Args:
+        client: TelegramClient connesso
+        channel_ids: Lista di ID canale
+        valid_senders: Whitelist mittenti, SenderWhitelist o set (None = nessun filtro)
+        db_path: Path del database
+        verbose: Se True stampa ogni pagamento inserito/filtrato
+        limiter: AdaptiveRateLimiter condiviso (None = ne crea uno)
+
+    Returns:
+        dict {channel_id: stats}
+    """
+    if limiter is None:
+        limiter = create_rate_limiter()
+
+    async def ingest_one(channel_id):
+        conn = sqlite3.connect(db_path)
+        try:
+            return await ingest_new_messages(
+                client, channel_id, valid_senders, conn, verbose=verbose, limiter=limiter
+            )
+        finally:
+            conn.close()
+
+    results = await asyncio.gather(*(ingest_one(channel_id) for channel_id in channel_ids))
+    return dict(zip(channel_ids, results))
 
 
 async def main():
@@ -187,14 +379,14 @@ async def main():
         print("❌ API_ID o API_HASH non trovati nel file .env")
         return
 
-    if not CHANNEL_ID:
-        print("❌ CHANNEL_ID non trovato nel file .env")
+    if not CHANNEL_IDS:
+        print("❌ CHANNEL_ID (o CHANNEL_IDS) non trovato nel file .env")
         return
 
     print("="*60)
     print("INGESTORE PAGAMENTI - Componente 1")
     print("="*60)
-    print(f"Canale: {CHANNEL_ID}")
+    print(f"Canali: {', '.join(str(c) for c in CHANNEL_IDS)}")
     print(f"Database: {DB_PATH}")
     print("="*60 + "\n")
 
@@ -202,80 +394,34 @@ async def main():
     valid_senders = load_whitelist(WHITELIST_PATH)
     print()
 
-    # Connessione al database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Inizializza Telethon client
-    client = TelegramClient(str(SESSION_NAME), API_ID, API_HASH)
-
-    # Start con callback per autenticazione interattiva
-    print("🔐 Autenticazione Telegram in corso...")
-    print(f"    Numero di telefono: {PHONE_NUMBER}\n")
-
-    await client.start(
-        phone=PHONE_NUMBER,
-        code_callback=lambda: VERIFICATION_CODE if VERIFICATION_CODE else input('Please enter the code you received: '),
-        password=lambda: TELEGRAM_PASSWORD if TELEGRAM_PASSWORD else input('Please enter your password: ')
-    )
-    print("✅ Client Telegram connesso\n")
-
-    # Recupera messaggi
-    messages = await fetch_channel_history(client, CHANNEL_ID, limit=100)
+    # Inizializza e autentica Telethon client
+    client = await connect_client()
 
-    if not messages:
-        print("\n⚠️  Nessun messaggio disponibile.")
-        await client.disconnect()
-        conn.close()
-        return
-
-    # Processa messaggi
-    inserted_count = 0
-    skipped_count = 0
-    error_count = 0
-    filtered_count = 0
-
-    print("\n📝 Processamento messaggi...\n")
-
-    for msg in messages:
-        # Parsing del messaggio
-        payment_data = parse_payment_message(msg.text, msg.date)
-
-        if not payment_data:
-            error_count += 1
-            continue
-
-        # Filtra mittenti non validi (se whitelist è attiva)
-        if valid_senders is not None and payment_data['nome_pagante'] not in valid_senders:
-            filtered_count += 1
-            print(f"🚫 Filtrato: {payment_data['nome_pagante']} - {payment_data['somma']}₽ (non è studente)")
-            continue
-
-        # Inserimento nel database
-        record_id = insert_payment(cursor, payment_data, msg.id)
-
-        if record_id:
-            inserted_count += 1
-            print(f"✅ Inserito: {payment_data['nome_pagante']} - {payment_data['somma']}₽ - {payment_data['giorno']} {payment_data['ora']}")
-        else:
-            skipped_count += 1
-
-    # Commit delle modifiche
-    conn.commit()
-    conn.close()
+    # Recupera e processa solo i messaggi nuovi (dal cursore di ogni canale), in parallelo
+    print("📝 Processamento messaggi...\n")
+    per_channel = await ingest_channels(client, CHANNEL_IDS, valid_senders)
 
     # Disconnetti client
     await client.disconnect()
 
+    stats = {key: sum(s[key] for s in per_channel.values()) for key in ('found', 'inserted', 'skipped', 'filtered', 'errors')}
+
+    if not stats['found']:
+        print("\n⚠️  Nessun messaggio nuovo disponibile.")
+
     # Riepilogo
     print("\n" + "="*60)
     print("RIEPILOGO")
     print("="*60)
-    print(f"Messaggi trovati: {len(messages)}")
-    print(f"Pagamenti inseriti: {inserted_count}")
-    print(f"Già esistenti (saltati): {skipped_count}")
-    print(f"Filtrati (non studenti): {filtered_count}")
-    print(f"Errori di parsing: {error_count}")
+    if len(per_channel) > 1:
+        for channel_id, channel_stats in per_channel.items():
+            print(f"Canale {channel_id}: {channel_stats['inserted']} inseriti su {channel_stats['found']} messaggi")
+        print("-"*60)
+    print(f"Messaggi trovati: {stats['found']}")
+    print(f"Pagamenti inseriti: {stats['inserted']}")
+    print(f"Già esistenti (saltati): {stats['skipped']}")
+    print(f"Filtrati (non studenti): {stats['filtered']}")
+    print(f"Errori di parsing: {stats['errors']}")
     print("="*60)
 
 
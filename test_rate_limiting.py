@@ -1,116 +1,225 @@
 #!/usr/bin/env python
 """
-Script di test per verificare la logica di rate limiting.
-Simula lo scaricamento di messaggi con batch e delay.
-"""
-import asyncio
-import time
+Benchmark del rate limiting per lo scaricamento storico da Telegram.
 
+Confronta la strategia FISSA (100 msg/batch, 3s di pausa) con il limiter
+ADATTIVO (utils/rate_limiter.py) contro un client Telegram finto che applica
+un proprio limite di richieste e risponde con FloodWaitError quando viene superato.
 
-BATCH_SIZE = 10  # Piccolo per test veloce
-DELAY_BETWEEN_BATCHES = 2  # 2 secondi per test
+Il download è quello vero (telegram_bulk_ingestor.download_batches e fetch_batch,
+con i loro retry): cambia solo il client.
 
+Il tempo è simulato (orologio virtuale): 1M di messaggi si misurano in pochi secondi
+reali, riportando il tempo di backfill che si avrebbe con il vero Telegram.
+"""
+import io
+import sys
+import time
+import asyncio
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
 
-async def simulate_telegram_fetch(total_messages=35):
-    """
-    Simula il fetch da Telegram con rate limiting.
+from telethon.errors import FloodWaitError
 
-    Args:
-        total_messages: Numero totale di messaggi da simulare
-    """
-    print(f"📥 Simulazione fetch di {total_messages} messaggi")
-    print(f"   Rate limiting: {BATCH_SIZE} msg/batch, {DELAY_BETWEEN_BATCHES}s delay\n")
+from utils.rate_limiter import AdaptiveRateLimiter, MESSAGES_PER_REQUEST
+import telegram_bulk_ingestor
 
-    messages = []
-    message_count = 0
-    batch_count = 0
-    offset = 0
+# Volumi da misurare
+BENCHMARK_SIZES = [10_000, 100_000, 1_000_000]
 
-    while offset < total_messages:
-        batch_count += 1
-        batch_start = time.time()
+# Modello del server Telegram finto
+SERVER_RATE = 4.0  # Richieste/secondo sostenute prima del FloodWait
+SERVER_BURST = 20  # Richieste consecutive tollerate
+FLOOD_WAIT_SECONDS = 10  # Attesa imposta dal FloodWait
+REQUEST_LATENCY = 0.15  # Latenza di rete per richiesta (secondi)
 
-        print(f"   📦 Batch #{batch_count}: scaricamento fino a {BATCH_SIZE} messaggi...")
+# Strategia fissa attuale (telegram_bulk_ingestor.py prima del limiter adattivo)
+FIXED_BATCH_SIZE = 100
+FIXED_DELAY = 3
 
-        # Simula scaricamento batch
-        await asyncio.sleep(0.5)  # Simula network latency
+# Data del messaggio con id 1 (gli id successivi sono un secondo dopo l'altro)
+FIRST_MESSAGE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
 
-        # Calcola quanti messaggi in questo batch
-        remaining = total_messages - offset
-        batch_size = min(BATCH_SIZE, remaining)
 
-        # "Scarica" messaggi
-        for i in range(batch_size):
-            messages.append(f"msg_{offset + i}")
+class VirtualClock:
+    """Orologio simulato: sleep() avanza il tempo senza attendere davvero."""
 
-        offset += batch_size
-        message_count += batch_size
+    def __init__(self):
+        self.now = 0.0
 
-        print(f"   ✅ Batch #{batch_count}: {batch_size} messaggi (totale: {message_count})")
+    def time(self):
+        return self.now
 
-        # Se abbiamo finito, esci
-        if offset >= total_messages:
-            print(f"   ✅ Tutti i messaggi scaricati.")
-            break
+    async def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+        await asyncio.sleep(0)
 
-        # Rate limiting: pausa tra batch
-        batch_duration = time.time() - batch_start
-        if batch_duration < DELAY_BETWEEN_BATCHES:
-            sleep_time = DELAY_BETWEEN_BATCHES - batch_duration
-            print(f"   ⏳ Pausa {sleep_time:.1f}s (rate limiting)...")
-            await asyncio.sleep(sleep_time)
 
-    print(f"\n✅ Completato: {len(messages)} messaggi in {batch_count} batch")
+class FakeMessage:
+    """Messaggio minimo: id, data e testo, i campi letti da download_batches."""
+    __slots__ = ('id', 'date', 'text')
 
-    # Calcola tempo totale e rate
-    total_time = batch_count * DELAY_BETWEEN_BATCHES
-    rate = len(messages) / total_time if total_time > 0 else 0
+    def __init__(self, message_id):
+        self.id = message_id
+        self.date = FIRST_MESSAGE_DATE + timedelta(seconds=message_id)
+        self.text = 'x'
 
-    print(f"\n📊 STATISTICHE:")
-    print(f"   Messaggi totali: {len(messages)}")
-    print(f"   Batch eseguiti: {batch_count}")
-    print(f"   Tempo stimato: ~{total_time:.1f}s")
-    print(f"   Rate: ~{rate:.1f} msg/s")
-    print(f"   Rate Telegram limit: 20 req/s ✅" if rate < 20 else "   ⚠️ Rate troppo alto!")
 
+class FakeTelegramClient:
+    """
+    Client finto con limite di richieste lato server (token bucket) e FloodWait.
 
-async def test_floodwait_handling():
-    """Simula gestione FloodWait."""
-    print("\n" + "="*60)
-    print("TEST GESTIONE FLOODWAIT")
-    print("="*60 + "\n")
+    Espone iter_messages con la stessa firma usata da telegram_bulk_ingestor.py:
+    messaggi dal più recente al più vecchio, offset_id esclusivo, max 100 per richiesta.
+    """
+
+    def __init__(self, total_messages, clock):
+        self.total_messages = total_messages
+        self.clock = clock
+        self.tokens = SERVER_BURST
+        self.last_refill = clock.time()
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.flood_waits = 0
+
+    def _check_rate(self):
+        """Simula il limite del server: solleva FloodWaitError se superato."""
+        now = self.clock.time()
+        if now < self.blocked_until:
+            raise FloodWaitError(request=None, capture=int(self.blocked_until - now) + 1)
+
+        self.tokens = min(SERVER_BURST, self.tokens + (now - self.last_refill) * SERVER_RATE)
+        self.last_refill = now
+
+        if self.tokens < 1:
+            self.flood_waits += 1
+            self.blocked_until = now + FLOOD_WAIT_SECONDS
+            raise FloodWaitError(request=None, capture=FLOOD_WAIT_SECONDS)
+
+        self.tokens -= 1
+        self.requests += 1
+
+    async def iter_messages(self, channel_id, limit=None, offset_id=0, reverse=False, wait_time=None):
+        next_id = (offset_id - 1) if offset_id else self.total_messages
+        remaining = limit
+
+        while remaining > 0 and next_id > 0:
+            # Una richiesta GetHistory per ogni blocco da 100
+            self._check_rate()
+            await self.clock.sleep(REQUEST_LATENCY)
+
+            chunk = min(remaining, MESSAGES_PER_REQUEST)
+            for message_id in range(next_id, max(0, next_id - chunk), -1):
+                yield FakeMessage(message_id)
+            next_id -= chunk
+            remaining -= chunk
+
+
+async def backfill(client, limiter):
+    """
+    Scarica tutto lo storico del client finto con telegram_bulk_ingestor.download_batches
+    (un consumer conta i messaggi al posto dell'inserimento nel DB).
 
-    print("📦 Batch #1: scaricamento...")
-    await asyncio.sleep(0.5)
-    print("✅ Batch #1: 10 messaggi")
+    Returns:
+        Numero di messaggi scaricati
+    """
+    queue = asyncio.Queue(maxsize=telegram_bulk_ingestor.QUEUE_MAX_BATCHES)
+    downloaded = 0
+
+    async def count_batches():
+        nonlocal downloaded
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            downloaded += len(item[0])
+
+    consumer = asyncio.create_task(count_batches())
+    # I messaggi di avanzamento e FloodWait del downloader non servono nel report
+    with redirect_stdout(io.StringIO()):
+        await telegram_bulk_ingestor.download_batches(
+            client, 'bench', FIRST_MESSAGE_DATE, datetime.max.replace(tzinfo=timezone.utc),
+            queue, limiter
+        )
+    await consumer
+    return downloaded
+
+
+def fixed_limiter(clock):
+    """Strategia fissa: 100 msg ogni 3 secondi, senza crescita."""
+    return AdaptiveRateLimiter(
+        rate=1 / FIXED_DELAY, batch_size=FIXED_BATCH_SIZE, max_batch_size=FIXED_BATCH_SIZE,
+        grow_after=sys.maxsize, clock=clock.time, sleep=clock.sleep
+    )
+
+
+def adaptive_limiter(clock):
+    """Limiter adattivo con gli stessi valori di telegram_bulk_ingestor.create_rate_limiter."""
+    return AdaptiveRateLimiter(
+        rate=1 / telegram_bulk_ingestor.DELAY_BETWEEN_BATCHES,
+        max_rate=telegram_bulk_ingestor.MAX_REQUESTS_PER_SECOND,
+        batch_size=telegram_bulk_ingestor.BATCH_SIZE,
+        min_batch_size=telegram_bulk_ingestor.BATCH_SIZE,
+        max_batch_size=telegram_bulk_ingestor.MAX_BATCH_SIZE,
+        clock=clock.time, sleep=clock.sleep
+    )
+
+
+async def run_benchmark(total_messages, limiter_factory):
+    """
+    Esegue un backfill simulato.
 
-    print("\n⚠️  SIMULATING FloodWaitError: attendo 5s...")
-    wait_time = 5
-    for i in range(wait_time, 0, -1):
-        print(f"   ⏳ {i}s...", end='\r')
-        await asyncio.sleep(1)
-    print("\n✅ Attesa completata, ripresa scaricamento")
+    Returns:
+        dict report del limiter + messaggi, richieste lato server, secondi reali
+    """
+    clock = VirtualClock()
+    client = FakeTelegramClient(total_messages, clock)
+    limiter = limiter_factory(clock)
 
-    print("\n📦 Batch #2: scaricamento...")
-    await asyncio.sleep(0.5)
-    print("✅ Batch #2: 10 messaggi")
+    wall_start = time.perf_counter()
+    downloaded = await backfill(client, limiter)
+    wall = time.perf_counter() - wall_start
 
+    report = limiter.report()
+    report['downloaded'] = downloaded
+    report['server_requests'] = client.requests
+    report['wall'] = wall
+    assert downloaded == total_messages, f"scaricati {downloaded}/{total_messages}"
+    return report
 
-async def main():
-    """Test principale."""
-    print("="*60)
-    print("TEST RATE LIMITING - TELEGRAM BULK INGESTOR")
-    print("="*60 + "\n")
 
-    # Test 1: Scaricamento normale con rate limiting
-    await simulate_telegram_fetch(total_messages=35)
+def format_duration(seconds):
+    """Formatta secondi come 1h 02m 03s."""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {secs:02d}s"
+    return f"{minutes}m {secs:02d}s"
 
-    # Test 2: Gestione FloodWait
-    await test_floodwait_handling()
 
-    print("\n" + "="*60)
-    print("✅ TUTTI I TEST COMPLETATI")
-    print("="*60)
+async def main():
+    """Benchmark principale."""
+    print("="*78)
+    print("BENCHMARK RATE LIMITING - TELEGRAM BULK INGESTOR")
+    print("="*78)
+    print(f"Server finto: {SERVER_RATE} req/s sostenute, burst {SERVER_BURST}, "
+          f"FloodWait {FLOOD_WAIT_SECONDS}s, latenza {REQUEST_LATENCY}s")
+    print("="*78 + "\n")
+
+    print(f"{'Messaggi':>10} | {'Strategia':<9} | {'Backfill':>12} | {'msg/s':>7} | "
+          f"{'req/s':>6} | {'FloodWait':>9} | {'Reale':>6}")
+    print("-"*78)
+
+    for total in BENCHMARK_SIZES:
+        for name, factory in (('fissa', fixed_limiter), ('adattiva', adaptive_limiter)):
+            r = await run_benchmark(total, factory)
+            print(f"{total:>10,} | {name:<9} | {format_duration(r['elapsed']):>12} | "
+                  f"{r['msg_per_sec']:>7.1f} | {r['req_per_sec']:>6.2f} | "
+                  f"{r['flood_waits']:>9} | {r['wall']:>5.1f}s")
+        print("-"*78)
+
+    print("\n✅ BENCHMARK COMPLETATO")
 
 
 if __name__ == "__main__":
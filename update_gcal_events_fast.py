@@ -3,16 +3,20 @@
 Script VELOCE per aggiornare Google Calendar in batch:
 1. Rinomina titoli con nomi standardizzati
 2. Colora di BLU (colorId=9) le lezioni completamente pagate
+
+Le modifiche vengono inviate in batch (fino a 50 patch per richiesta HTTP,
+utils/gcal_batch.py), con esito e retry per singolo evento.
 """
 import os
 import sqlite3
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client
+from utils.gcal_batch import execute_batch
+
 # Configurazione
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -32,10 +36,7 @@ END_DATE = datetime.now()
 
 def get_calendar_service():
     """Crea servizio Google Calendar."""
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE), scopes=SCOPES
-    )
-    return build('calendar', 'v3', credentials=credentials)
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def get_lessons_map(db_path):
@@ -91,23 +92,22 @@ def update_events_batch(service, calendar_id, lessons_map, start_date, end_date)
     print(f"   Range: {start_date.strftime('%Y-%m-%d')} → {end_date.strftime('%Y-%m-%d')}\n")
 
     try:
-        # Recupera TUTTI gli eventi in un colpo solo
+        # Recupera TUTTI gli eventi (tutte le pagine, solo i campi usati)
         time_min = start_date.replace(hour=0, minute=0, second=0).isoformat() + 'Z'
         time_max = end_date.replace(hour=23, minute=59, second=59).isoformat() + 'Z'
 
-        events_result = service.events().list(
-            calendarId=calendar_id,
+        events = list(gcal_client.iter_events(
+            service, calendar_id,
+            fields='id,summary,colorId',
             timeMin=time_min,
             timeMax=time_max,
             singleEvents=True,
-            orderBy='startTime',
-            maxResults=2500
-        ).execute()
-
-        events = events_result.get('items', [])
+            orderBy='startTime'
+        ))
         print(f"✅ Trovati {len(events)} eventi\n")
         print("🔄 Aggiornamento in corso...\n")
 
+        patches = []
         for event in events:
             stats['total'] += 1
             event_id = event['id']
@@ -120,39 +120,42 @@ def update_events_batch(service, calendar_id, lessons_map, start_date, end_date)
             nome_atteso = lesson['nome']
             is_paid = lesson['is_paid']
 
-            # Determina aggiornamenti necessari
-            needs_update = False
+            # Determina aggiornamenti necessari (patch dei soli campi cambiati:
+            # l'evento è stato letto con una field mask parziale)
+            changes = {}
             current_title = event.get('summary', '')
             current_color = event.get('colorId', None)
 
             # Titolo
             if current_title != nome_atteso:
-                event['summary'] = nome_atteso
-                needs_update = True
+                changes['summary'] = nome_atteso
                 stats['renamed'] += 1
                 print(f"  ✏️  '{current_title}' → '{nome_atteso}'")
 
             # Colore (solo se pagato)
             if is_paid and current_color != COLOR_PAID:
-                event['colorId'] = COLOR_PAID
-                needs_update = True
+                changes['colorId'] = COLOR_PAID
                 stats['colored'] += 1
                 print(f"  🔵 Colorato BLU: {nome_atteso}")
 
-            # Applica update se necessario
-            if needs_update:
-                try:
-                    service.events().update(
-                        calendarId=calendar_id,
-                        eventId=event_id,
-                        body=event
-                    ).execute()
-                except HttpError as e:
-                    stats['errors'] += 1
-                    print(f"  ❌ Errore {event_id}: {e}")
+            # Update da applicare (in batch, sotto)
+            if changes:
+                patches.append((event_id, service.events().patch(
+                    calendarId=calendar_id,
+                    eventId=event_id,
+                    body=changes,
+                    fields='id'
+                )))
             else:
                 stats['unchanged'] += 1
 
+        if patches:
+            print(f"\n📤 Invio {len(patches)} modifiche in batch...")
+        for event_id, (_, error) in execute_batch(service, patches).items():
+            if error is not None:
+                stats['errors'] += 1
+                print(f"  ❌ Errore {event_id}: {error}")
+
     except HttpError as error:
         print(f"❌ Errore nell'accesso al calendario: {error}")
         return None
@@ -6,7 +6,9 @@ Aggiorna SOLO le lezioni che hanno cambiato stato di pagamento dall'ultimo aggio
 Strategia:
 1. Legge timestamp ultimo aggiornamento dal DB (sync_status)
 2. Trova lezioni modificate dopo quel timestamp (updated_at)
-3. Aggiorna solo gli eventi modificati (titolo e colore)
+3. Confronta titolo e colore con la copia locale degli eventi (calendar_events,
+   riempita dal sync) e scrive su Calendar solo gli eventi diversi (patch con If-Match,
+   in batch da 50 per richiesta HTTP)
 4. Salva nuovo timestamp nel DB
 
 IMPORTANTE: Colora BLU solo le lezioni COMPLETAMENTE PAGATE (quota_pagata >= costo)
@@ -16,10 +18,11 @@ import sqlite3
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from utils import gcal_client
+from utils.calendar_mirror import ensure_calendar_events_table, load_events, write_events_changes
+
 # Configurazione
 env_path = Path(__file__).parent / '.env'
 load_dotenv(env_path)
@@ -35,10 +38,7 @@ COLOR_DEFAULT = '1'  # Lavanda (default)
 
 def get_calendar_service():
     """Crea servizio Google Calendar."""
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE), scopes=SCOPES
-    )
-    return build('calendar', 'v3', credentials=credentials)
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def get_last_update_timestamp():
@@ -181,83 +181,65 @@ def get_modified_lessons(db_path, since_timestamp):
     return lessons_map
 
 
-def update_event_incremental(service, calendar_id, event_id, lesson_data):
+def update_events_incremental(service, calendar_id, conn, events, lessons_map):
     """
-    Aggiorna un singolo evento in modo incrementale.
+    Aggiorna titolo e colore degli eventi delle lezioni modificate.
+    Le scritture necessarie viaggiano in batch (fino a 50 per richiesta HTTP).
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        conn: Connessione SQLite (copia locale degli eventi)
+        events: Eventi dalla copia locale (load_events)
+        lessons_map: Lezioni da get_modified_lessons
 
     Returns:
-        dict: {'renamed': bool, 'colored': bool, 'unchanged': bool, 'error': str, 'skipped_future': bool}
+        dict: {event_id: {'renamed': bool, 'colored': bool, 'unchanged': bool, 'error': str, 'skipped_future': bool}}
     """
-    result = {
-        'renamed': False,
-        'colored': False,
-        'unchanged': False,
-        'error': None,
-        'skipped_future': False
-    }
+    results = {}
+    to_write = []
+    oggi = datetime.now().date().isoformat()
 
-    try:
-        # Recupera evento corrente
-        event = service.events().get(
-            calendarId=calendar_id,
-            eventId=event_id
-        ).execute()
+    for event_id in lessons_map:
+        result = results[event_id] = {
+            'renamed': False,
+            'colored': False,
+            'unchanged': False,
+            'error': None,
+            'skipped_future': False
+        }
 
+        event = events.get(event_id)
+        if event is None:
+            result['error'] = 'not_found'
         # CONTROLLO DATA: Salta eventi futuri (dopo oggi)
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        if 'T' in start:
-            event_date = datetime.fromisoformat(start.replace('Z', '+00:00')).date()
-        else:
-            event_date = datetime.fromisoformat(start).date()
-
-        oggi = datetime.now().date()
-        if event_date > oggi:
+        elif event['giorno'] and event['giorno'] > oggi:
             result['skipped_future'] = True
-            return result
-
-        nome_atteso = lesson_data['nome']
-        is_paid = lesson_data['is_paid']
-
-        # Determina aggiornamenti necessari
-        needs_update = False
-        current_title = event.get('summary', '')
-        current_color = event.get('colorId', None)
-
-        # 1. Verifica titolo
-        if current_title != nome_atteso:
-            event['summary'] = nome_atteso
-            needs_update = True
-            result['renamed'] = True
-
-        # 2. Verifica colore
-        target_color = COLOR_PAID if is_paid else COLOR_DEFAULT
-        if current_color != target_color:
-            event['colorId'] = target_color
-            needs_update = True
-            if is_paid:
-                result['colored'] = True
-
-        # Applica update se necessario
-        if needs_update:
-            service.events().update(
-                calendarId=calendar_id,
-                eventId=event_id,
-                body=event
-            ).execute()
         else:
-            result['unchanged'] = True
+            to_write.append(event)
 
-        return result
+    def compute_changes(current):
+        lesson_data = lessons_map[current['id']]
+        target_color = COLOR_PAID if lesson_data['is_paid'] else COLOR_DEFAULT
+        changes = {}
+        if current['summary'] != lesson_data['nome']:
+            changes['summary'] = lesson_data['nome']
+        if current['colorId'] != target_color:
+            changes['colorId'] = target_color
+        return changes
 
-    except HttpError as e:
-        if e.resp.status == 404:
-            result['error'] = 'not_found'
-        else:
-            result['error'] = str(e)
-        return result
-    except Exception as e:
-        result['error'] = str(e)
-        return result
+    for event_id, changes in write_events_changes(
+            service, calendar_id, conn, to_write, compute_changes).items():
+        result = results[event_id]
+        if isinstance(changes, HttpError):
+            result['error'] = 'not_found' if changes.resp.status in (404, 410) else str(changes)
+            continue
+
+        result['renamed'] = 'summary' in changes
+        result['colored'] = changes.get('colorId') == COLOR_PAID
+        result['unchanged'] = not changes
+
+    return results
 
 
 def main():
@@ -304,6 +286,12 @@ def main():
     print(f"   - Da colorare BLU: {paid_count}")
     print(f"   - Altre: {len(lessons_map) - paid_count}")
 
+    # Stato attuale degli eventi dalla copia locale (API solo per quelli mancanti)
+    conn = sqlite3.connect(DB_PATH)
+    ensure_calendar_events_table(conn)
+    events = load_events(service, CALENDAR_ID, conn, lessons_map.keys())
+    print(f"📋 Eventi nella copia locale: {len(events)}/{len(lessons_map)}")
+
     # Aggiorna eventi modificati
     print("\n🔄 Aggiornamento eventi modificati...\n")
 
@@ -317,15 +305,11 @@ def main():
         'skipped_future': 0
     }
 
-    for i, (event_id, lesson_data) in enumerate(lessons_map.items(), 1):
-        nome = lesson_data['nome']
-        is_paid = lesson_data['is_paid']
-
-        # Progress ogni 10
-        if i % 10 == 0:
-            print(f"   📊 Processati {i}/{len(lessons_map)} eventi...")
+    results = update_events_incremental(service, CALENDAR_ID, conn, events, lessons_map)
 
-        result = update_event_incremental(service, CALENDAR_ID, event_id, lesson_data)
+    for event_id, lesson_data in lessons_map.items():
+        nome = lesson_data['nome']
+        result = results[event_id]
 
         if result['error']:
             if result['error'] == 'not_found':
@@ -349,6 +333,10 @@ def main():
         else:
             stats['unchanged'] += 1
 
+    # Copia locale aggiornata con gli eventi scritti
+    conn.commit()
+    conn.close()
+
     # Salva timestamp aggiornamento
     save_update_timestamp()
 
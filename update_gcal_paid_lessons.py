@@ -4,13 +4,19 @@ Script per aggiornare Google Calendar:
 1. Normalizza nomi studenti negli eventi
 2. Aggiunge nota "PAGATO" alle lezioni completamente pagate
 3. Cambia colore a blu (colorId=9) per lezioni pagate
+
+Lo stato attuale degli eventi viene letto dalla copia locale (calendar_events,
+riempita dal sync): l'API viene chiamata solo per gli eventi da modificare
+(patch con If-Match sull'etag) e per quelli mancanti nella copia, in batch da
+50 richieste per scambio HTTP.
 """
 import os
 import sqlite3
 from pathlib import Path
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+
+from utils import gcal_client
+from utils.calendar_mirror import ensure_calendar_events_table, load_events, write_events_changes
 
 # Configurazione
 env_path = Path(__file__).parent / '.env'
@@ -34,12 +40,7 @@ def get_calendar_service():
         print(f"❌ File Service Account non trovato: {SERVICE_ACCOUNT_FILE}")
         return None
 
-    credentials = service_account.Credentials.from_service_account_file(
-        str(SERVICE_ACCOUNT_FILE),
-        scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=credentials)
-    return service
+    return gcal_client.get_calendar_service(SERVICE_ACCOUNT_FILE, SCOPES)
 
 
 def get_paid_lessons():
@@ -116,41 +117,43 @@ def get_all_lessons():
     return all_lessons
 
 
-def update_event(service, event_id, updates):
+def update_events(service, conn, events, compute_changes):
     """
-    Aggiorna un evento su Google Calendar.
+    Aggiorna eventi su Google Calendar (solo i campi cambiati, in batch).
 
     Args:
         service: Google Calendar service
-        event_id: ID dell'evento
-        updates: Dict con campi da aggiornare
+        conn: Connessione SQLite (copia locale degli eventi)
+        events: Eventi dalla copia locale (load_events)
+        compute_changes: Funzione evento → dict campi da aggiornare
 
     Returns:
-        bool: True se successo
+        dict event_id → campi aggiornati ({} se già aggiornato, None in caso di errore)
     """
-    try:
-        # Recupera evento esistente
-        event = service.events().get(
-            calendarId=CALENDAR_ID,
-            eventId=event_id
-        ).execute()
+    results = write_events_changes(service, CALENDAR_ID, conn, events, compute_changes)
+
+    for event_id, result in results.items():
+        if isinstance(result, Exception):
+            print(f"    ❌ Errore aggiornamento evento {event_id}: {result}")
+            results[event_id] = None
+
+    return results
 
-        # Applica aggiornamenti
-        for key, value in updates.items():
-            event[key] = value
 
-        # Aggiorna su Google Calendar
-        updated_event = service.events().update(
-            calendarId=CALENDAR_ID,
-            eventId=event_id,
-            body=event
-        ).execute()
+def paid_changes(event):
+    """Nota "PAGATO" e colore blu mancanti in un evento."""
+    updates = {}
+    current_description = event['description']
 
-        return True
+    # Aggiungi "PAGATO" se non presente
+    if 'PAGATO' not in current_description:
+        updates['description'] = f"PAGATO\n{current_description}" if current_description else "PAGATO"
 
-    except Exception as e:
-        print(f"    ❌ Errore aggiornamento evento {event_id}: {e}")
-        return False
+    # Cambia colore a blu se non è già blu
+    if event['colorId'] != PAID_COLOR:
+        updates['colorId'] = PAID_COLOR
+
+    return updates
 
 
 def main():
@@ -191,65 +194,60 @@ def main():
     print()
     print("🔄 Aggiornamento in corso...\n")
 
+    # Stato attuale degli eventi dalla copia locale (API solo per quelli mancanti)
+    conn = sqlite3.connect(DB_PATH)
+    ensure_calendar_events_table(conn)
+    events = load_events(service, CALENDAR_ID, conn, all_lessons.keys() | paid_lessons.keys())
+
     # Step 1: Normalizza tutti i nomi
     print("📝 Step 1: Normalizzazione nomi studenti...")
     normalized_count = 0
-    for event_id, lesson in all_lessons.items():
-        current_name = lesson['nome_studente']
-
-        try:
-            # Recupera evento da Google Calendar
-            event = service.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-            event_summary = event.get('summary', '')
-
-            # Se il nome è diverso, aggiorna
-            if event_summary != current_name:
-                updates = {'summary': current_name}
-                if update_event(service, event_id, updates):
-                    print(f"  ✅ '{event_summary}' → '{current_name}'")
-                    normalized_count += 1
-
-        except Exception as e:
-            print(f"  ⚠️  Evento {event_id} non trovato o errore: {e}")
+    to_rename = []
+    for event_id in all_lessons:
+        if event_id in events:
+            to_rename.append(events[event_id])
+        else:
+            print(f"  ⚠️  Evento {event_id} non trovato")
+
+    def name_changes(current):
+        # Se il nome è diverso, aggiorna
+        current_name = all_lessons[current['id']]['nome_studente']
+        return {'summary': current_name} if current['summary'] != current_name else {}
+
+    old_summaries = {event['id']: event['summary'] for event in to_rename}
+    for event_id, changes in update_events(service, conn, to_rename, name_changes).items():
+        if changes:
+            print(f"  ✅ '{old_summaries[event_id]}' → '{all_lessons[event_id]['nome_studente']}'")
+            normalized_count += 1
 
     print(f"\n  Totale nomi normalizzati: {normalized_count}\n")
 
     # Step 2: Marca lezioni pagate
     print("💰 Step 2: Aggiornamento lezioni pagate...")
     paid_count = 0
-    for event_id, lesson in paid_lessons.items():
-        try:
-            # Recupera evento
-            event = service.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
-
-            current_description = event.get('description', '')
-            current_color = event.get('colorId', '')
-
-            # Prepara aggiornamenti
-            updates = {}
+    to_mark = []
+    for event_id in paid_lessons:
+        if event_id in events:
+            to_mark.append(events[event_id])
+        else:
+            print(f"  ⚠️  Evento {event_id} non trovato")
+
+    for event_id, changes in update_events(service, conn, to_mark, paid_changes).items():
+        lesson = paid_lessons[event_id]
+        if changes:
             changed = []
-
-            # Aggiungi "PAGATO" se non presente
-            if 'PAGATO' not in current_description:
-                new_description = f"PAGATO\n{current_description}" if current_description else "PAGATO"
-                updates['description'] = new_description
+            if 'description' in changes:
                 changed.append("nota")
-
-            # Cambia colore a blu se non è già blu
-            if current_color != PAID_COLOR:
-                updates['colorId'] = PAID_COLOR
+            if 'colorId' in changes:
                 changed.append("colore")
+            print(f"  ✅ {lesson['nome_studente']} - {lesson['giorno']} {lesson['ora']}: {', '.join(changed)}")
+            paid_count += 1
+        elif changes is not None:
+            print(f"  ⏭️  {lesson['nome_studente']} - {lesson['giorno']} {lesson['ora']}: già aggiornato")
 
-            # Applica aggiornamenti se necessario
-            if updates:
-                if update_event(service, event_id, updates):
-                    print(f"  ✅ {lesson['nome_studente']} - {lesson['giorno']} {lesson['ora']}: {', '.join(changed)}")
-                    paid_count += 1
-            else:
-                print(f"  ⏭️  {lesson['nome_studente']} - {lesson['giorno']} {lesson['ora']}: già aggiornato")
-
-        except Exception as e:
-            print(f"  ⚠️  Evento {event_id} non trovato o errore: {e}")
+    # Copia locale aggiornata con gli eventi scritti
+    conn.commit()
+    conn.close()
 
     print(f"\n  Totale lezioni pagate aggiornate: {paid_count}\n")
 
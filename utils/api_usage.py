@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Conteggio delle richieste a Google Calendar API.
+
+Il client di utils/gcal_client.py costruisce le richieste con CountingHttpRequest:
+ogni execute() viene contato e cronometrato per metodo (events.list, events.get,
+events.patch...). A fine esecuzione dello script (atexit) il riepilogo viene
+stampato e salvato nella tabella api_usage, una riga per metodo, così l'effetto
+di field mask, sync token o batch si misura in richieste risparmiate.
+
+I processi residenti (il bot di association_resolver.py) racchiudono ogni sync
+in usage_run(): all'uscita i contatori vengono salvati e azzerati, così ogni
+sync ha le sue righe e i contatori non crescono per tutta la vita del processo.
+L'atexit resta come rete di sicurezza per le richieste fuori da un usage_run.
+
+Le richieste inviate in batch (utils/gcal_batch.py) contano ognuna per il suo
+metodo, come per la quota; gli scambi HTTP dei batch sono contati a parte
+(metodo 'batch' nella tabella).
+
+La quota di default di Calendar API è di circa 600 richieste/minuto per utente:
+il riepilogo riporta il picco al minuto della run rispetto a quel limite.
+"""
+import sys
+import time
+import atexit
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+from collections import Counter, defaultdict
+
+from googleapiclient.http import HttpRequest
+
+# Database in cui salvare i conteggi (lo stesso degli script)
+USAGE_DB_PATH = Path(__file__).parent.parent / 'pagamenti.db'
+
+# Quota Calendar API per utente (richieste al minuto)
+QUOTA_PER_USER_PER_MINUTE = 600
+
+
+class ApiUsage:
+    """Contatori per metodo, condivisi tra i thread del processo."""
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.seconds = defaultdict(float)
+        self.per_minute = defaultdict(Counter)
+        self.batches = 0
+        self.batch_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, method, elapsed, error=False, count=1):
+        """
+        Registra una (o count) richieste.
+
+        Args:
+            method: Metodo API (es. 'events.list')
+            elapsed: Secondi impiegati
+            error: True se la richiesta è fallita
+            count: Richieste registrate (es. le parti di un batch)
+        """
+        minute = int(time.time() // 60)
+        with self.lock:
+            self.requests[method] += count
+            self.seconds[method] += elapsed
+            self.per_minute[method][minute] += count
+            if error:
+                self.errors[method] += count
+
+    def record_batch(self, methods, elapsed, errors):
+        """
+        Registra uno scambio HTTP batch.
+
+        Args:
+            methods: Counter metodo → richieste nel batch
+            elapsed: Secondi dello scambio (ripartiti tra le richieste)
+            errors: Counter metodo → richieste fallite
+        """
+        count = sum(methods.values())
+        with self.lock:
+            self.batches += 1
+            self.batch_seconds += elapsed
+        for method, n in methods.items():
+            self.record(method, elapsed * n / count, count=n)
+        with self.lock:
+            for method, n in errors.items():
+                self.errors[method] += n
+
+    def take(self):
+        """
+        Preleva i contatori accumulati finora e li azzera.
+
+        Returns:
+            ApiUsage con i contatori prelevati (started_at = inizio del periodo)
+        """
+        taken = ApiUsage()
+        with self.lock:
+            taken.started_at, self.started_at = self.started_at, datetime.now()
+            taken.requests, self.requests = self.requests, Counter()
+            taken.errors, self.errors = self.errors, Counter()
+            taken.seconds, self.seconds = self.seconds, defaultdict(float)
+            taken.per_minute, self.per_minute = self.per_minute, defaultdict(Counter)
+            taken.batches, self.batches = self.batches, 0
+            taken.batch_seconds, self.batch_seconds = self.batch_seconds, 0.0
+        return taken
+
+    def total(self):
+        """Numero totale di richieste registrate."""
+        return sum(self.requests.values())
+
+    def peak_per_minute(self, method=None):
+        """Massimo di richieste in un minuto (di un metodo o di tutti)."""
+        with self.lock:
+            if method is not None:
+                minutes = self.per_minute[method]
+            else:
+                minutes = Counter()
+                for counts in self.per_minute.values():
+                    minutes.update(counts)
+        return max(minutes.values(), default=0)
+
+    def summary_lines(self):
+        """Righe del riepilogo di fine esecuzione."""
+        lines = []
+        for method in sorted(self.requests):
+            count = self.requests[method]
+            seconds = self.seconds[method]
+            lines.append(
+                f"{method:<20} {count:>6} richieste  {seconds:>7.2f}s "
+                f"(media {seconds / count:.3f}s)  errori {self.errors[method]}"
+            )
+
+        if self.batches:
+            lines.append(f"{'(scambi HTTP batch)':<20} {self.batches:>6} batch      {self.batch_seconds:>7.2f}s")
+
+        peak = self.peak_per_minute()
+        lines.append(
+            f"Totale: {self.total()} richieste, picco {peak}/min "
+            f"({peak / QUOTA_PER_USER_PER_MINUTE:.0%} della quota per utente)"
+        )
+        return lines
+
+
+# Contatori del processo corrente
+usage = ApiUsage()
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def method_name(method_id):
+    """'calendar.events.list' → 'events.list'."""
+    if not method_id:
+        return 'unknown'
+    return method_id.split('.', 1)[1] if method_id.startswith('calendar.') else method_id
+
+
+class CountingHttpRequest(HttpRequest):
+    """HttpRequest che registra in usage ogni execute()."""
+
+    def execute(self, http=None, num_retries=0):
+        started = time.monotonic()
+        error = False
+        try:
+            return super().execute(http=http, num_retries=num_retries)
+        except Exception:
+            # HttpError, ma anche timeout e errori di rete
+            error = True
+            raise
+        finally:
+            usage.record(method_name(self.methodId), time.monotonic() - started, error)
+
+
+def ensure_api_usage_table(conn):
+    """
+    Crea la tabella api_usage (se non esiste).
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            script TEXT NOT NULL,
+            method TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            total_ms INTEGER NOT NULL,
+            peak_per_minute INTEGER NOT NULL,
+            run_started_at TEXT NOT NULL,
+            run_ended_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_api_usage_script ON api_usage (script, run_started_at)')
+    conn.commit()
+
+
+def save_usage(conn, script, counts=None):
+    """
+    Salva i contatori della run (una riga per metodo).
+
+    NON esegue commit.
+
+    Args:
+        conn: Connessione SQLite attiva
+        script: Nome dello script (es. 'gcal_incremental_sync.py')
+        counts: ApiUsage da salvare (None = contatori del processo)
+    """
+    if counts is None:
+        counts = usage
+    ended_at = datetime.now().isoformat()
+    rows = [
+        (script, method, count, counts.errors[method], int(counts.seconds[method] * 1000),
+         counts.peak_per_minute(method), counts.started_at.isoformat(), ended_at)
+        for method, count in counts.requests.items()
+    ]
+    if counts.batches:
+        rows.append((script, 'batch', counts.batches, 0, int(counts.batch_seconds * 1000), 0,
+                     counts.started_at.isoformat(), ended_at))
+
+    conn.executemany('''
+        INSERT INTO api_usage
+            (script, method, requests, errors, total_ms, peak_per_minute, run_started_at, run_ended_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+
+def process_script():
+    """Nome dello script del processo corrente (es. 'association_resolver.py')."""
+    return Path(sys.argv[0]).name or 'python'
+
+
+def flush_usage(script, log=print):
+    """
+    Stampa e salva nel database i contatori accumulati (se ci sono richieste), poi li azzera.
+
+    Args:
+        script: Nome salvato nella colonna script
+        log: Funzione per le righe del riepilogo (print, logger.info...)
+
+    Returns:
+        ApiUsage con i contatori salvati
+    """
+    counts = usage.take()
+    if not counts.total():
+        return counts
+
+    log("="*60)
+    log(f"CHIAMATE GOOGLE CALENDAR API ({script})")
+    log("="*60)
+    for line in counts.summary_lines():
+        log(line)
+    log("="*60)
+
+    if not USAGE_DB_PATH.exists():
+        return counts
+    try:
+        conn = sqlite3.connect(USAGE_DB_PATH)
+        ensure_api_usage_table(conn)
+        save_usage(conn, script, counts)
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        log(f"⚠️  Conteggio chiamate API non salvato: {e}")
+    return counts
+
+
+@contextmanager
+def usage_run(script, log=print):
+    """
+    Conta a parte le richieste di un sync (processi residenti).
+
+    Le richieste precedenti vengono salvate col nome del processo; all'uscita quelle
+    del sync vengono salvate come script e i contatori azzerati.
+
+    Uso:
+        with api_usage.usage_run('association_resolver.py sync_today', log=logger.info):
+            ...sync...
+    """
+    flush_usage(process_script(), log=log)
+    try:
+        yield
+    finally:
+        flush_usage(script, log=log)
+
+
+def report_usage():
+    """Riepilogo di fine esecuzione: stampa e salva nel database (se ci sono richieste)."""
+    if usage.total():
+        print()
+        flush_usage(process_script())
+
+
+def install():
+    """Registra report_usage() a fine processo (una volta sola)."""
+    global _installed
+    with _install_lock:
+        if not _installed:
+            atexit.register(report_usage)
+            _installed = True
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Copia locale degli eventi di Google Calendar (tabella calendar_events).
+
+Il sync in lettura (gcal_incremental_sync.py, gcal_bulk_sync.py) salva per ogni
+evento etag, titolo, colore, descrizione e inizio. Gli script che scrivono sul
+calendario (update_gcal_incremental.py, update_gcal_paid_lessons.py) confrontano
+lo stato desiderato con questa copia invece di fare events().get per ogni lezione,
+e chiamano l'API solo per gli eventi che differiscono.
+
+Ogni scrittura è un patch con If-Match sull'etag salvato: se l'evento è stato
+modificato su Calendar dopo l'ultimo sync, Google risponde 412 e l'evento viene
+riletto (una sola get), aggiornato nella copia e confrontato di nuovo.
+
+Letture e scritture di più eventi viaggiano in batch HTTP (utils/gcal_batch.py):
+fino a 50 richieste per scambio, con esito ed eventuali retry per richiesta.
+"""
+from googleapiclient.errors import HttpError
+
+from utils.gcal_batch import execute_batch, no_response_error
+
+# Campi evento salvati nella copia (superset dei campi del sync lezioni)
+MIRROR_EVENT_FIELDS = 'id,etag,status,summary,start,colorId,description'
+
+
+def ensure_calendar_events_table(conn):
+    """
+    Crea la tabella calendar_events (se non esiste).
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS calendar_events (
+            event_id TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            summary TEXT,
+            color_id TEXT,
+            description TEXT,
+            start TEXT,
+            giorno TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_calendar_events_giorno ON calendar_events(giorno)')
+    conn.commit()
+
+
+def _event_row(event):
+    """Riga calendar_events da un evento dell'API."""
+    start = event.get('start', {})
+    start = start.get('dateTime', start.get('date'))
+    return (
+        event['id'],
+        event['etag'],
+        event.get('summary'),
+        event.get('colorId'),
+        event.get('description'),
+        start,
+        start[:10] if start else None
+    )
+
+
+def mirror_events(cursor, events):
+    """
+    Aggiorna la copia locale con gli eventi letti (i cancellati vengono rimossi).
+
+    NON esegue commit: va committato insieme alle lezioni del sync.
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+        events: Eventi letti con (almeno) i campi MIRROR_EVENT_FIELDS
+
+    Returns:
+        Numero di eventi salvati
+    """
+    rows = []
+    cancelled = []
+    for event in events:
+        if event.get('status') == 'cancelled':
+            cancelled.append((event['id'],))
+        elif 'etag' in event:
+            rows.append(_event_row(event))
+
+    cursor.executemany('''
+        INSERT INTO calendar_events (event_id, etag, summary, color_id, description, start, giorno)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(event_id) DO UPDATE SET
+            etag = excluded.etag,
+            summary = excluded.summary,
+            color_id = excluded.color_id,
+            description = excluded.description,
+            start = excluded.start,
+            giorno = excluded.giorno,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE calendar_events.etag IS NOT excluded.etag
+    ''', rows)
+    cursor.executemany('DELETE FROM calendar_events WHERE event_id = ?', cancelled)
+    return len(rows)
+
+
+def _row_dict(row):
+    """dict evento (chiavi come nell'API) da una riga calendar_events."""
+    event_id, etag, summary, color_id, description, start, giorno = row
+    return {
+        'id': event_id,
+        'etag': etag,
+        'summary': summary or '',
+        'colorId': color_id,
+        'description': description or '',
+        'start': start,
+        'giorno': giorno
+    }
+
+
+def load_events(service, calendar_id, conn, event_ids):
+    """
+    Stato attuale degli eventi indicati, dalla copia locale.
+    Gli eventi che mancano nella copia vengono letti dall'API e salvati.
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        conn: Connessione SQLite attiva
+        event_ids: ID degli eventi
+
+    Returns:
+        dict event_id → evento (id, etag, summary, colorId, description, start, giorno);
+        gli eventi inesistenti su Calendar non compaiono
+    """
+    event_ids = list(event_ids)
+    found = {}
+
+    # A blocchi: limite di variabili per query SQLite
+    for i in range(0, len(event_ids), 500):
+        chunk = event_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f'''
+            SELECT event_id, etag, summary, color_id, description, start, giorno
+            FROM calendar_events WHERE event_id IN ({placeholders})
+        ''', chunk):
+            found[row[0]] = _row_dict(row)
+
+    # Eventi mancanti nella copia: lettura in batch
+    missing = [event_id for event_id in event_ids if event_id not in found]
+    fetched = []
+    for response, error in execute_batch(service, [
+        (event_id, _get_request(service, calendar_id, event_id)) for event_id in missing
+    ]).values():
+        if error is None:
+            fetched.append(response)
+        elif error.resp.status not in (404, 410):
+            raise error
+
+    if fetched:
+        mirror_events(conn, fetched)
+        conn.commit()
+        for event in fetched:
+            if event.get('status') != 'cancelled':
+                found[event['id']] = _row_dict(_event_row(event))
+
+    return found
+
+
+def _get_request(service, calendar_id, event_id):
+    """Richiesta get di un evento (campi della copia locale)."""
+    return service.events().get(calendarId=calendar_id, eventId=event_id, fields=MIRROR_EVENT_FIELDS)
+
+
+def _patch_request(service, calendar_id, event, changes):
+    """Richiesta patch con If-Match sull'etag noto (HttpError 412 se l'evento è cambiato)."""
+    request = service.events().patch(
+        calendarId=calendar_id,
+        eventId=event['id'],
+        body=changes,
+        fields=MIRROR_EVENT_FIELDS
+    )
+    request.headers['If-Match'] = event['etag']
+    return request
+
+
+def write_events_changes(service, calendar_id, conn, events, compute_changes):
+    """
+    Scrive su Calendar le differenze tra eventi e stato desiderato, in batch.
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        conn: Connessione SQLite attiva (la copia viene aggiornata, senza commit)
+        events: Eventi come restituiti da load_events
+        compute_changes: Funzione evento → dict campi da modificare ({} = niente)
+
+    Gli eventi passati vengono aggiornati in place con lo stato dopo la scrittura.
+    Gli eventi in conflitto (412) vengono riletti in batch, ricalcolati e
+    riscritti una volta.
+
+    Returns:
+        dict event_id → dict dei campi modificati ({} se già aggiornato)
+        oppure HttpError se la scrittura dell'evento è fallita
+    """
+    results = {}
+    pending = {event['id']: event for event in events}
+
+    for attempt in range(2):
+        patches = {}
+        for event_id, event in pending.items():
+            changes = compute_changes(event)
+            if changes:
+                patches[event_id] = changes
+            else:
+                results[event_id] = {}
+
+        responses = execute_batch(service, [
+            (event_id, _patch_request(service, calendar_id, pending[event_id], changes))
+            for event_id, changes in patches.items()
+        ])
+
+        conflicts = []
+        for event_id, (updated, error) in responses.items():
+            if error is None and updated is None:
+                error = no_response_error()
+
+            if error is None:
+                mirror_events(conn, [updated])
+                pending[event_id].update(_row_dict(_event_row(updated)))
+                results[event_id] = patches[event_id]
+            elif error.resp.status == 412 and attempt == 0:
+                conflicts.append(event_id)
+            else:
+                results[event_id] = error
+
+        if not conflicts:
+            break
+
+        # Modificati su Calendar dopo l'ultimo sync: rileggi e ricalcola
+        current = execute_batch(service, [
+            (event_id, _get_request(service, calendar_id, event_id)) for event_id in conflicts
+        ])
+        retry = {}
+        for event_id, (event, error) in current.items():
+            if error is None and event is None:
+                error = no_response_error()
+
+            if error is not None:
+                results[event_id] = error
+                continue
+            mirror_events(conn, [event])
+            pending[event_id].update(_row_dict(_event_row(event)))
+            retry[event_id] = pending[event_id]
+        pending = retry
+
+    return results
+
+
+def write_event_changes(service, calendar_id, conn, event, compute_changes):
+    """
+    Scrive su Calendar le differenze tra un evento e lo stato desiderato
+    (vedi write_events_changes).
+
+    Raises:
+        HttpError: Errore della scrittura
+
+    Returns:
+        dict dei campi modificati ({} se l'evento era già aggiornato)
+    """
+    result = write_events_changes(service, calendar_id, conn, [event], compute_changes)[event['id']]
+    if isinstance(result, HttpError):
+        raise result
+    return result
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Notifiche push di Google Calendar (watch channel).
+
+Google chiama l'endpoint /api/calendar_notification dell'interfaccia web a ogni
+modifica del calendario: la notifica non contiene gli eventi, solo "qualcosa è
+cambiato". L'endpoint passa la notifica a SyncCoalescer, che accorpa le raffiche
+(una modifica in Calendar ne genera spesso diverse) e lancia in background un
+solo sync delta (gcal_incremental_sync.py, sync token).
+
+Il canale scade (al massimo dopo una settimana): gcal_watch_channel.py, lanciato
+da cron, lo rinnova prima della scadenza. Il canale attivo è salvato in
+sync_status (fonte WATCH_SOURCE) come JSON; i canali finti di
+fake_calendar_notifier.py hanno una fonte a parte (TEST_WATCH_SOURCE) e durano
+poco, così non sostituiscono mai quello reale.
+"""
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, timezone, timedelta
+
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+
+# Fonte in sync_status per il canale attivo
+WATCH_SOURCE = 'google_calendar_watch'
+
+# Fonte in sync_status per il canale finto dei test locali (fake_calendar_notifier.py)
+TEST_WATCH_SOURCE = 'google_calendar_watch_test'
+
+# Durata richiesta per un canale (Google può ridurla)
+CHANNEL_TTL = timedelta(days=7)
+
+# Durata di un canale finto
+TEST_CHANNEL_TTL = timedelta(hours=1)
+
+# Rinnova il canale quando mancano meno di RENEW_MARGIN alla scadenza
+RENEW_MARGIN = timedelta(days=1)
+
+# Secondi di attesa per accorpare una raffica di notifiche in un solo sync
+COALESCE_DELAY = 2.0
+
+# Stati inviati da Google nell'header X-Goog-Resource-State
+STATE_SYNC = 'sync'  # primo messaggio dopo la creazione del canale, nessuna modifica
+
+
+def load_channel(conn, source=WATCH_SOURCE):
+    """
+    Legge il canale attivo salvato.
+
+    Args:
+        conn: Connessione SQLite attiva
+        source: Fonte in sync_status (WATCH_SOURCE o TEST_WATCH_SOURCE)
+
+    Returns:
+        dict (id, resource_id, token, expiration datetime UTC) o None
+    """
+    ensure_sync_status_table(conn)
+    value = get_cursor(conn, source)
+    if not value:
+        return None
+
+    channel = json.loads(value)
+    channel['expiration'] = datetime.fromisoformat(channel['expiration'])
+    return channel
+
+
+def save_channel(conn, channel, source=WATCH_SOURCE):
+    """
+    Salva il canale attivo (None = nessun canale).
+
+    Args:
+        conn: Connessione SQLite attiva
+        channel: dict come restituito da create_channel
+        source: Fonte in sync_status (WATCH_SOURCE o TEST_WATCH_SOURCE)
+    """
+    ensure_sync_status_table(conn)
+    if channel is None:
+        conn.execute('DELETE FROM sync_status WHERE source = ?', (source,))
+    else:
+        save_cursor(conn, source, json.dumps({
+            **channel, 'expiration': channel['expiration'].isoformat()
+        }))
+    conn.commit()
+
+
+def find_channel(conn, channel_id, now=None):
+    """
+    Canale a cui appartiene una notifica: quello reale o, se non scaduto, quello finto.
+
+    Args:
+        conn: Connessione SQLite attiva
+        channel_id: Header X-Goog-Channel-ID della notifica
+
+    Returns:
+        dict del canale o None se la notifica non è di un canale noto
+    """
+    channel = load_channel(conn)
+    if channel is not None and channel['id'] == channel_id:
+        return channel
+
+    test_channel = load_channel(conn, TEST_WATCH_SOURCE)
+    now = now or datetime.now(timezone.utc)
+    if test_channel is not None and test_channel['id'] == channel_id and test_channel['expiration'] > now:
+        return test_channel
+    return None
+
+
+def needs_renewal(channel, now=None, margin=RENEW_MARGIN):
+    """True se il canale manca o scade entro margin."""
+    if channel is None:
+        return True
+    now = now or datetime.now(timezone.utc)
+    return channel['expiration'] - now < margin
+
+
+def create_channel(service, calendar_id, address, token, ttl=CHANNEL_TTL):
+    """
+    Apre un watch channel sugli eventi del calendario.
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        address: URL HTTPS pubblico di /api/calendar_notification
+        token: Segreto rimandato da Google in X-Goog-Channel-Token
+        ttl: Durata richiesta
+
+    Returns:
+        dict con id, resource_id, token, expiration (datetime UTC)
+    """
+    response = service.events().watch(
+        calendarId=calendar_id,
+        body={
+            'id': str(uuid.uuid4()),
+            'type': 'web_hook',
+            'address': address,
+            'token': token,
+            'params': {'ttl': str(int(ttl.total_seconds()))},
+        }
+    ).execute()
+
+    return {
+        'id': response['id'],
+        'resource_id': response['resourceId'],
+        'token': token,
+        # expiration: millisecondi epoch, come stringa
+        'expiration': datetime.fromtimestamp(int(response['expiration']) / 1000, timezone.utc),
+    }
+
+
+def stop_channel(service, channel):
+    """Chiude un canale (Google smette di inviare notifiche)."""
+    service.channels().stop(body={
+        'id': channel['id'],
+        'resourceId': channel['resource_id'],
+    }).execute()
+
+
+class SyncCoalescer:
+    """
+    Accorpa le notifiche e lancia sync_func in un thread in background.
+
+    notify() ritorna subito (Google vuole una risposta veloce). Il thread aspetta
+    delay secondi per raccogliere il resto della raffica, esegue un solo sync e,
+    se nel frattempo sono arrivate altre notifiche, ne esegue un altro: non ci
+    sono mai due sync contemporanei e nessuna modifica resta senza sync.
+
+    I sync manuali passano da run_now(), che usa lo stesso lock: un sync lanciato
+    a mano durante uno da notifica aspetta che finisca.
+    """
+
+    def __init__(self, sync_func, delay=COALESCE_DELAY):
+        """
+        Args:
+            sync_func: Funzione senza argomenti che esegue il sync (solleva un'eccezione se fallisce)
+            delay: Secondi di attesa per accorpare le notifiche
+        """
+        self.sync_func = sync_func
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()  # Un solo sync alla volta (notifiche e manuali)
+        self.pending = False
+        self.running = False
+
+        self.notifications = 0
+        self.runs = 0
+        self.last_run_at = None
+        self.last_error = None
+
+    def notify(self):
+        """
+        Segnala una modifica del calendario.
+
+        Returns:
+            True se è stato avviato un nuovo thread di sync
+        """
+        with self.lock:
+            self.notifications += 1
+            self.pending = True
+            if self.running:
+                return False
+            self.running = True
+
+        threading.Thread(target=self._worker, daemon=True).start()
+        return True
+
+    def _worker(self):
+        """Esegue i sync finché arrivano notifiche."""
+        while True:
+            time.sleep(self.delay)
+
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                self.pending = False
+
+            try:
+                self.run_now()
+            except Exception as e:
+                print(f"❌ Errore sync da notifica Calendar: {e}")
+
+    def run_now(self):
+        """
+        Esegue subito un sync (es. richiesto a mano), dopo quello eventualmente in corso.
+
+        Returns:
+            Risultato di sync_func
+
+        Raises:
+            Exception: L'errore di sync_func (registrato anche in last_error)
+        """
+        with self.sync_lock:
+            try:
+                result = self.sync_func()
+                self.last_error = None
+                return result
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            finally:
+                self.runs += 1
+                self.last_run_at = datetime.now(timezone.utc)
+
+    def status(self):
+        """Contatori per /api/calendar_notification/status."""
+        return {
+            'notifications': self.notifications,
+            'runs': self.runs,
+            'running': self.running,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'last_error': self.last_error,
+        }
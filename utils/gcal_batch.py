@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Richieste Google Calendar API raggruppate in batch HTTP.
+
+Fino a BATCH_SIZE richieste (get, patch...) viaggiano in un solo scambio HTTP
+(limite di Calendar API: 50). Ogni richiesta del batch ha il suo esito: gli
+errori temporanei (rate limit, 5xx) vengono ritentati in un batch successivo,
+con attesa crescente; gli altri vengono restituiti al chiamante per richiesta.
+"""
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from utils.api_usage import usage, method_name
+
+# Richieste per batch (massimo consentito da Calendar API)
+BATCH_SIZE = 50
+
+# Tentativi aggiuntivi per le richieste fallite con errore temporaneo
+MAX_RETRIES = 3
+
+# Status HTTP da ritentare (403 solo se è un rate limit)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_retryable(error):
+    """True se l'errore è temporaneo (rate limit o errore del server)."""
+    status = error.resp.status
+    if status in RETRY_STATUSES:
+        return True
+    return status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()
+
+
+def no_response_error():
+    """
+    Errore per una richiesta rimasta senza esito nel batch (nessun callback).
+
+    Ha status 503, quindi viene ritentata come gli errori temporanei.
+    """
+    return HttpError(httplib2.Response({'status': 503}), b'Nessuna risposta per la richiesta nel batch')
+
+
+def _execute_chunk(service, chunk):
+    """
+    Esegue un batch (al massimo BATCH_SIZE richieste).
+
+    Returns:
+        Lista di (response, error) nello stesso ordine di chunk
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for n, (_, request) in enumerate(chunk):
+        batch.add(request, request_id=str(n))
+
+    started = time.monotonic()
+    try:
+        batch.execute()
+    except HttpError as e:
+        # Errore dell'intero scambio HTTP: stesso esito per tutte le richieste
+        results = {str(n): (None, e) for n in range(len(chunk))}
+
+    # Richiesta senza callback: errore temporaneo, non un successo senza risposta
+    outcomes = [results.get(str(n)) or (None, no_response_error()) for n in range(len(chunk))]
+    usage.record_batch(
+        Counter(method_name(request.methodId) for _, request in chunk),
+        time.monotonic() - started,
+        Counter(method_name(request.methodId)
+                for (_, request), (_, error) in zip(chunk, outcomes) if error is not None)
+    )
+    return outcomes
+
+
+def execute_batch(service, requests, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, sleep=time.sleep):
+    """
+    Esegue richieste API in batch, ritentando quelle fallite per errori temporanei.
+
+    Args:
+        service: Google Calendar API service object
+        requests: Lista di (chiave, HttpRequest non eseguita), es. (event_id, events().patch(...))
+        batch_size: Richieste per scambio HTTP
+        max_retries: Tentativi aggiuntivi per gli errori temporanei
+        sleep: Funzione di attesa tra i tentativi (time.sleep)
+
+    Returns:
+        dict chiave → (response, HttpError o None)
+    """
+    results = {}
+    pending = list(requests)
+
+    for attempt in range(max_retries + 1):
+        retry = []
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            for (key, request), (response, error) in zip(chunk, _execute_chunk(service, chunk)):
+                if error is not None and attempt < max_retries and is_retryable(error):
+                    retry.append((key, request))
+                else:
+                    results[key] = (response, error)
+
+        if not retry:
+            break
+
+        # Backoff esponenziale prima di ritentare (1s, 2s, 4s...)
+        sleep(2 ** attempt)
+        pending = retry
+
+    return results
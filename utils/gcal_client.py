@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Client Google Calendar condiviso.
+
+Tutti gli script e il bot ottengono il service da get_calendar_service(), che:
+- costruisce il client una sola volta (per file credenziali, scope e thread) con il
+  discovery document statico incluso in google-api-python-client, senza scaricarlo
+- riusa la stessa sessione HTTP autorizzata (connessioni keep-alive) per tutte le chiamate
+- salva il token OAuth su disco fino alla scadenza: gli script brevi lanciati da cron
+  o dall'interfaccia web non chiedono un token nuovo a ogni esecuzione
+
+Il client è per thread perché httplib2 non è thread-safe; negli script (un solo
+thread) è quindi un client per processo.
+
+Le letture degli eventi passano da iter_events()/iter_event_pages(): seguono
+nextPageToken fino all'ultima pagina (nessun troncamento silenzioso) e chiedono
+solo i campi che il chiamante usa (parametro fields).
+
+Ogni richiesta viene contata e cronometrata per metodo (utils/api_usage.py):
+il riepilogo viene stampato e salvato nella tabella api_usage a fine script.
+"""
+import os
+import json
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+
+import httplib2
+import google_auth_httplib2
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+
+from utils import api_usage
+
+# Cache dei token su disco (un token per service account + scope)
+TOKEN_CACHE_PATH = Path(__file__).parent.parent / '.gcal_token_cache.json'
+
+# Un token che scade entro questo margine viene considerato già scaduto
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+# Timeout (secondi) di ogni richiesta HTTP
+HTTP_TIMEOUT = 60
+
+# Massimo consentito da events().list
+MAX_PAGE_SIZE = 2500
+
+# Campi evento letti dal sync lezioni (utils/lesson_sync.py)
+LESSON_EVENT_FIELDS = 'id,status,summary,start'
+
+_local = threading.local()
+_token_lock = threading.Lock()
+
+
+def _token_key(credentials):
+    """Chiave del token nella cache: email service account + scope."""
+    return f"{credentials.service_account_email}|{' '.join(sorted(credentials.scopes or []))}"
+
+
+def _read_token_cache():
+    """Legge la cache dei token (dict vuoto se manca o è illeggibile)."""
+    try:
+        with open(TOKEN_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_token_cache(cache):
+    """Scrive la cache in modo atomico, leggibile solo dal proprietario."""
+    tmp_path = TOKEN_CACHE_PATH.with_suffix('.tmp')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, TOKEN_CACHE_PATH)
+
+
+class CachedCredentials(service_account.Credentials):
+    """Credenziali service account che salvano su disco ogni token ottenuto."""
+
+    def refresh(self, request):
+        super().refresh(request)
+        with _token_lock:
+            cache = _read_token_cache()
+            cache[_token_key(self)] = {
+                'token': self.token,
+                'expiry': self.expiry.isoformat(),
+            }
+            try:
+                _write_token_cache(cache)
+            except OSError:
+                # Cache non scrivibile: il token resta valido in memoria
+                pass
+
+
+def load_cached_token(credentials):
+    """
+    Carica nelle credenziali il token salvato, se ancora valido.
+
+    Returns:
+        True se è stato caricato un token dalla cache
+    """
+    entry = _read_token_cache().get(_token_key(credentials))
+    if not entry:
+        return False
+
+    # expiry naive UTC, come in google-auth
+    expiry = datetime.fromisoformat(entry['expiry'])
+    if expiry - TOKEN_EXPIRY_MARGIN <= datetime.utcnow():
+        return False
+
+    credentials.token = entry['token']
+    credentials.expiry = expiry
+    return True
+
+
+def get_calendar_service(service_account_file, scopes):
+    """
+    Restituisce il service Google Calendar API condiviso.
+
+    Args:
+        service_account_file: Path del JSON del service account
+        scopes: Lista di scope OAuth
+
+    Returns:
+        Google Calendar API service object
+    """
+    key = (str(service_account_file), tuple(scopes))
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+
+    service = services.get(key)
+    if service is None:
+        credentials = CachedCredentials.from_service_account_file(
+            str(service_account_file),
+            scopes=list(scopes)
+        )
+        load_cached_token(credentials)
+
+        http = google_auth_httplib2.AuthorizedHttp(
+            credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT)
+        )
+        service = build(
+            'calendar', 'v3', http=http,
+            requestBuilder=api_usage.CountingHttpRequest,
+            static_discovery=True, cache_discovery=False
+        )
+        services[key] = service
+        api_usage.install()
+
+    return service
+
+
+def iter_event_pages(service, calendar_id, fields=None, limiter=None, **params):
+    """
+    Pagine di events().list, seguendo nextPageToken.
+
+    Args:
+        service: Google Calendar API service object
+        calendar_id: ID del calendario Google
+        fields: Campi evento da scaricare (es. 'id,summary,start'), None = tutti
+        limiter: QpsLimiter (utils/rate_limiter.py) da rispettare a ogni pagina, None = nessuno
+        **params: Altri parametri di events().list (timeMin, singleEvents, syncToken...)
+
+    Yields:
+        Risposte di events().list (items, timeZone del calendario, e nextSyncToken
+        sull'ultima pagina)
+    """
+    request_params = {'calendarId': calendar_id, 'maxResults': MAX_PAGE_SIZE, **params}
+    if fields:
+        request_params['fields'] = f"items({fields}),timeZone,nextPageToken,nextSyncToken"
+
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        page = service.events().list(**request_params).execute()
+        yield page
+
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            return
+        request_params['pageToken'] = page_token
+
+
+def iter_events(service, calendar_id, fields=None, limiter=None, **params):
+    """
+    Tutti gli eventi di events().list, pagina dopo pagina (vedi iter_event_pages).
+
+    Yields:
+        Eventi (dict con i soli campi richiesti)
+    """
+    for page in iter_event_pages(service, calendar_id, fields=fields, limiter=limiter, **params):
+        yield from page.get('items', [])
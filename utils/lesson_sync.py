@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Motore unico di sincronizzazione eventi Google Calendar → tabella lezioni.
+
+Usato da gcal_bulk_sync.py, gcal_incremental_sync.py e dal bot (association_resolver.py):
+le regole su eventi "prova", orari, nomi e range di date sono solo qui.
+
+Gli eventi di una pagina (o di tutto il sync) diventano righe lezione in memoria,
+poi vengono applicati con un solo executemany di upsert e DELETE set-based su una
+tabella temporanea di event_id. Le funzioni NON eseguono commit: il chiamante
+committa tutto il sync in un'unica transazione.
+
+Le lezioni il cui evento è stato cancellato (o non è più nel calendario) vengono
+rimosse, tranne quelle già abbinate a un pagamento (righe in pagamenti_lezioni):
+restano in lezioni e vengono segnalate in lezioni_da_verificare, per non perdere
+le quote pagate.
+
+Ogni sync che legge il calendario fino a oggi registra in sync_status il momento
+in cui ha iniziato a leggerlo (mark_lessons_fresh): il bot lo usa per non
+ripetere il sync delle lezioni di oggi quando i dati sono già aggiornati.
+"""
+import re
+from datetime import datetime
+from functools import lru_cache
+from collections import Counter
+
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+
+# Titoli che indicano una lezione di prova (gratis, non va in lezioni)
+PROVA_KEYWORDS = ('prova', 'пробный', 'trial')
+
+_PROVA_PATTERN = re.compile('|'.join(map(re.escape, PROVA_KEYWORDS)), re.IGNORECASE)
+
+# Varianti di nomi studente da correggere (titolo evento → nome)
+NAME_REWRITES = {'dmitry1': 'dmitry'}
+
+# Fonte in sync_status: lezioni aggiornate fino a oggi (ora locale, ISO)
+LESSONS_FRESH_SOURCE = 'lessons_fresh_as_of'
+
+
+def is_prova(summary):
+    """True se il titolo indica una lezione di prova."""
+    return _PROVA_PATTERN.search(summary) is not None
+
+
+@lru_cache(maxsize=4096)
+def normalize_student_name(summary):
+    """Nome studente dal titolo dell'evento (es. "dmitry1" → "dmitry")."""
+    for old, new in NAME_REWRITES.items():
+        summary = summary.replace(old, new)
+    return summary.strip()
+
+
+def parse_event_start(event):
+    """
+    Giorno e ora di inizio di un evento.
+
+    Returns:
+        Tupla (giorno 'YYYY-MM-DD', ora 'HH:MM:SS'); '00:00:00' per eventi all-day
+    """
+    start = event['start'].get('dateTime', event['start'].get('date'))
+
+    if 'T' in start:
+        # Evento con orario: RFC 3339 'YYYY-MM-DDTHH:MM:SS±HH:MM', giorno e ora
+        # nel fuso dell'evento sono già nella stringa (come fromisoformat + strftime)
+        return start[:10], start[11:19]
+
+    # Evento all-day
+    return start, '00:00:00'
+
+
+def new_stats():
+    """Contatori di un sync (sommabili tra più pagine)."""
+    return {
+        'synced': 0,         # righe lezione applicate
+        'changed': 0,        # di cui nuove o modificate
+        'deleted': 0,
+        'flagged': 0,        # lezioni pagate senza evento, da verificare
+        'skipped_prova': 0,
+        'skipped_range': 0,
+        'errors': 0,
+        'students': Counter()
+    }
+
+
+def events_to_rows(events, stats, min_day=None, max_day=None):
+    """
+    Converte eventi del calendario in righe lezione.
+
+    Args:
+        events: Eventi Google Calendar
+        stats: dict di new_stats(), aggiornato in place
+        min_day: Giorno minimo 'YYYY-MM-DD' (None = nessun limite)
+        max_day: Giorno massimo 'YYYY-MM-DD' incluso (None = nessun limite)
+
+    Returns:
+        Tupla (righe (event_id, nome_studente, giorno, ora), event_id cancellati,
+        event_id di tutti gli eventi non cancellati, event_id fuori dal range)
+    """
+    rows = []
+    cancelled_ids = []
+    seen_ids = []
+    out_of_range_ids = []
+
+    for event in events:
+        event_id = event['id']
+
+        # Eventi cancellati (showDeleted / sync token): da rimuovere
+        if event.get('status') == 'cancelled':
+            cancelled_ids.append(event_id)
+            continue
+        seen_ids.append(event_id)
+
+        summary = event.get('summary', '').strip()
+
+        # Eventi senza titolo
+        if not summary or 'start' not in event:
+            stats['errors'] += 1
+            continue
+
+        if is_prova(summary):
+            stats['skipped_prova'] += 1
+            continue
+
+        giorno, ora = parse_event_start(event)
+
+        if (min_day and giorno < min_day) or (max_day and giorno > max_day):
+            stats['skipped_range'] += 1
+            out_of_range_ids.append(event_id)
+            continue
+
+        nome_studente = normalize_student_name(summary)
+        stats['students'][nome_studente] += 1
+        rows.append((event_id, nome_studente, giorno, ora))
+
+    return rows, cancelled_ids, seen_ids, out_of_range_ids
+
+
+def _load_event_ids(cursor, event_ids):
+    """Carica gli event_id nella tabella temporanea sync_event_ids (svuotata prima)."""
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS sync_event_ids (event_id TEXT PRIMARY KEY)')
+    cursor.execute('DELETE FROM sync_event_ids')
+    cursor.executemany(
+        'INSERT OR IGNORE INTO sync_event_ids (event_id) VALUES (?)',
+        ((event_id,) for event_id in event_ids)
+    )
+
+
+def upsert_lessons(cursor, rows):
+    """
+    Inserisce o aggiorna le lezioni (chiave nextcloud_event_id) con un solo executemany.
+    Le righe invariate non vengono riscritte (updated_at resta quello dell'ultima modifica).
+
+    Returns:
+        Numero di lezioni nuove o modificate
+    """
+    if not rows:
+        return 0
+
+    # Il costo di default (2000 RUB) viene impostato dalla tabella;
+    # updated_at è aggiornato dal trigger trg_lezioni_updated_at
+    cursor = cursor.executemany('''
+        INSERT INTO lezioni (nextcloud_event_id, nome_studente, giorno, ora, stato)
+        VALUES (?, ?, ?, ?, 'prevista')
+        ON CONFLICT(nextcloud_event_id) DO UPDATE SET
+            nome_studente = excluded.nome_studente,
+            giorno = excluded.giorno,
+            ora = excluded.ora
+        WHERE lezioni.nome_studente IS NOT excluded.nome_studente
+           OR lezioni.giorno IS NOT excluded.giorno
+           OR lezioni.ora IS NOT excluded.ora
+    ''', rows)
+    return max(cursor.rowcount, 0)
+
+
+def ensure_review_table(cursor):
+    """
+    Crea la tabella lezioni_da_verificare (se non esiste). Nessun commit.
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lezioni_da_verificare (
+            lezione_id INTEGER PRIMARY KEY,
+            nextcloud_event_id TEXT,
+            motivo TEXT NOT NULL,
+            segnalata_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (lezione_id) REFERENCES lezioni(id_lezione)
+        )
+    ''')
+
+
+def _remove_lessons(cursor, condition, params, motivo):
+    """
+    Cancella le lezioni che soddisfano condition (SQL su lezioni); quelle con
+    righe in pagamenti_lezioni vengono invece segnalate in lezioni_da_verificare.
+
+    Returns:
+        Tupla (lezioni cancellate, lezioni segnalate ora)
+    """
+    paid = 'EXISTS (SELECT 1 FROM pagamenti_lezioni pl WHERE pl.lezione_id = lezioni.id_lezione)'
+
+    ensure_review_table(cursor)
+    cursor = cursor.execute(f'''
+        INSERT OR IGNORE INTO lezioni_da_verificare (lezione_id, nextcloud_event_id, motivo)
+        SELECT id_lezione, nextcloud_event_id, ? FROM lezioni
+        WHERE ({condition}) AND {paid}
+    ''', (motivo, *params))
+    flagged = max(cursor.rowcount, 0)
+
+    cursor = cursor.execute(f'''
+        DELETE FROM lezioni
+        WHERE ({condition}) AND NOT {paid}
+    ''', params)
+    return max(cursor.rowcount, 0), flagged
+
+
+def delete_lessons(cursor, event_ids):
+    """
+    Cancella le lezioni degli eventi indicati (eventi cancellati).
+    Le lezioni già pagate vengono segnalate invece che cancellate.
+
+    Returns:
+        Tupla (lezioni cancellate, lezioni segnalate)
+    """
+    if not event_ids:
+        return 0, 0
+
+    _load_event_ids(cursor, event_ids)
+    return _remove_lessons(
+        cursor,
+        'nextcloud_event_id IN (SELECT event_id FROM sync_event_ids)',
+        (),
+        'evento cancellato'
+    )
+
+
+def delete_moved_lessons(cursor, event_ids, min_day=None, max_day=None):
+    """
+    Cancella le lezioni salvate nel range degli eventi ora fuori dal range
+    (es. una lezione di oggi spostata alla settimana prossima): senza evento nel
+    range la riga resterebbe alla vecchia data. L'evento verrà reimportato quando
+    rientra nel range. Le lezioni già pagate vengono segnalate invece che cancellate.
+
+    Returns:
+        Tupla (lezioni cancellate, lezioni segnalate)
+    """
+    if not event_ids:
+        return 0, 0
+
+    _load_event_ids(cursor, event_ids)
+    condition = 'nextcloud_event_id IN (SELECT event_id FROM sync_event_ids)'
+    params = []
+    if min_day:
+        condition += ' AND giorno >= ?'
+        params.append(min_day)
+    if max_day:
+        condition += ' AND giorno <= ?'
+        params.append(max_day)
+    return _remove_lessons(cursor, condition, tuple(params), 'evento spostato fuori dal range del sync')
+
+
+def delete_missing_lessons(cursor, seen_ids, first_day, last_day):
+    """
+    Cancella le lezioni tra first_day e last_day (inclusi) il cui evento non è
+    più nel calendario, cioè non è tra seen_ids: gli id vanno in una tabella
+    temporanea e gli orfani si trovano con un anti-join (indice su giorno e sulla
+    chiave della tabella temporanea), senza limiti sul numero di eventi.
+    Le lezioni già pagate vengono segnalate invece che cancellate.
+
+    Returns:
+        Tupla (lezioni cancellate, lezioni segnalate)
+    """
+    _load_event_ids(cursor, seen_ids)
+    return _remove_lessons(
+        cursor,
+        '''giorno BETWEEN ? AND ?
+           AND nextcloud_event_id IS NOT NULL
+           AND NOT EXISTS (
+               SELECT 1 FROM sync_event_ids s WHERE s.event_id = lezioni.nextcloud_event_id
+           )''',
+        (first_day, last_day),
+        'evento non più nel calendario'
+    )
+
+
+def clear_review_flags(cursor, event_ids):
+    """Toglie la segnalazione alle lezioni il cui evento è di nuovo nel calendario."""
+    ensure_review_table(cursor)
+    if not event_ids or cursor.execute('SELECT 1 FROM lezioni_da_verificare LIMIT 1').fetchone() is None:
+        return
+
+    _load_event_ids(cursor, event_ids)
+    cursor.execute('''
+        DELETE FROM lezioni_da_verificare
+        WHERE nextcloud_event_id IN (SELECT event_id FROM sync_event_ids)
+    ''')
+
+
+def apply_events(cursor, events, stats=None, min_day=None, max_day=None, reconcile_days=None):
+    """
+    Applica al DB una pagina (o un intero sync) di eventi del calendario.
+
+    NON esegue commit.
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+        events: Eventi Google Calendar
+        stats: dict di new_stats() da aggiornare (None = nuovo)
+        min_day, max_day: Range di giorni delle lezioni da salvare
+        reconcile_days: Tupla (primo, ultimo giorno 'YYYY-MM-DD') se events sono
+            TUTTI gli eventi di quei giorni: le lezioni del range senza evento
+            vengono cancellate (o segnalate, se pagate)
+
+    Returns:
+        dict statistiche
+    """
+    stats = stats if stats is not None else new_stats()
+
+    rows, cancelled_ids, seen_ids, out_of_range_ids = events_to_rows(events, stats, min_day, max_day)
+
+    stats['synced'] += len(rows)
+    stats['changed'] += upsert_lessons(cursor, rows)
+    clear_review_flags(cursor, seen_ids)
+
+    deleted, flagged = delete_lessons(cursor, cancelled_ids)
+    stats['deleted'] += deleted
+    stats['flagged'] += flagged
+
+    # Eventi spostati fuori dal range (es. nel futuro): la lezione alla vecchia data non vale più
+    deleted, flagged = delete_moved_lessons(cursor, out_of_range_ids, min_day, max_day)
+    stats['deleted'] += deleted
+    stats['flagged'] += flagged
+
+    if reconcile_days is not None:
+        deleted, flagged = delete_missing_lessons(cursor, seen_ids, *reconcile_days)
+        stats['deleted'] += deleted
+        stats['flagged'] += flagged
+
+    return stats
+
+
+def mark_lessons_fresh(conn, as_of):
+    """
+    Registra che le lezioni fino a oggi sono aggiornate al momento as_of.
+    Da chiamare dopo il commit del sync (esegue commit).
+
+    Args:
+        conn: Connessione SQLite attiva
+        as_of: datetime locale di inizio lettura del calendario
+    """
+    ensure_sync_status_table(conn)
+    save_cursor(conn, LESSONS_FRESH_SOURCE, as_of.isoformat())
+    conn.commit()
+
+
+def lessons_fresh_as_of(conn):
+    """
+    Momento a cui le lezioni fino a oggi sono aggiornate.
+
+    Returns:
+        datetime locale, None se mai registrato
+    """
+    ensure_sync_status_table(conn)
+    value = get_cursor(conn, LESSONS_FRESH_SOURCE)
+    return datetime.fromisoformat(value) if value else None
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Archivio compresso dei messaggi grezzi ricevuti dai canali.
+
+Ogni messaggio con testo che passa dagli ingestori (API, servizio residente,
+export Telegram Desktop) viene salvato in messaggi_raw, con chiave fonte_msg_id,
+anche se il parser non lo riconosce. Quando il parser migliora, reparse_messages.py
+rielabora l'archivio in locale invece di riscaricare lo storico da Telegram.
+
+Il testo è compresso con zlib e un dizionario precaricato con le parole tipiche
+degli SMS bancari: su messaggi di ~100 byte dimezza lo spazio, dove zlib da solo
+non guadagna quasi nulla. Il primo byte indica il formato: ARCHIVE_ZDICT non va
+mai modificato, per un dizionario nuovo si aggiunge un nuovo formato.
+"""
+import zlib
+from datetime import datetime
+
+# Formato 1: zlib con ARCHIVE_ZDICT
+FORMAT_ZLIB_ZDICT = 1
+
+ARCHIVE_ZDICT = (
+    "СЧЁТ Перевод из Т-Банк Сбербанк СБП от Баланс: Покупка Оплата Списание "
+    "Зачисление Мобильная связь Код для входа в СберБанк Онлайн р "
+).encode('utf-8')
+
+
+def compress_text(text):
+    """Comprime il testo di un messaggio (primo byte = formato)."""
+    compressor = zlib.compressobj(9, zdict=ARCHIVE_ZDICT)
+    data = compressor.compress(text.encode('utf-8')) + compressor.flush()
+    return bytes([FORMAT_ZLIB_ZDICT]) + data
+
+
+def decompress_text(blob):
+    """Decomprime un testo salvato con compress_text."""
+    blob = bytes(blob)
+    if blob[0] != FORMAT_ZLIB_ZDICT:
+        raise ValueError(f"Formato archivio sconosciuto: {blob[0]}")
+    decompressor = zlib.decompressobj(zdict=ARCHIVE_ZDICT)
+    return (decompressor.decompress(blob[1:]) + decompressor.flush()).decode('utf-8')
+
+
+def ensure_archive_table(conn):
+    """
+    Crea la tabella messaggi_raw (se non esiste).
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messaggi_raw (
+            fonte_msg_id TEXT PRIMARY KEY,
+            data_msg TEXT NOT NULL,
+            testo BLOB NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+
+def archive_messages(cursor, messages):
+    """
+    Salva i messaggi grezzi nell'archivio (quelli già presenti vengono ignorati).
+
+    NON esegue commit: va committato insieme ai pagamenti del batch.
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+        messages: Lista di tuple (fonte_msg_id, testo, data datetime)
+
+    Returns:
+        Numero di messaggi nuovi archiviati
+    """
+    if not messages:
+        return 0
+
+    cursor = cursor.executemany('''
+        INSERT INTO messaggi_raw (fonte_msg_id, data_msg, testo)
+        VALUES (?, ?, ?)
+        ON CONFLICT(fonte_msg_id) DO NOTHING
+    ''', [
+        (fonte_msg_id, date.isoformat(), compress_text(text))
+        for fonte_msg_id, text, date in messages
+        if text
+    ])
+    return max(cursor.rowcount, 0)
+
+
+def iter_archive(conn, batch_size=1000):
+    """
+    Legge l'archivio a batch, in ordine di fonte_msg_id (paginazione per chiave).
+
+    Args:
+        conn: Connessione SQLite attiva
+        batch_size: Messaggi per batch
+
+    Yields:
+        Liste di tuple (fonte_msg_id, testo, data datetime)
+    """
+    last_id = ''
+    while True:
+        rows = conn.execute('''
+            SELECT fonte_msg_id, data_msg, testo
+            FROM messaggi_raw
+            WHERE fonte_msg_id > ?
+            ORDER BY fonte_msg_id
+            LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+
+        if not rows:
+            return
+
+        yield [
+            (fonte_msg_id, decompress_text(testo), datetime.fromisoformat(data_msg))
+            for fonte_msg_id, data_msg, testo in rows
+        ]
+        last_id = rows[-1][0]
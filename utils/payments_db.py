@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Scrittura dei pagamenti nel database a batch.
+
+Un batch di pagamenti parsati viene scritto con un solo executemany e
+INSERT ... ON CONFLICT(fonte_msg_id) DO NOTHING: i messaggi già importati
+vengono scartati da SQLite, senza un'eccezione IntegrityError per ogni duplicato.
+
+Oltre a fonte_msg_id, ogni pagamento ha un hash del contenuto (pagante normalizzato,
+giorno, ora, somma) nella colonna indicizzata hash_contenuto: lo stesso SMS inoltrato
+due volte o importato da un secondo canale viene scartato nello stesso INSERT.
+"""
+import hashlib
+from functools import lru_cache
+
+from utils.name_matcher import normalize_name, transliterate_cyrillic
+
+# id per query IN (...): sotto il limite di variabili di SQLite (999 nelle versioni vecchie)
+LOOKUP_CHUNK_SIZE = 500
+
+
+@lru_cache(maxsize=4096)
+def _payer_key(nome_pagante):
+    """Pagante normalizzato e translitterato (i paganti sono pochi: cache)."""
+    return transliterate_cyrillic(normalize_name(nome_pagante))
+
+
+def content_hash(nome_pagante, giorno, ora, somma):
+    """
+    Hash del contenuto di un pagamento, indipendente dalla fonte.
+
+    Args:
+        nome_pagante: Nome pagante (normalizzato e translitterato qui)
+        giorno: Data 'YYYY-MM-DD'
+        ora: Ora 'HH:MM' o 'HH:MM:SS' (conta solo HH:MM, come nell'SMS)
+        somma: Importo
+
+    Returns:
+        Hash esadecimale (sha1)
+    """
+    key = '|'.join((
+        _payer_key(nome_pagante),
+        str(giorno)[:10],
+        str(ora)[:5],
+        f"{float(somma):.2f}"
+    ))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def payment_content_hash(payment_data):
+    """Hash del contenuto di un pagamento parsato (dict di parse_payment_message)."""
+    return content_hash(
+        payment_data['nome_pagante'], payment_data['giorno'],
+        payment_data['ora'], payment_data['somma']
+    )
+
+
+def ensure_content_hash_column(conn):
+    """
+    Aggiunge la colonna hash_contenuto (e il suo indice) alla tabella pagamenti.
+    Le righe esistenti restano NULL: vedi backfill_payment_hash.py.
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(pagamenti)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'hash_contenuto' not in columns:
+        cursor.execute('ALTER TABLE pagamenti ADD COLUMN hash_contenuto TEXT')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pagamenti_hash_contenuto ON pagamenti (hash_contenuto)')
+    conn.commit()
+
+
+def telegram_fonte_msg_id(channel_id, message_id):
+    """
+    Chiave di deduplicazione di un messaggio Telegram.
+
+    Args:
+        channel_id: ID del canale
+        message_id: ID del messaggio nel canale
+
+    Returns:
+        Stringa 'tg_{channel_id}_{message_id}' (colonna fonte_msg_id)
+    """
+    return f"tg_{channel_id}_{message_id}"
+
+
+def insert_payments(cursor, payments):
+    """
+    Inserisce un batch di pagamenti ignorando quelli già presenti
+    (stesso fonte_msg_id o stesso hash del contenuto, anche all'interno del batch).
+
+    NON esegue commit: il chiamante committa il batch in un'unica transazione
+    (insieme al cursore/checkpoint, se presente).
+    Richiede la colonna hash_contenuto (ensure_content_hash_column).
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+        payments: Lista di tuple (payment_data, fonte_msg_id)
+
+    Returns:
+        Tupla (inseriti, duplicati)
+    """
+    if not payments:
+        return 0, 0
+
+    rows = []
+    for payment_data, fonte_msg_id in payments:
+        hash_contenuto = payment_content_hash(payment_data)
+        rows.append((
+            payment_data['nome_pagante'],
+            payment_data['giorno'],
+            payment_data['ora'],
+            payment_data['somma'],
+            payment_data['valuta'],
+            payment_data['stato'],
+            fonte_msg_id,
+            hash_contenuto,
+            hash_contenuto
+        ))
+
+    # Il controllo sull'hash usa l'indice idx_pagamenti_hash_contenuto e vede
+    # anche le righe inserite prima nello stesso executemany
+    cursor = cursor.executemany('''
+        INSERT INTO pagamenti
+        (nome_pagante, giorno, ora, somma, valuta, stato, fonte_msg_id, hash_contenuto)
+        SELECT ?, ?, ?, ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM pagamenti WHERE hash_contenuto = ?)
+        ON CONFLICT(fonte_msg_id) DO NOTHING
+    ''', rows)
+
+    # Con executemany rowcount è la somma delle righe effettivamente inserite
+    inserted = max(cursor.rowcount, 0)
+    return inserted, len(payments) - inserted
+
+
+def upsert_payments(cursor, payments):
+    """
+    Come insert_payments, ma i pagamenti già presenti (stesso fonte_msg_id)
+    vengono aggiornati con i campi estratti, se sono cambiati.
+    Lo stato e gli abbinamenti dei pagamenti esistenti non vengono toccati.
+
+    Usato da reparse_messages.py per rielaborare l'archivio con il parser attuale.
+    NON esegue commit.
+
+    Args:
+        cursor: Cursore (o connessione) SQLite
+        payments: Lista di tuple (payment_data, fonte_msg_id)
+
+    Returns:
+        Tupla (inseriti, aggiornati, invariati o duplicati)
+    """
+    if not payments:
+        return 0, 0, 0
+
+    # Lookup a blocchi: il batch può superare il limite di variabili di SQLite
+    ids = [fonte_msg_id for _, fonte_msg_id in payments]
+    existing = set()
+    for i in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+        chunk = ids[i:i + LOOKUP_CHUNK_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        existing.update(
+            row[0] for row in cursor.execute(
+                f'SELECT fonte_msg_id FROM pagamenti WHERE fonte_msg_id IN ({placeholders})', chunk
+            ).fetchall()
+        )
+
+    new = [(p, fonte_msg_id) for p, fonte_msg_id in payments if fonte_msg_id not in existing]
+    inserted, _ = insert_payments(cursor, new)
+
+    updates = []
+    for payment_data, fonte_msg_id in payments:
+        if fonte_msg_id in existing:
+            fields = (payment_data['nome_pagante'], payment_data['giorno'], payment_data['ora'], payment_data['somma'])
+            updates.append(fields + (payment_content_hash(payment_data), fonte_msg_id) + fields)
+
+    updated = 0
+    if updates:
+        cursor = cursor.executemany('''
+            UPDATE pagamenti
+            SET nome_pagante = ?, giorno = ?, ora = ?, somma = ?, hash_contenuto = ?
+            WHERE fonte_msg_id = ?
+              AND (nome_pagante IS NOT ? OR giorno IS NOT ? OR ora IS NOT ? OR somma IS NOT ?)
+        ''', updates)
+        updated = max(cursor.rowcount, 0)
+
+    return inserted, updated, len(payments) - inserted - updated
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Rate limiter adattivo (token bucket) per lo scaricamento dello storico Telegram.
+
+Al posto di BATCH_SIZE e DELAY fissi: finché Telegram accetta le richieste
+il limiter aumenta gradualmente richieste/secondo e dimensione del batch;
+al primo FloodWaitError dimezza entrambi e rispetta l'attesa richiesta
+(additive/multiplicative: cresce piano, rallenta subito).
+
+Ogni batch costa un token per ogni richiesta API che Telethon esegue
+(GetHistory restituisce al massimo 100 messaggi per richiesta).
+
+QpsLimiter è invece un budget fisso di richieste/secondo condiviso tra thread
+(es. i fetch paralleli del sync completo di Google Calendar).
+"""
+import math
+import time
+import asyncio
+import threading
+
+# Messaggi massimi per singola richiesta GetHistory
+MESSAGES_PER_REQUEST = 100
+
+# Tolleranza sugli arrotondamenti float dei token (evita attese infinitesimali)
+TOKEN_EPSILON = 1e-6
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket con rate e dimensione batch adattivi.
+
+    Uso:
+        limiter = AdaptiveRateLimiter()
+        batch_size = await limiter.acquire()
+        try:
+            ...scarica batch_size messaggi...
+            limiter.on_success(len(messages))
+        except FloodWaitError as e:
+            limiter.on_flood_wait(e.seconds)
+
+    Più task possono condividere lo stesso limiter (es. un canale per task):
+    acquire() li serve in ordine di arrivo, quindi ognuno ottiene la sua quota
+    del budget globale invece di farsi superare dagli altri.
+
+    clock e sleep sono iniettabili per simulare il tempo nei benchmark
+    (vedi test_rate_limiting.py).
+    """
+
+    def __init__(self, rate=1 / 3, min_rate=0.05, max_rate=20.0,
+                 batch_size=100, min_batch_size=100, max_batch_size=1000,
+                 burst=3, grow_after=5, grow_factor=1.25, backoff_factor=0.5,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        """
+        Args:
+            rate: Richieste al secondo iniziali
+            min_rate: Rate minimo dopo i backoff
+            max_rate: Rate massimo (limite Telegram ~20 req/s)
+            batch_size: Messaggi per batch iniziali
+            min_batch_size: Batch minimo dopo i backoff
+            max_batch_size: Batch massimo
+            burst: Token accumulabili (richieste consecutive senza attesa)
+            grow_after: Successi consecutivi prima di aumentare rate e batch
+            grow_factor: Moltiplicatore del rate a ogni crescita
+            backoff_factor: Moltiplicatore di rate e batch dopo un FloodWait
+            clock: Funzione che restituisce i secondi correnti
+            sleep: Coroutine di attesa (asyncio.sleep)
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.burst = burst
+        self.grow_after = grow_after
+        self.grow_factor = grow_factor
+        self.backoff_factor = backoff_factor
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = 1.0
+        self.last_refill = clock()
+        self.blocked_until = 0.0
+        self.success_streak = 0
+        self.lock = asyncio.Lock()
+
+        # Statistiche per il report
+        self.started_at = None
+        self.requests = 0
+        self.messages = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def _refill(self):
+        """Aggiunge i token maturati dall'ultimo refill."""
+        now = self.clock()
+        # La capacità copre sempre almeno un batch intero
+        capacity = max(self.burst, self.requests_for(self.batch_size))
+        self.tokens = min(capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def requests_for(self, batch_size):
+        """Numero di richieste API necessarie per un batch."""
+        return max(1, math.ceil(batch_size / MESSAGES_PER_REQUEST))
+
+    async def acquire(self):
+        """
+        Attende finché c'è budget per il prossimo batch.
+
+        Returns:
+            Dimensione del batch da scaricare
+        """
+        async with self.lock:
+            return await self._acquire()
+
+    async def _acquire(self):
+        """acquire() senza lock: attende i token e li consuma."""
+        if self.started_at is None:
+            self.started_at = self.clock()
+
+        # Rispetta un eventuale FloodWait in corso
+        now = self.clock()
+        if now < self.blocked_until:
+            await self.sleep(self.blocked_until - now)
+            self.last_refill = self.clock()
+
+        batch_size = self.batch_size
+        cost = self.requests_for(batch_size)
+
+        self._refill()
+        while self.tokens < cost - TOKEN_EPSILON:
+            await self.sleep((cost - self.tokens) / self.rate)
+            self._refill()
+
+        self.tokens = max(0.0, self.tokens - cost)
+        self.requests += cost
+        return batch_size
+
+    def on_success(self, message_count):
+        """
+        Registra un batch riuscito; dopo grow_after successi consecutivi
+        aumenta rate e dimensione batch.
+        """
+        self.messages += message_count
+        self.success_streak += 1
+
+        if self.success_streak >= self.grow_after:
+            self.success_streak = 0
+            self.rate = min(self.max_rate, self.rate * self.grow_factor)
+            self.batch_size = min(self.max_batch_size, self.batch_size + MESSAGES_PER_REQUEST)
+
+    def on_flood_wait(self, seconds):
+        """
+        Registra un FloodWait: blocca per `seconds` e dimezza rate e batch.
+        """
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.success_streak = 0
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+        self.tokens = 0.0
+
+        self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+        reduced = int(self.batch_size * self.backoff_factor)
+        reduced -= reduced % MESSAGES_PER_REQUEST
+        self.batch_size = max(self.min_batch_size, reduced)
+
+    def report(self):
+        """
+        Statistiche del rate effettivamente ottenuto.
+
+        Returns:
+            dict con elapsed, requests, messages, flood_waits, flood_wait_seconds,
+            req_per_sec, msg_per_sec, rate (attuale), batch_size (attuale)
+        """
+        elapsed = self.clock() - self.started_at if self.started_at is not None else 0
+        return {
+            'elapsed': elapsed,
+            'requests': self.requests,
+            'messages': self.messages,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'req_per_sec': self.requests / elapsed if elapsed > 0 else 0,
+            'msg_per_sec': self.messages / elapsed if elapsed > 0 else 0,
+            'rate': self.rate,
+            'batch_size': self.batch_size
+        }
+
+
+class QpsLimiter:
+    """
+    Budget globale di richieste al secondo, condiviso tra più thread.
+
+    Ogni acquire() prenota il primo slot libero (uno ogni 1/rate secondi) e
+    attende fuori dal lock: i thread vengono serviti in ordine di arrivo.
+
+    Uso:
+        limiter = QpsLimiter(5)
+        limiter.acquire()
+        ...una richiesta API...
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            rate: Richieste al secondo massime
+            clock: Funzione che restituisce i secondi correnti
+            sleep: Funzione di attesa (time.sleep)
+        """
+        self.interval = 1 / rate
+        self.clock = clock
+        self.sleep = sleep
+
+        self.next_slot = 0.0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Attende il proprio slot nel budget."""
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            self.requests += 1
+
+        if slot > now:
+            self.sleep(slot - now)
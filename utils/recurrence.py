@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Espansione locale degli eventi ricorrenti di Google Calendar.
+
+Con singleEvents=True Google restituisce ogni occorrenza di una lezione settimanale
+come evento separato. Con singleEvents=False arrivano invece solo l'evento
+"master" (con le regole RRULE/EXDATE/RDATE in 'recurrence') e le eccezioni
+(occorrenze spostate, rinominate o cancellate): expand_events() genera qui le
+occorrenze del range richiesto, nello stesso formato di singleEvents=True.
+
+Le regole si applicano all'ora locale: start.timeZone dell'evento o, se manca, il
+fuso del calendario (campo timeZone della risposta di events().list), così le
+occorrenze non si spostano di un'ora dopo il cambio dell'ora legale.
+
+Gli id delle occorrenze sono quelli che assegna Google (e che sono già in
+lezioni.nextcloud_event_id):
+- eventi con orario: <id master>_<inizio originale in UTC, YYYYMMDDTHHMMSSZ>
+- eventi all-day:    <id master>_<giorno originale, YYYYMMDD>
+"""
+from datetime import datetime, date, timezone
+from zoneinfo import ZoneInfo
+
+from dateutil.rrule import rrulestr
+
+from utils.calendar_mirror import MIRROR_EVENT_FIELDS
+
+# Campi evento per l'espansione locale (oltre a quelli della copia locale)
+RECURRENCE_EVENT_FIELDS = MIRROR_EVENT_FIELDS + ',recurrence,recurringEventId,originalStartTime'
+
+
+def _parse_bound(value):
+    """Limite timeMin/timeMax RFC 3339 → datetime aware."""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _master_start(event, default_timezone=None):
+    """
+    Inizio del master nel fuso dell'evento.
+
+    Args:
+        event: Evento master
+        default_timezone: Fuso da usare se start non ha timeZone (fuso del calendario)
+
+    Returns:
+        Tupla (dtstart, all_day); dtstart è naive per gli eventi all-day
+    """
+    start = event['start']
+    if 'dateTime' not in start:
+        return datetime.combine(date.fromisoformat(start['date']), datetime.min.time()), True
+
+    dtstart = datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+    timezone_name = start.get('timeZone') or default_timezone
+    if timezone_name:
+        # Le regole si applicano all'ora locale del fuso (cambi d'ora), non all'offset fisso
+        dtstart = dtstart.astimezone(ZoneInfo(timezone_name))
+    return dtstart, False
+
+
+def _in_window(event, time_min, time_max):
+    """True se l'inizio dell'evento è tra time_min e time_max (inclusi, come per le occorrenze)."""
+    start = event.get('start', {})
+    if 'dateTime' in start:
+        return time_min <= _parse_bound(start['dateTime']) <= time_max
+    if 'date' in start:
+        return time_min.date() <= date.fromisoformat(start['date']) <= time_max.date()
+    return True
+
+
+def instance_id(master_id, original_start, all_day):
+    """id Google di un'occorrenza (vedi docstring del modulo)."""
+    if all_day:
+        return f"{master_id}_{original_start.strftime('%Y%m%d')}"
+    return f"{master_id}_{original_start.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}"
+
+
+def expand_recurring(master, time_min, time_max, default_timezone=None):
+    """
+    Occorrenze di un evento ricorrente tra time_min e time_max.
+
+    Args:
+        master: Evento con 'recurrence'
+        time_min, time_max: Range (datetime aware)
+        default_timezone: Fuso del calendario, se start del master non ha timeZone
+
+    Returns:
+        Lista di eventi occorrenza (id, status, summary, start, recurringEventId...)
+    """
+    dtstart, all_day = _master_start(master, default_timezone)
+    rules = rrulestr('\n'.join(master['recurrence']), dtstart=dtstart, forceset=True, unfold=True)
+
+    if all_day:
+        # Eventi all-day: confronto tra giorni (naive)
+        low = datetime.combine(time_min.date(), datetime.min.time())
+        high = datetime.combine(time_max.date(), datetime.min.time())
+    else:
+        low, high = time_min, time_max
+
+    timezone_name = master['start'].get('timeZone') or default_timezone
+    instances = []
+    for occurrence in rules.between(low, high, inc=True):
+        if all_day:
+            start = {'date': occurrence.date().isoformat()}
+        else:
+            start = {'dateTime': occurrence.isoformat()}
+            if timezone_name:
+                start['timeZone'] = timezone_name
+
+        instance = {
+            'id': instance_id(master['id'], occurrence, all_day),
+            'status': master.get('status', 'confirmed'),
+            'summary': master.get('summary', ''),
+            'start': start,
+            'recurringEventId': master['id'],
+        }
+        for key in ('colorId', 'description'):
+            if key in master:
+                instance[key] = master[key]
+        instances.append(instance)
+
+    return instances
+
+
+def expand_events(events, time_min, time_max, default_timezone=None):
+    """
+    Eventi di events().list(singleEvents=False) → eventi come con singleEvents=True.
+
+    Gli eventi singoli restano invariati, i master vengono espansi nel range e le
+    eccezioni (anche cancellate) sostituiscono l'occorrenza generata con lo stesso id.
+    Un'eccezione spostata fuori dal range toglie l'occorrenza generata e non viene
+    aggiunta; una spostata dentro il range da fuori viene aggiunta col suo id.
+
+    Args:
+        events: Eventi letti con singleEvents=False (campi RECURRENCE_EVENT_FIELDS)
+        time_min, time_max: timeMin/timeMax della richiesta (RFC 3339)
+        default_timezone: Fuso del calendario (timeZone della risposta di events().list)
+
+    Returns:
+        Lista di eventi
+    """
+    time_min = _parse_bound(time_min)
+    time_max = _parse_bound(time_max)
+
+    expanded = {}
+    exceptions = []
+    for event in events:
+        if event.get('recurringEventId'):
+            exceptions.append(event)
+        elif event.get('recurrence') and event.get('status') != 'cancelled':
+            for instance in expand_recurring(event, time_min, time_max, default_timezone):
+                expanded[instance['id']] = instance
+        else:
+            expanded[event['id']] = event
+
+    for event in exceptions:
+        if event.get('status') == 'cancelled' or _in_window(event, time_min, time_max):
+            expanded[event['id']] = event
+        else:
+            # Occorrenza spostata fuori dal range: non c'è più nel range
+            expanded.pop(event['id'], None)
+
+    return list(expanded.values())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Parser condiviso degli SMS bancari inoltrati sul canale Telegram.
+
+Un registro di template (uno per layout di messaggio bancario) con regex
+precompilate. Prima di qualsiasi regex, un filtro a sottostringhe (es. 'СЧЁТ',
+'Перевод') scarta i messaggi che non possono essere pagamenti: sul canale la
+maggior parte del traffico (spese, saldi, OTP) non arriva mai al motore regex.
+
+Per aggiungere un nuovo layout bancario:
+    register_template('nome_banca', ('PAROLA1', 'PAROLA2'), re.compile(r'...'))
+con i gruppi nominati hh, mm, somma, nome.
+"""
+import re
+
+# Registro dei template: lista di dict {name, keywords, pattern}
+BANK_TEMPLATES = []
+_COMPILED = []
+
+
+def register_template(name, keywords, pattern):
+    """
+    Registra un template di SMS bancario.
+
+    Args:
+        name: Nome del template (es. 'sber_transfer')
+        keywords: Tupla di sottostringhe che DEVONO comparire nel testo (prefiltro)
+        pattern: Regex compilata con gruppi nominati hh, mm, somma, nome
+    """
+    BANK_TEMPLATES.append({
+        'name': name,
+        'keywords': tuple(keywords),
+        'pattern': pattern
+    })
+    # Vista piatta (tuple) usata nel ciclo caldo: evita lookup di dict per messaggio
+    _COMPILED.append((tuple(keywords), pattern.search, BANK_TEMPLATES[-1]))
+
+
+# Formato: СЧЁТ3185 HH:MM Перевод [dettagli] XXXXр от NOME COGNOME Баланс: YYYYр
+register_template(
+    'sber_transfer',
+    ('СЧЁТ', 'Перевод'),
+    re.compile(
+        r'СЧЁТ\d+\s+'  # Numero conto
+        r'(?P<hh>\d{1,2}):(?P<mm>\d{2})\s+'  # Ora
+        r'Перевод.*?'  # "Перевод" con dettagli opzionali
+        r'(?P<somma>[\d\s]+)р\s+'  # Somma - può avere spazi nei numeri
+        r'от\s+'  # "от"
+        r'(?P<nome>[А-ЯЁA-Za-zА-яё]+(?:\s+[А-ЯЁA-Za-zА-яё]\.?)?)'  # Nome pagante
+    )
+)
+
+
+def match_template(message_text):
+    """
+    Trova il primo template che corrisponde al testo.
+
+    Args:
+        message_text: Testo del messaggio
+
+    Returns:
+        Tupla (template, match) o (None, None) se nessun template corrisponde
+    """
+    if not message_text:
+        return None, None
+
+    for keywords, search, template in _COMPILED:
+        # Prefiltro: sottostringhe obbligatorie, costa molto meno della regex
+        for keyword in keywords:
+            if keyword not in message_text:
+                break
+        else:
+            match = search(message_text)
+            if match:
+                return template, match
+
+    return None, None
+
+
+def build_payment(match, message_date):
+    """
+    Costruisce il dict del pagamento da un match di template.
+
+    Args:
+        match: Match della regex del template (gruppi hh, mm, somma, nome)
+        message_date: Data del messaggio (datetime object)
+
+    Returns:
+        dict con i dati estratti o None se la somma non è valida
+    """
+    somma_str = match.group('somma').strip()
+
+    # Normalizza il nome (Title Case)
+    nome_pagante = match.group('nome').strip().title()
+
+    # Costruisci data dal message_date
+    giorno = message_date.date().isoformat()
+    ora = f"{match.group('hh').zfill(2)}:{match.group('mm')}:00"
+
+    # Rimuovi tutti gli spazi dalla somma (gestisce "10 000" -> "10000")
+    somma_clean = somma_str.replace(' ', '').replace('\xa0', '')  # Rimuove spazi normali e non-breaking spaces
+
+    try:
+        somma = float(somma_clean)
+    except ValueError:
+        print(f"⚠️  Errore conversione somma: '{somma_str}' -> '{somma_clean}'")
+        return None
+
+    return {
+        'nome_pagante': nome_pagante,
+        'giorno': giorno,
+        'ora': ora,
+        'somma': somma,
+        'valuta': 'RUB',
+        'stato': 'sospeso'
+    }
+
+
+def parse_payment_message(message_text, message_date):
+    """
+    Estrae i dati di pagamento da un messaggio SMS.
+
+    Args:
+        message_text: Testo del messaggio
+        message_date: Data del messaggio (datetime object)
+
+    Returns:
+        dict con i dati estratti o None se il parsing fallisce
+    """
+    _, match = match_template(message_text)
+    if not match:
+        return None
+    return build_payment(match, message_date)
+
+
+def parse_many(messages):
+    """
+    Parsa un batch di messaggi.
+
+    Il dict del pagamento viene costruito solo per i messaggi che superano
+    prefiltro e regex: il resto del batch costa un controllo di sottostringa.
+
+    Args:
+        messages: Iterabile di tuple (testo, data)
+
+    Returns:
+        Lista allineata all'input: dict del pagamento o None per ogni messaggio
+    """
+    results = []
+    append = results.append
+    for text, date in messages:
+        _, match = match_template(text)
+        append(build_payment(match, date) if match else None)
+    return results
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Cursori persistenti nella tabella sync_status.
+
+Ogni fonte (calendario, canale Telegram, notifiche...) salva in sync_status
+l'ultimo punto elaborato, così un ciclo saltato o in ritardo riparte da lì
+invece di basarsi su una finestra temporale fissa.
+"""
+
+
+def ensure_sync_status_table(conn):
+    """
+    Crea la tabella sync_status (se non esiste) e aggiunge la colonna cursor.
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_status (
+            source TEXT PRIMARY KEY,
+            last_sync_at TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Le tabelle create dagli script gcal non hanno la colonna cursor
+    cursor.execute("PRAGMA table_info(sync_status)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'cursor' not in columns:
+        cursor.execute('ALTER TABLE sync_status ADD COLUMN cursor TEXT')
+
+    conn.commit()
+
+
+def get_cursor(conn, source):
+    """
+    Legge il cursore salvato per una fonte.
+
+    Args:
+        conn: Connessione SQLite attiva
+        source: Nome della fonte (es. 'payment_notifications')
+
+    Returns:
+        Valore del cursore (stringa) o None se mai salvato
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT cursor FROM sync_status WHERE source = ?', (source,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def save_cursor(conn, source, value):
+    """
+    Salva il cursore di una fonte.
+
+    NON esegue commit: il chiamante committa insieme ai dati elaborati,
+    così cursore e dati restano coerenti anche in caso di crash.
+
+    Args:
+        conn: Connessione SQLite attiva
+        source: Nome della fonte
+        value: Nuovo valore del cursore
+    """
+    conn.execute('''
+        INSERT INTO sync_status (source, last_sync_at, cursor, updated_at)
+        VALUES (?, datetime('now'), ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(source) DO UPDATE SET
+            last_sync_at = excluded.last_sync_at,
+            cursor = excluded.cursor,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (source, str(value)))
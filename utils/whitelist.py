@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Whitelist dei mittenti (studenti) nel database, con cache in memoria.
+
+La whitelist vive nella tabella mittenti_whitelist con una chiave precalcolata
+(nome normalizzato + translitterato, come in utils/name_matcher.py): il controllo
+di un pagante è una lookup O(1) sulla chiave, e solo i nomi sconosciuti passano
+al confronto fuzzy (varianti di scrittura della banca, es. "Наили Г." / "Наиля Г.").
+
+mittenti_whitelist.csv resta il file da modificare a mano: viene reimportato
+nella tabella solo quando cambia (mtime salvato in sync_status). Ogni modifica
+alla tabella incrementa una revisione in sync_status; la cache la ricontrolla
+al massimo ogni RELOAD_INTERVAL secondi e si ricarica solo se è cambiata.
+"""
+import csv
+import time
+import sqlite3
+from pathlib import Path
+
+from rapidfuzz import fuzz, process
+
+from utils.name_matcher import normalize_name, transliterate_cyrillic
+from utils.sync_status import ensure_sync_status_table, get_cursor, save_cursor
+
+# Fonti in sync_status
+REVISION_SOURCE = 'mittenti_whitelist'
+CSV_SOURCE = 'mittenti_whitelist_csv'
+
+# Score minimo (0-100) sul nome per accettare una variante fuzzy
+FUZZY_THRESHOLD = 85
+
+# Secondi tra due controlli della revisione (servizio residente)
+RELOAD_INTERVAL = 30
+
+
+def whitelist_key(name):
+    """
+    Chiave di lookup di un nome: normalizzato e translitterato in latino.
+
+    Args:
+        name: Nome pagante (es. "Дарья М.")
+
+    Returns:
+        Chiave (es. "dar'ia m")
+    """
+    return transliterate_cyrillic(normalize_name(name))
+
+
+def ensure_whitelist_table(conn):
+    """
+    Crea la tabella mittenti_whitelist (se non esiste).
+
+    Args:
+        conn: Connessione SQLite attiva
+    """
+    ensure_sync_status_table(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mittenti_whitelist (
+            nome_pagante TEXT PRIMARY KEY,
+            chiave TEXT NOT NULL,
+            studente INTEGER NOT NULL DEFAULT 1,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_whitelist_chiave ON mittenti_whitelist(chiave)')
+    conn.commit()
+
+
+def bump_revision(conn):
+    """
+    Segnala una modifica della whitelist ai processi che la tengono in cache.
+    NON esegue commit: va committato insieme alla modifica.
+    """
+    revision = get_cursor(conn, REVISION_SOURCE)
+    save_cursor(conn, REVISION_SOURCE, int(revision or 0) + 1)
+
+
+def _write_senders(conn, senders):
+    """Scrive i mittenti e incrementa la revisione, senza commit."""
+    rows = [(nome, whitelist_key(nome), int(studente)) for nome, studente in senders if nome]
+
+    conn.executemany('''
+        INSERT INTO mittenti_whitelist (nome_pagante, chiave, studente)
+        VALUES (?, ?, ?)
+        ON CONFLICT(nome_pagante) DO UPDATE SET
+            chiave = excluded.chiave,
+            studente = excluded.studente,
+            updated_at = CURRENT_TIMESTAMP
+    ''', rows)
+    bump_revision(conn)
+    return len(rows)
+
+
+def upsert_senders(conn, senders):
+    """
+    Inserisce o aggiorna mittenti nella whitelist.
+
+    Args:
+        conn: Connessione SQLite attiva
+        senders: Iterabile di tuple (nome_pagante, studente)
+
+    Returns:
+        Numero di mittenti scritti
+    """
+    ensure_whitelist_table(conn)
+    count = _write_senders(conn, senders)
+    conn.commit()
+    return count
+
+
+def import_whitelist_csv(conn, csv_path):
+    """
+    Importa mittenti_whitelist.csv nella tabella, solo se il file è cambiato
+    dall'ultimo import. Il CSV è la fonte di verità: i nomi tolti dal file
+    vengono tolti anche dalla tabella (nella stessa transazione).
+
+    Args:
+        conn: Connessione SQLite attiva
+        csv_path: Path al file CSV (colonne nome_pagante, studente)
+
+    Returns:
+        Numero di mittenti importati (0 se il file non esiste o non è cambiato)
+    """
+    if not csv_path.exists():
+        return 0
+
+    ensure_whitelist_table(conn)
+    mtime = str(csv_path.stat().st_mtime)
+    if get_cursor(conn, CSV_SOURCE) == mtime:
+        return 0
+
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        senders = [
+            (row['nome_pagante'].strip(), 1 if row.get('studente') == '1' else 0)
+            for row in csv.DictReader(f)
+            if row.get('nome_pagante')
+        ]
+
+    conn.execute('DELETE FROM mittenti_whitelist')
+    save_cursor(conn, CSV_SOURCE, mtime)
+    count = _write_senders(conn, senders)
+    conn.commit()
+    return count
+
+
+class SenderWhitelist:
+    """
+    Cache in memoria della whitelist, usabile come un set:
+
+        valid_senders = SenderWhitelist(DB_PATH, csv_path=WHITELIST_PATH)
+        if payment_data['nome_pagante'] in valid_senders:
+            ...
+
+    Lookup esatta sulla chiave, poi fuzzy solo sui nomi mai visti, limitata agli
+    studenti con la stessa iniziale del cognome. I risultati fuzzy sono memorizzati
+    fino al prossimo reload.
+    """
+
+    def __init__(self, db_path, csv_path=None, fuzzy_threshold=FUZZY_THRESHOLD,
+                 reload_interval=RELOAD_INTERVAL):
+        """
+        Args:
+            db_path: Path del database
+            csv_path: Path di mittenti_whitelist.csv (reimportato se cambia)
+            fuzzy_threshold: Score minimo per le varianti fuzzy (None = solo match esatti)
+            reload_interval: Secondi tra due controlli della revisione
+        """
+        self.db_path = db_path
+        self.csv_path = csv_path
+        self.fuzzy_threshold = fuzzy_threshold
+        self.reload_interval = reload_interval
+
+        self.revision = None
+        self.checked_at = None
+        self.keys = {}  # chiave -> studente (bool)
+        self.students_by_initial = {}  # iniziale cognome -> [chiavi nome]
+        self.fuzzy_cache = {}  # chiave -> bool
+
+    def __len__(self):
+        return sum(1 for studente in self.keys.values() if studente)
+
+    def __contains__(self, name):
+        return self.is_valid(name)
+
+    def refresh(self, force=False):
+        """
+        Ricarica la cache se la whitelist è cambiata (CSV o tabella).
+
+        Args:
+            force: Se True ignora reload_interval
+
+        Returns:
+            True se la cache è stata ricaricata
+        """
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.reload_interval:
+            return False
+        self.checked_at = now
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            ensure_whitelist_table(conn)
+            if self.csv_path is not None:
+                import_whitelist_csv(conn, self.csv_path)
+
+            revision = get_cursor(conn, REVISION_SOURCE)
+            if self.revision is not None and revision == self.revision:
+                return False
+
+            rows = conn.execute('SELECT chiave, studente FROM mittenti_whitelist').fetchall()
+        finally:
+            conn.close()
+
+        keys = {}
+        students_by_initial = {}
+        for chiave, studente in rows:
+            # Se due nomi hanno la stessa chiave, basta uno studente per renderla valida
+            keys[chiave] = keys.get(chiave, False) or bool(studente)
+
+        for chiave, studente in keys.items():
+            if studente:
+                first, _, initial = chiave.partition(' ')
+                students_by_initial.setdefault(initial, []).append(first)
+
+        self.keys = keys
+        self.students_by_initial = students_by_initial
+        self.fuzzy_cache = {}
+        self.revision = revision
+        return True
+
+    def is_valid(self, name):
+        """
+        Verifica se un pagante è uno studente in whitelist.
+
+        Args:
+            name: Nome pagante (come estratto dall'SMS)
+
+        Returns:
+            True se il pagante è uno studente
+        """
+        self.refresh()
+        key = whitelist_key(name)
+
+        studente = self.keys.get(key)
+        if studente is not None:
+            return studente
+
+        if self.fuzzy_threshold is None:
+            return False
+
+        if key not in self.fuzzy_cache:
+            self.fuzzy_cache[key] = self._fuzzy_match(key)
+        return self.fuzzy_cache[key]
+
+    def _fuzzy_match(self, key):
+        """Confronto fuzzy del nome tra gli studenti con la stessa iniziale."""
+        first, _, initial = key.partition(' ')
+        candidates = self.students_by_initial.get(initial)
+        if not candidates:
+            return False
+
+        return process.extractOne(
+            first, candidates, scorer=fuzz.ratio, score_cutoff=self.fuzzy_threshold
+        ) is not None
+
+
+def load_sender_whitelist(db_path, csv_path):
+    """
+    Carica la whitelist dei mittenti validi per l'ingestione e il reparse.
+    Il file CSV viene reimportato nella tabella solo se è cambiato.
+
+    Args:
+        db_path: Path del database
+        csv_path: Path di mittenti_whitelist.csv
+
+    Returns:
+        SenderWhitelist, anche vuota (nessun pagamento passa il filtro);
+        None se il file non esiste o non si carica (nessun filtro)
+    """
+    csv_path = Path(csv_path)
+    if not csv_path.exists():
+        print(f"⚠️  File whitelist non trovato: {csv_path}")
+        print("    Tutti i pagamenti verranno processati.")
+        return None
+
+    try:
+        valid_senders = SenderWhitelist(db_path, csv_path=csv_path)
+        valid_senders.refresh(force=True)
+    except Exception as e:
+        print(f"❌ Errore caricamento whitelist: {e}")
+        return None
+
+    if not len(valid_senders):
+        print(f"⚠️  Whitelist vuota (file: {csv_path})")
+        print("    Nessun mittente è valido: nessun pagamento verrà processato.")
+        return valid_senders
+
+    print(f"✅ Whitelist caricata: {len(valid_senders)} studenti validi")
+    return valid_senders
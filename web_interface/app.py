@@ -3,12 +3,18 @@
 Interfaccia Web - Gestione Storico Pagamenti e Lezioni
 Flask app per abbinare manualmente pagamenti storici a lezioni.
 """
+import sys
 import sqlite3
+import subprocess
 from pathlib import Path
 from datetime import datetime, timedelta
 from flask import Flask, render_template, request, redirect, url_for, jsonify
 import calendar
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils.calendar_watch import SyncCoalescer, load_channel, find_channel, STATE_SYNC
+from utils.lesson_sync import ensure_review_table
+
 app = Flask(__name__)
 DB_PATH = Path(__file__).parent.parent / "pagamenti.db"
 
@@ -1053,39 +1059,136 @@ def api_sync_payments():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
-@app.route('/api/sync_lessons', methods=['POST'])
-def api_sync_lessons():
-    """API per sincronizzare lezioni da Google Calendar (incrementale)."""
-    import subprocess
+def run_lessons_sync():
+    """Esegue gcal_incremental_sync.py (sync delta) e ne restituisce il risultato."""
+    script_path = Path(__file__).parent.parent / 'gcal_incremental_sync.py'
+
+    return subprocess.run(
+        [str(Path(__file__).parent.parent / '.cal/bin/python'), str(script_path)],
+        capture_output=True,
+        text=True,
+        timeout=120
+    )
 
+
+def run_lessons_sync_checked():
+    """
+    Come run_lessons_sync(), ma solleva un'eccezione se il sync fallisce
+    (exit code diverso da 0 o timeout), così SyncCoalescer la registra in last_error.
+    """
     try:
-        script_path = Path(__file__).parent.parent / 'gcal_incremental_sync.py'
+        result = run_lessons_sync()
+    except subprocess.TimeoutExpired as e:
+        raise RuntimeError(f"Timeout dopo {e.timeout}s: operazione troppo lunga") from e
 
-        result = subprocess.run(
-            [str(Path(__file__).parent.parent / '.cal/bin/python'), str(script_path)],
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
+    if result.returncode != 0:
+        output = (result.stderr or result.stdout or '').strip()
+        tail = '\n'.join(output.splitlines()[-5:])
+        raise RuntimeError(f"gcal_incremental_sync.py terminato con codice {result.returncode}: {tail}")
+    return result
 
-        if result.returncode == 0:
-            return jsonify({
-                'success': True,
-                'output': result.stdout,
-                'message': 'Lezioni sincronizzate da Google Calendar'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.stderr or result.stdout
-            }), 500
 
-    except subprocess.TimeoutExpired:
-        return jsonify({'success': False, 'error': 'Timeout: operazione troppo lunga'}), 500
+# Sync in background lanciati dalle notifiche push di Google Calendar
+calendar_sync = SyncCoalescer(run_lessons_sync_checked)
+
+
+@app.route('/api/sync_lessons', methods=['POST'])
+def api_sync_lessons():
+    """
+    API per sincronizzare lezioni da Google Calendar (incrementale).
+
+    Passa da calendar_sync: se è in corso un sync lanciato da una notifica,
+    aspetta che finisca invece di avviare un secondo processo in parallelo.
+    """
+    try:
+        result = calendar_sync.run_now()
+        return jsonify({
+            'success': True,
+            'output': result.stdout,
+            'message': 'Lezioni sincronizzate da Google Calendar'
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/calendar_notification', methods=['POST'])
+def api_calendar_notification():
+    """
+    Riceve le notifiche push di Google Calendar (watch channel, vedi gcal_watch_channel.py).
+
+    Verifica canale e token rispetto al canale salvato, poi avvia un sync delta in
+    background (accorpando le raffiche). Risponde subito: Google ritenta le
+    notifiche che non ricevono una risposta 2xx veloce.
+    """
+    conn = get_db()
+    channel = find_channel(conn, request.headers.get('X-Goog-Channel-ID'))
+    conn.close()
+
+    if channel is None or request.headers.get('X-Goog-Channel-Token') != channel['token']:
+        return '', 403
+
+    # 'sync' arriva alla creazione del canale: nessuna modifica da scaricare
+    if request.headers.get('X-Goog-Resource-State') != STATE_SYNC:
+        calendar_sync.notify()
+
+    return '', 204
+
+
+@app.route('/api/calendar_notification/status')
+def api_calendar_notification_status():
+    """Stato delle notifiche push e dei sync in background."""
+    conn = get_db()
+    channel = load_channel(conn)
+    conn.close()
+
+    return jsonify({
+        'channel_id': channel['id'] if channel else None,
+        'expiration': channel['expiration'].isoformat() if channel else None,
+        **calendar_sync.status()
+    })
+
+
+@app.route('/api/lezioni_da_verificare')
+def api_lezioni_da_verificare():
+    """Lezioni pagate il cui evento non è più nel calendario (non cancellate dal sync)."""
+    conn = get_db()
+    ensure_review_table(conn)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT
+            v.lezione_id,
+            v.nextcloud_event_id,
+            v.motivo,
+            v.segnalata_at,
+            l.nome_studente,
+            l.giorno,
+            l.ora,
+            COALESCE(SUM(pl.quota_usata), 0) as quota_pagata
+        FROM lezioni_da_verificare v
+        JOIN lezioni l ON l.id_lezione = v.lezione_id
+        LEFT JOIN pagamenti_lezioni pl ON pl.lezione_id = v.lezione_id
+        GROUP BY v.lezione_id
+        ORDER BY l.giorno DESC, l.ora DESC
+    ''')
+
+    lessons = []
+    for row in cursor.fetchall():
+        lessons.append({
+            'lezione_id': row['lezione_id'],
+            'nextcloud_event_id': row['nextcloud_event_id'],
+            'motivo': row['motivo'],
+            'segnalata_at': row['segnalata_at'],
+            'nome_studente': row['nome_studente'],
+            'giorno': row['giorno'],
+            'ora': row['ora'],
+            'quota_pagata': row['quota_pagata']
+        })
+
+    conn.close()
+    return jsonify({'lessons': lessons})
+
+
 @app.route('/api/update_calendar', methods=['POST'])
 def api_update_calendar():
     """API per aggiornare Google Calendar (colori lezioni pagate + normalizzazione nomi)."""